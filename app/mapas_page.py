@@ -7,6 +7,8 @@ from streamlit_folium import st_folium
 import random
 import time # Necessário para o sleep
 import os # <<< ADICIONADO para verificar existência do arquivo
+import requests
+from routing.osrm_client import osrm_get, url_rota, OSRM_SERVER_URL
 
 # Função para gerar cores aleatórias
 def gerar_cor_aleatoria():
@@ -256,15 +258,15 @@ def show():
                         # Calcular distância total (km) e tempo total (min) da rota
                         distancia_total_km = 0
                         tempo_total_min = 0
-                        import requests
+                        # Segmentos consultados pela sessão compartilhada (conexões keep-alive reaproveitadas)
                         for i in range(len(coords)-1):
                             origem = coords[i]
                             destino = coords[i+1]
                             # Ajuste para usar http://router.project-osrm.org se o local não estiver rodando
                             # url = f"http://router.project-osrm.org/route/v1/driving/{origem[1]},{origem[0]};{destino[1]},{destino[0]}?overview=full&geometries=geojson"
-                            url = f"http://localhost:5000/route/v1/driving/{origem[1]},{origem[0]};{destino[1]},{destino[0]}?overview=full&geometries=geojson"
+                            url = url_rota(origem, destino)
                             try:
-                                resp = requests.get(url, timeout=10)
+                                resp = osrm_get(url, timeout=10)
                                 if resp.status_code == 200:
                                     data = resp.json()
                                     if data.get('routes'):
@@ -286,7 +288,7 @@ def show():
                                      # st.warning(f"OSRM request failed for segment {i}: Status {resp.status_code}")
                                      pass # Continua tentando os próximos segmentos
                             except requests.exceptions.ConnectionError:
-                                 st.error("Erro de conexão com o servidor OSRM local (localhost:5000). Verifique se o container Docker está rodando.")
+                                 st.error(f"Erro de conexão com o servidor OSRM ({OSRM_SERVER_URL}). Verifique se o container Docker está rodando.")
                                  break # Para de tentar calcular rotas se OSRM não está acessível
                             except Exception as osrm_err:
                                  # st.warning(f"Erro ao buscar rota OSRM para segmento {i}: {osrm_err}")
@@ -2,6 +2,7 @@ import streamlit as st
 import pandas as pd
 import numpy as np # Adicionado para uso potencial
 import time # Adicionado para uso potencial
+import os
 
 # Importações adicionadas para funcionalidade completa
 from database import (
@@ -13,13 +14,29 @@ from database import (
 # Ajuste na importação dos solvers para pegar do módulo correto
 from routing.cvrp import solver_cvrp
 from routing.cvrp_flex import solver_cvrp_flex
-from routing.distancias import calcular_matriz_distancias
+from routing.decomposicao import solver_cvrp_decomposto, LIMITE_DECOMPOSICAO
+from routing.portfolio import solver_cvrp_portfolio
+from routing.vrptw import solver_vrptw
+from routing.distancias import (calcular_matrizes_tempo_distancia, calcular_matrizes_esparsas, atualizar_matrizes_tempo_distancia,
+                                LIMITE_MATRIZ_DENSA)
+from routing.simulador import simular_cenario
 from pedidos import obter_coordenadas # Para geocodificação do endereço de partida
 
 # Constantes para endereço de partida padrão
 DEFAULT_ENDERECO_PARTIDA = "Avenida Antonio Ortega, 3604 - Pinhal, Cabreúva - SP, 13315-000"
 DEFAULT_LAT_PARTIDA = -23.251501
 DEFAULT_LON_PARTIDA = -47.084560
+ROTEIRIZACAO_CSV_PATH = "/workspaces/WazeLog/data/Roteirizacao.csv"
+INTERVALO_GRAFICO_BUSCA_S = 0.5 # Intervalo mínimo entre redesenhos do gráfico da busca
+
+def _desenhar_busca(painel, historico):
+    """Gráfico da distância da melhor solução ao longo da busca do solver, com o resumo da última melhora."""
+    ultima = historico[-1]
+    with painel.container():
+        st.caption(f"Melhor solução até agora: {ultima['objetivo'] / 1000:,.1f} km com {ultima['veiculos']} veículo(s), "
+                   f"após {ultima['tempo_s']:.1f}s de busca ({len(historico)} melhoras).")
+        grafico = pd.DataFrame(historico).assign(**{'Distância (km)': lambda df: df['objetivo'] / 1000})
+        st.line_chart(grafico.set_index('tempo_s')['Distância (km)'], height=200)
 
 def show():
     # Inicializa o estado da sessão para cenários, se necessário
@@ -169,13 +186,15 @@ def show():
         st.subheader("Configuração da Roteirização")
         tipo = st.selectbox(
             "Selecione o tipo de problema de roteirização",
-            ["CVRP", "CVRP Flex"],
+            ["CVRP", "CVRP Flex", "VRPTW"],
             key="tipo_roteirizacao_select",
             help="Escolha o algoritmo de roteirização baseado nas restrições do seu problema."
         )
         explicacoes = {
             "CVRP": "CVRP (Capacitated VRP): Considera a capacidade máxima (Kg ou Cx) dos veículos.",
-            "CVRP Flex": "CVRP Flex: Permite ajustar a capacidade dos veículos de 0% a 120% para simular sobrecarga controlada."
+            "CVRP Flex": "CVRP Flex: Permite ajustar a capacidade dos veículos de 0% a 120% para simular sobrecarga controlada.",
+            "VRPTW": "VRPTW (VRP with Time Windows): Além da capacidade, respeita a janela de entrega de cada pedido "
+                     "('Janela Início'/'Janela Fim'), o tempo de serviço nas paradas e o horário de cada veículo."
         }
         st.info(explicacoes.get(tipo, ""))
 
@@ -187,6 +206,46 @@ def show():
                 help="Permite simular veículos carregando menos ou até 20% a mais que a capacidade cadastrada."
             )
 
+        simulacao_rapida = st.checkbox(
+            "Simulação rápida (matriz simétrica aproximada)", value=False, key="simulacao_rapida_cb",
+            help="Consulta no OSRM só um sentido de cada par de pontos (cerca de metade das requisições) e espelha o outro. "
+                 "Indicado para testar cenários; em vias de mão única os tempos e distâncias ficam aproximados."
+        )
+
+        decompor = False
+        if tipo == "CVRP":
+            decompor = st.checkbox(
+                "Dividir em regiões (muitos pedidos)", value=len(pedidos_validos) > LIMITE_DECOMPOSICAO, key="decompor_cb",
+                help="Agrupa os pedidos em regiões com demanda equilibrada, divide a frota entre elas e resolve cada região "
+                     "separadamente. Recomendado acima de alguns milhares de pedidos, quando o modelo único não converge."
+            )
+
+        # Warm start: a busca parte das rotas do último cenário (ou do último CSV salvo) em vez de começar do zero
+        partir_anterior = False
+        if tipo == "CVRP" and not decompor and (st.session_state.cenarios_roteirizacao or os.path.exists(ROTEIRIZACAO_CSV_PATH)):
+            partir_anterior = st.checkbox(
+                "Partir da roteirização anterior", value=False, key="warm_start_cb",
+                help="Usa as rotas do último cenário calculado (ou de Roteirizacao.csv) como solução inicial. Depois de poucas "
+                     "mudanças nos pedidos, a otimização termina em segundos em vez de repetir a busca completa."
+            )
+
+        portfolio = False
+        if tipo == "CVRP" and not decompor and not partir_anterior:
+            portfolio = st.checkbox(
+                "Competição de estratégias", value=False, key="portfolio_cb",
+                help="Roda várias estratégias do OR-Tools em paralelo (um processo por núcleo) no mesmo tempo total "
+                     "e fica com a melhor rota."
+            )
+
+        # Parada da busca quando o plano já está bom o bastante (só CVRP sem decomposição/portfólio e VRPTW)
+        meta_km = 0.0
+        if tipo == "VRPTW" or (tipo == "CVRP" and not decompor and not portfolio):
+            meta_km = st.number_input(
+                "Encerrar a busca ao atingir (km)", min_value=0.0, value=0.0, step=10.0, key="meta_km_input",
+                help="Durante o cálculo, o gráfico mostra a distância da melhor solução encontrada. Com um valor acima de zero, "
+                     "a busca termina assim que a distância total chega a ele, sem esperar o limite de tempo."
+            )
+
         # --- Resumo dos Dados para Roteirização ---
         with st.container(border=True): # Adiciona borda ao container
             st.markdown("##### Resumo para Cálculo")
@@ -239,15 +298,47 @@ def show():
                 depot_index = 0 # Índice do depósito na lista all_locations
 
                 matriz_distancias = None
+                matriz_tempos = None
 
-                # Calcular Matriz de Distâncias (necessária para VRP, CVRP, TSP e cálculo final de distância)
+                # Calcular Matrizes de Distâncias e Tempos numa única passada pelo OSRM
+                # (distância para os solvers, tempo para a simulação do cenário)
                 with st.spinner("Calculando matriz de distâncias..."):
                     try:
-                        matriz_distancias = calcular_matriz_distancias(all_locations, metrica='distance')
+                        # Se o OSRM falhar, segue com a estimativa calibrada em vez de interromper a roteirização
+                        if len(all_locations) > LIMITE_MATRIZ_DENSA:
+                            # Muitos pontos: só os arcos entre vizinhos próximos vão ao OSRM
+                            matrizes_esparsas, metadados_matriz = calcular_matrizes_esparsas(
+                                all_locations, retornar_metadados=True, fallback="haversine")
+                            matriz_tempos, matriz_distancias = (matrizes_esparsas["duration"], matrizes_esparsas["distance"]) \
+                                if matrizes_esparsas is not None else (None, None)
+                        elif 'matrizes_roteirizacao' in st.session_state:
+                            # Pedidos editados desde a última roteirização: só os pontos novos vão ao OSRM
+                            anterior = st.session_state.matrizes_roteirizacao
+                            matriz_tempos, matriz_distancias, metadados_matriz = atualizar_matrizes_tempo_distancia(
+                                anterior['tempos'], anterior['distancias'], anterior['pontos'], all_locations,
+                                retornar_metadados=True, fallback="haversine", simetrica=simulacao_rapida)
+                        else:
+                            matriz_tempos, matriz_distancias, metadados_matriz = calcular_matrizes_tempo_distancia(
+                                all_locations, retornar_metadados=True, fallback="haversine", simetrica=simulacao_rapida)
+                        # Guarda as matrizes exatas (sem estimativa nem espelhamento) para a próxima atualização incremental
+                        if matriz_distancias is not None and metadados_matriz.get('provider_usado') == "osrm" \
+                                and metadados_matriz.get('modo') != "esparso" and not metadados_matriz.get('pares_espelhados'):
+                            st.session_state.matrizes_roteirizacao = {
+                                'pontos': list(all_locations), 'tempos': matriz_tempos, 'distancias': matriz_distancias,
+                            }
+                        if metadados_matriz.get('provider_usado') == "haversine":
+                             st.warning("OSRM indisponível: as distâncias e tempos foram estimados pela distância em linha reta "
+                                        "(calibrada com rotas já consultadas). Os resultados são aproximados.")
+                        elif metadados_matriz.get('blocos_estimados'):
+                             st.warning(f"O OSRM não respondeu {len(metadados_matriz['blocos_estimados'])} bloco(s) da matriz; "
+                                        "esses trechos foram estimados pela distância em linha reta e são aproximados.")
+                        if metadados_matriz.get('pares_espelhados'):
+                             st.info(f"Simulação rápida: {metadados_matriz['pares_espelhados']:,} pares foram espelhados do sentido "
+                                     "oposto em vez de consultados no OSRM. Os resultados são aproximados.")
                         if matriz_distancias is None or len(matriz_distancias) != len(all_locations):
                              st.error("Falha ao calcular a matriz de distâncias completa.")
                              matriz_distancias = None # Garante que não prossiga se falhar
-                        elif np.any(np.array(matriz_distancias) >= 1e7):
+                        elif (np.asarray(matriz_distancias) >= 1e7).any():
                              st.error("A matriz de distâncias contém valores infinitos ou impossíveis. Verifique as coordenadas dos pedidos e do depósito.")
                              return
                         else:
@@ -265,6 +356,18 @@ def show():
                     resultado_solver = None # Para armazenar o dict do VRPTW ou o DataFrame dos outros
                     status_solver = "Não executado"
 
+                    # Acompanhamento ao vivo da busca (CVRP e VRPTW): distância da melhor solução a cada melhora
+                    painel_busca = st.empty()
+                    historico_busca = []
+                    ultimo_desenho = [0.0]
+                    def _ao_melhorar(evento):
+                        historico_busca.append(evento)
+                        if time.time() - ultimo_desenho[0] >= INTERVALO_GRAFICO_BUSCA_S:
+                            ultimo_desenho[0] = time.time()
+                            _desenhar_busca(painel_busca, historico_busca)
+                    def _deve_parar():
+                        return meta_km > 0 and bool(historico_busca) and historico_busca[-1]['objetivo'] / 1000 <= meta_km
+
                     with st.spinner(f"Executando o solver {tipo}..."):
                         try:
                             if tipo == "CVRP":
@@ -277,9 +380,34 @@ def show():
                                      raise ValueError("Faltando 'Capacidade (Kg)'")
                                 else:
                                      # Passa a matriz de distâncias - CORRIGIDO: Removidos argumentos extras
-                                     rotas = solver_cvrp(pedidos_validos, frota, matriz_distancias)
+                                     if decompor:
+                                         rotas = solver_cvrp_decomposto(pedidos_validos, frota, matriz_distancias)
+                                     else:
+                                         rotas_anteriores = None
+                                         if partir_anterior:
+                                             if st.session_state.cenarios_roteirizacao:
+                                                 rotas_anteriores = st.session_state.cenarios_roteirizacao[0]['rotas']
+                                             else:
+                                                 rotas_anteriores = pd.read_csv(ROTEIRIZACAO_CSV_PATH)
+                                         if portfolio:
+                                             disputa = solver_cvrp_portfolio(pedidos_validos, frota, matriz_distancias)
+                                             rotas = disputa['rotas']
+                                             if disputa['vencedora']:
+                                                 st.info(f"Estratégia vencedora: {disputa['vencedora']}")
+                                                 with st.expander("Resultado de cada estratégia", expanded=False):
+                                                     st.dataframe(disputa['estrategias'], use_container_width=True, hide_index=True)
+                                         else:
+                                             rotas = solver_cvrp(pedidos_validos, frota, matriz_distancias, rotas_iniciais=rotas_anteriores,
+                                                                 ao_melhorar=_ao_melhorar, deve_parar=_deve_parar)
                                      rotas_df = rotas # Resultado já é DataFrame
                                      status_solver = "OK" if rotas_df is not None and not rotas_df.empty else "Falha ou Sem Solução"
+                            elif tipo == "VRPTW":
+                                rotas_df = solver_vrptw(pedidos_validos, frota, matriz_tempos, matriz_distancias,
+                                                        ao_melhorar=_ao_melhorar, deve_parar=_deve_parar)
+                                if rotas_df is not None and not rotas_df.empty and len(rotas_df) < len(pedidos_validos):
+                                    st.warning(f"{len(pedidos_validos) - len(rotas_df)} pedidos não couberam nas janelas de tempo "
+                                               "ou na capacidade e ficaram fora das rotas.")
+                                status_solver = "OK" if rotas_df is not None and not rotas_df.empty else "Falha ou Sem Solução"
                             elif tipo == "CVRP Flex":
                                 rotas = solver_cvrp_flex(pedidos_validos, frota, matriz_distancias, depot_index=depot_index, ajuste_capacidade_pct=ajuste_capacidade_pct)
                                 # Se o solver retornar dict, tenta extrair o DataFrame
@@ -311,6 +439,9 @@ def show():
                              st.session_state['rotas_calculadas'] = None
                              st.session_state['mapa_necessario'] = False
 
+                        if historico_busca:
+                            _desenhar_busca(painel_busca, historico_busca) # Estado final (o último redesenho pode ter sido pulado)
+
                         # Relatório automático de causas para inviabilidade
                         if status_solver and ("INFEASIBLE" in str(status_solver).upper() or "NENHUMA SOLUÇÃO" in str(status_solver).upper() or "Falha" in str(status_solver)):
                             st.warning("\n**Diagnóstico automático para problema inviável:**\n\n- Verifique se algum pedido tem demanda maior que a capacidade máxima dos veículos.\n- Revise as janelas de tempo dos veículos e pedidos (se existirem).\n- Confira se todos os pedidos possuem coordenadas válidas e não há outliers muito distantes.\n- Certifique-se de que a frota é suficiente para atender todos os pedidos.\n- Tente relaxar restrições (aumentar janelas, frota, capacidade) e rode novamente.\n\nSe o problema persistir, revise os dados de entrada e tente com um conjunto menor de pedidos.")
@@ -339,7 +470,7 @@ def show():
 
                             # <<< ADICIONAR CÓDIGO PARA SALVAR O CSV AQUI >>>
                             try:
-                                csv_path = "/workspaces/WazeLog/data/Roteirizacao.csv"
+                                csv_path = ROTEIRIZACAO_CSV_PATH
                                 rotas_df.to_csv(csv_path, index=False, encoding='utf-8')
                                 st.success(f"Rotas salvas com sucesso em {csv_path}")
                             except Exception as save_err:
@@ -395,6 +526,17 @@ def show():
                                      st.warning("Matriz de distâncias ou colunas necessárias não disponíveis para calcular a distância total real.")
                                  distancia_total_real_m = None # Garante que seja None se não calculado
 
+                            # Tempo de operação (viagem + serviço) a partir da matriz de tempos
+                            tempo_operacao_sec = None
+                            if matriz_tempos is not None and 'Veículo' in rotas_df.columns and 'Node_Index_OR' in rotas_df.columns:
+                                try:
+                                    rotas_simulacao = rotas_df.sort_values(['Veículo', 'Sequencia']).rename(columns={'Node_Index_OR': 'node_index'})
+                                    metricas_cenario = simular_cenario(rotas_simulacao, frota, np.asarray(matriz_distancias), np.asarray(matriz_tempos))
+                                    if metricas_cenario:
+                                        tempo_operacao_sec = metricas_cenario['tempo_operacao_total_h'] * 3600
+                                except Exception as sim_err:
+                                    st.warning(f"Não foi possível simular o tempo de operação do cenário: {sim_err}")
+
                             # --- Calcular e Exibir Resumo por Veículo ---
                             peso_total_empenhado_kg = 0
                             if isinstance(rotas_df, pd.DataFrame) and not rotas_df.empty and 'Veículo' in rotas_df.columns and 'Demanda' in rotas_df.columns:
@@ -438,7 +580,7 @@ def show():
                                 'peso_total_empenhado_kg': peso_total_empenhado_kg, # Adicionado
                                 'distancia_total_real_m': distancia_total_real_m,
                                 'custo_solver_sec': None, # Placeholder
-                                'tempo_operacao_sec': None, # Placeholder
+                                'tempo_operacao_sec': tempo_operacao_sec,
                                 'status_solver': status_solver,
                                 'endereco_partida': endereco_partida,
                                 'lat_partida': lat_partida,
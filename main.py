@@ -1,13 +1,163 @@
 import sys
 import os
+import json
+import asyncio
+from typing import Any, Dict, List, Literal, Optional
 
 # Add the parent directory to the Python path
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
 
-from fastapi import FastAPI
+import pandas as pd
+from fastapi import FastAPI, HTTPException
+from fastapi.responses import StreamingResponse
+from pydantic import BaseModel, Field
+
+from routing.pipeline import (submeter_job, consultar_job, consultar_melhorias, resultado_job, listar_jobs, cancelar_job,
+                              parar_job, ErroRoteirizacao, STATUS_FINAIS)
+
+INTERVALO_EVENTOS_S = 0.5 # Intervalo de verificação do progresso no streaming (SSE)
 
 app = FastAPI()
 
+
+class Deposito(BaseModel):
+    latitude: float = Field(..., ge=-90, le=90)
+    longitude: float = Field(..., ge=-180, le=180)
+
+
+class RoteirizacaoRequest(BaseModel):
+    """Pedidos e frota com as mesmas colunas das planilhas do app (ex.: 'Latitude', 'Peso dos Itens', 'Capacidade (Kg)')."""
+    tipo: Literal["CVRP", "CVRP Flex", "VRPTW"] = "CVRP"
+    pedidos: List[Dict[str, Any]]
+    frota: List[Dict[str, Any]]
+    deposito: Deposito
+    ajuste_capacidade_pct: int = Field(100, ge=0, le=120)
+    simetrica: bool = False
+    decompor: Optional[bool] = None # None: decompõe em clusters só com muitos pedidos
+    # Warm start do CVRP: rotas de uma roteirização anterior (ex.: Roteirizacao.csv) ou o id de um job concluído
+    rotas_iniciais: Optional[List[Dict[str, Any]]] = None
+    partir_do_job: Optional[str] = None
+    portfolio: bool = False # Várias estratégias do OR-Tools em paralelo (CVRP)
+
+
+def _registros(df):
+    """DataFrame -> lista de dicts serializável em JSON (NaN vira null)."""
+    if df is None or df.empty:
+        return []
+    return json.loads(df.to_json(orient="records", force_ascii=False))
+
+
+def _job_ou_404(job_id):
+    job = consultar_job(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail=f"Job {job_id} não encontrado.")
+    return job
+
+
 @app.get("/")
 def read_root():
     return {"message": "Wazelog FastAPI backend online!"}
+
+
+@app.post("/jobs", status_code=202)
+def criar_job(requisicao: RoteirizacaoRequest):
+    """Enfileira uma roteirização (matriz + solver) e retorna o id do job sem esperar o cálculo."""
+    rotas_iniciais = pd.DataFrame(requisicao.rotas_iniciais) if requisicao.rotas_iniciais else None
+    if requisicao.partir_do_job:
+        anterior = resultado_job(requisicao.partir_do_job)
+        if anterior is None:
+            raise HTTPException(status_code=422, detail=f"Job {requisicao.partir_do_job} não encontrado ou não concluído.")
+        rotas_iniciais = anterior['rotas']
+    try:
+        job_id = submeter_job(pd.DataFrame(requisicao.pedidos), pd.DataFrame(requisicao.frota),
+                              (requisicao.deposito.latitude, requisicao.deposito.longitude), tipo=requisicao.tipo,
+                              ajuste_capacidade_pct=requisicao.ajuste_capacidade_pct, simetrica=requisicao.simetrica,
+                              decompor=requisicao.decompor, rotas_iniciais=rotas_iniciais, portfolio=requisicao.portfolio)
+    except ErroRoteirizacao as e:
+        raise HTTPException(status_code=422, detail=str(e))
+    return consultar_job(job_id)
+
+
+@app.get("/jobs")
+def listar():
+    return listar_jobs()
+
+
+@app.get("/jobs/{job_id}")
+def status_job(job_id: str):
+    """Status ('pendente', 'executando', 'concluido', 'erro', 'cancelado'), etapa e progresso (0 a 1)."""
+    return _job_ou_404(job_id)
+
+
+@app.get("/jobs/{job_id}/eventos")
+async def eventos_job(job_id: str):
+    """
+    Progresso do job em Server-Sent Events: um evento 'progresso' a cada mudança e um evento 'melhoria'
+    a cada nova melhor solução do solver (objetivo, veículos usados e tempo de busca), até o job terminar.
+    """
+    _job_ou_404(job_id)
+
+    async def _gerar():
+        versao = None
+        enviadas = 0
+        while True:
+            job = consultar_job(job_id)
+            if job is None:
+                return
+            if job['versao'] != versao:
+                versao = job['versao']
+                for melhoria in consultar_melhorias(job_id, enviadas) or []:
+                    enviadas += 1
+                    yield f"event: melhoria\ndata: {json.dumps(melhoria)}\n\n"
+                yield f"event: progresso\ndata: {json.dumps(job, ensure_ascii=False)}\n\n"
+            if job['status'] in STATUS_FINAIS:
+                yield f"event: fim\ndata: {json.dumps({'status': job['status']})}\n\n"
+                return
+            await asyncio.sleep(INTERVALO_EVENTOS_S)
+
+    return StreamingResponse(_gerar(), media_type="text/event-stream", headers={"Cache-Control": "no-cache"})
+
+
+@app.get("/jobs/{job_id}/rotas")
+def rotas_job(job_id: str):
+    """Rotas calculadas (uma linha por parada), pedidos não alocados e metadados da matriz."""
+    job = _job_ou_404(job_id)
+    resultado = resultado_job(job_id)
+    if resultado is None:
+        detalhe = job['erro'] if job['status'] == "erro" else f"Job ainda não concluído (status: {job['status']})."
+        raise HTTPException(status_code=409, detail=detalhe)
+    metadados = {chave: valor for chave, valor in resultado['metadados_matriz'].items()
+                 if isinstance(valor, (str, int, float, bool, type(None)))}
+    return {
+        'job': job,
+        'distancia_total_m': resultado['distancia_total_m'],
+        'rotas': _registros(resultado['rotas']),
+        'pedidos_nao_alocados': _registros(resultado['pedidos_nao_alocados']),
+        'metadados_matriz': metadados,
+        'portfolio': _registros(resultado.get('portfolio')),
+    }
+
+
+@app.get("/jobs/{job_id}/melhorias")
+def melhorias_job(job_id: str):
+    """Histórico das melhores soluções do solver (objetivo, veículos usados e tempo de busca)."""
+    _job_ou_404(job_id)
+    return consultar_melhorias(job_id)
+
+
+@app.post("/jobs/{job_id}/parar")
+def parar(job_id: str):
+    """Encerra a busca do solver de um job em execução com a melhor solução até agora (o job conclui com ela)."""
+    job = _job_ou_404(job_id)
+    if not parar_job(job_id):
+        raise HTTPException(status_code=409, detail=f"Só jobs em execução podem ser parados (status: {job['status']}).")
+    return consultar_job(job_id)
+
+
+@app.delete("/jobs/{job_id}")
+def cancelar(job_id: str):
+    """Cancela um job que ainda está na fila (jobs em execução vão até o fim)."""
+    job = _job_ou_404(job_id)
+    if not cancelar_job(job_id):
+        raise HTTPException(status_code=409, detail=f"Só jobs na fila podem ser cancelados (status: {job['status']}).")
+    return consultar_job(job_id)
@@ -1,9 +1,35 @@
-def solver_cvrp(pedidos, frota, matriz_distancias):
-    """Capacitated VRP: considera a capacidade máxima de carga dos veículos além da roteirização."""
+def solver_cvrp(pedidos, frota, matriz_distancias, rotas_iniciais=None, primeira_solucao="PATH_CHEAPEST_ARC",
+                metaheuristica="GUIDED_LOCAL_SEARCH", tempo_limite_s=None, estatisticas=None, janela_sem_melhoria_s=None,
+                ao_melhorar=None, deve_parar=None):
+    """
+    Capacitated VRP: considera a capacidade máxima de carga dos veículos além da roteirização.
+
+    Peso (Kg) e caixas (Cx) são limitados ao mesmo tempo quando pedidos e frota têm as duas
+    colunas; nesse caso o resultado ganha 'Demanda_Cx' e 'Carga_Acumulada_Cx'.
+
+    Com `rotas_iniciais` (rotas de uma roteirização anterior, com 'Veículo', 'Sequencia' e
+    'Node_Index_OR'), a busca parte delas (warm start) em vez de `primeira_solucao`, com limite de
+    TEMPO_LIMITE_WARM_START_S: depois de pequenas mudanças nos pedidos, a solução converge em segundos.
+
+    `primeira_solucao` e `metaheuristica` são nomes de routing_enums_pb2.FirstSolutionStrategy e
+    LocalSearchMetaheuristic. Sem `tempo_limite_s`, o limite cresce com pedidos e veículos
+    (tempo_limite_adaptativo), e a busca termina antes se o objetivo não melhorar por
+    `janela_sem_melhoria_s` (padrão: uma fração do limite; 0 desliga). Se `estatisticas` (dict) for
+    passado, recebe 'objetivo', 'status', 'tempo_s', 'tempo_limite_s', 'tempo_melhor_s' (quando a
+    melhor solução apareceu), 'solucoes', 'parada_antecipada', 'parada_solicitada' e 'warm_start'.
+
+    `ao_melhorar` recebe cada nova melhor solução durante a busca ({'objetivo', 'veiculos', 'tempo_s'}),
+    e a busca termina com a melhor solução até ali quando `deve_parar()` retornar True (ver MonitorMelhoria).
+    """
+    import time
     import pandas as pd
     from ortools.constraint_solver import pywrapcp, routing_enums_pb2
     import numpy as np
     import logging # Adicionado para logging
+    from routing.distancias import MatrizEsparsa
+    from routing.ortools_comum import (registrar_transito_matriz, dimensoes_capacidade, registrar_dimensoes_capacidade, nome_status,
+                                       montar_rotas_iniciais, tempo_limite_adaptativo, janela_sem_melhoria,
+                                       MonitorMelhoria, extrair_paradas, TEMPO_LIMITE_WARM_START_S)
 
     logger = logging.getLogger(__name__) # Configura logger
 
@@ -13,7 +39,7 @@ def solver_cvrp(pedidos, frota, matriz_distancias):
     if frota.empty:
         logger.warning("CVRP Solver: DataFrame de frota vazio.")
         return pd.DataFrame() # Retorna DataFrame vazio
-    if not isinstance(matriz_distancias, (list, np.ndarray)) or len(matriz_distancias) == 0:
+    if not isinstance(matriz_distancias, (list, np.ndarray, MatrizEsparsa)) or len(matriz_distancias) == 0:
         logger.error("CVRP Solver: Matriz de distâncias inválida ou vazia.")
         return pd.DataFrame() # Retorna DataFrame vazio
 
@@ -25,30 +51,15 @@ def solver_cvrp(pedidos, frota, matriz_distancias):
     depot_index = 0 # Assumindo que o depósito é sempre o índice 0 na matriz_distancias
 
     # --- Preparação dos Dados para OR-Tools ---
-    # Demanda (garantir que seja numérica e tratar NaNs)
-    if 'Peso dos Itens' in pedidos.columns:
-        demands_series = pd.to_numeric(pedidos['Peso dos Itens'], errors='coerce').fillna(1)
-    elif 'Qtde. dos Itens' in pedidos.columns:
-        demands_series = pd.to_numeric(pedidos['Qtde. dos Itens'], errors='coerce').fillna(1)
-    else:
-        logger.warning("CVRP Solver: Coluna de demanda ('Peso dos Itens' ou 'Qtde. dos Itens') não encontrada. Usando demanda 1 para todos.")
-        demands_series = pd.Series([1] * n_pedidos)
-    # Adiciona 0 para o depósito no início da lista de demandas
-    demands = [0] + demands_series.astype(int).tolist()
-
-    # Capacidade (garantir que seja numérica e tratar NaNs/zeros)
-    if 'Capacidade (Kg)' in frota.columns:
-        capacities_series = pd.to_numeric(frota['Capacidade (Kg)'], errors='coerce').fillna(1)
-    elif 'Capacidade (Cx)' in frota.columns:
-        capacities_series = pd.to_numeric(frota['Capacidade (Cx)'], errors='coerce').fillna(1)
-    else:
-        logger.warning("CVRP Solver: Coluna de capacidade ('Capacidade (Kg)' ou 'Capacidade (Cx)') não encontrada. Usando capacidade 1000 para todos.")
-        capacities_series = pd.Series([1000] * n_veiculos)
-    # Garante que capacidade seja pelo menos 1
-    capacities = capacities_series.astype(int).clip(lower=1).tolist()
+    # Demandas (0 no depósito) e capacidades por dimensão: peso e, se cadastradas nos dois lados, caixas
+    dimensoes = dimensoes_capacidade(pedidos, frota)
+    identificadores = (frota['ID Veículo'] if 'ID Veículo' in frota.columns else
+                       frota['Placa'] if 'Placa' in frota.columns else
+                       pd.Series([f'veiculo_{v+1}' for v in range(n_veiculos)])).tolist()
 
     # Matriz de distâncias (já deve incluir o depósito no índice 0)
-    distance_matrix = np.array(matriz_distancias).astype(int).tolist() # Garante formato lista de listas de int
+    # Lida direto como array NumPy (sem .tolist()): int32/memmap evitam milhões de ints Python em instâncias grandes
+    distance_matrix = np.asarray(matriz_distancias)
     num_locations = len(distance_matrix)
 
     if num_locations != n_pedidos + 1:
@@ -60,37 +71,12 @@ def solver_cvrp(pedidos, frota, matriz_distancias):
         manager = pywrapcp.RoutingIndexManager(num_locations, n_veiculos, depot_index)
         routing = pywrapcp.RoutingModel(manager)
 
-        # Callback de Distância
-        def distance_callback(from_index, to_index):
-            from_node = manager.IndexToNode(from_index)
-            to_node = manager.IndexToNode(to_index)
-            # Validação de índices
-            if 0 <= from_node < num_locations and 0 <= to_node < num_locations:
-                return distance_matrix[from_node][to_node]
-            else:
-                logger.error(f"Índice fora dos limites no distance_callback: {from_node}, {to_node}")
-                return 9999999 # Retorna um valor alto para penalizar rotas inválidas
-        transit_callback_index = routing.RegisterTransitCallback(distance_callback)
+        # Distâncias e demandas registradas como trânsitos nativos (a busca não chama Python a cada arco)
+        transit_callback_index = registrar_transito_matriz(routing, manager, distance_matrix)
         routing.SetArcCostEvaluatorOfAllVehicles(transit_callback_index)
 
-        # Callback de Demanda e Dimensão de Capacidade
-        def demand_callback(from_index):
-            from_node = manager.IndexToNode(from_index)
-            # Validação de índices
-            if 0 <= from_node < len(demands):
-                return demands[from_node]
-            else:
-                 logger.error(f"Índice fora dos limites no demand_callback: {from_node}")
-                 return 0 # Retorna 0 para evitar falhas, mas indica problema
-        demand_callback_index = routing.RegisterUnaryTransitCallback(demand_callback)
-        routing.AddDimensionWithVehicleCapacity(
-            demand_callback_index,
-            0,  # Sem folga de capacidade
-            capacities,  # Capacidades máximas dos veículos
-            True,  # Começar cumulativo em zero
-            'Capacity'
-        )
-        capacity_dimension = routing.GetDimensionOrDie('Capacity')
+        # Uma dimensão por capacidade (sem folga, cumulativo começando em zero), todas no mesmo modelo
+        registrar_dimensoes_capacidade(routing, dimensoes)
 
     except Exception as e:
         logger.error(f"Erro na configuração do OR-Tools: {e}")
@@ -98,85 +84,92 @@ def solver_cvrp(pedidos, frota, matriz_distancias):
 
     # --- Parâmetros de Busca ---
     search_parameters = pywrapcp.DefaultRoutingSearchParameters()
-    search_parameters.first_solution_strategy = (
-        routing_enums_pb2.FirstSolutionStrategy.PATH_CHEAPEST_ARC
-    )
-    search_parameters.local_search_metaheuristic = (
-        routing_enums_pb2.LocalSearchMetaheuristic.GUIDED_LOCAL_SEARCH
-    )
-    search_parameters.time_limit.seconds = 30 # Adiciona um limite de tempo
+    search_parameters.first_solution_strategy = routing_enums_pb2.FirstSolutionStrategy.Value.Value(primeira_solucao)
+    search_parameters.local_search_metaheuristic = routing_enums_pb2.LocalSearchMetaheuristic.Value.Value(metaheuristica)
+    if tempo_limite_s is None:
+        tempo_limite_s = tempo_limite_adaptativo(num_locations, n_veiculos)
+    search_parameters.time_limit.FromMilliseconds(int(tempo_limite_s * 1000)) # Adiciona um limite de tempo
 
     # --- Resolução ---
-    logger.info("Iniciando a resolução do CVRP com OR-Tools...")
-    solution = routing.SolveWithParameters(search_parameters)
+    monitor = MonitorMelhoria(routing, janela_sem_melhoria(tempo_limite_s, janela_sem_melhoria_s),
+                              ao_melhorar=ao_melhorar, deve_parar=deve_parar, manager=manager)
+    routing.AddAtSolutionCallback(monitor)
+    solution = None
+    warm_start = False
+    if rotas_iniciais is not None:
+        rotas_nos = montar_rotas_iniciais(rotas_iniciais, pedidos, identificadores, dimensoes, distance_matrix)
+        if rotas_nos is not None:
+            routing.CloseModelWithParameters(search_parameters)
+            inicial = routing.ReadAssignmentFromRoutes([[manager.NodeToIndex(no) for no in rota] for rota in rotas_nos], True)
+            if inicial is not None:
+                limite = min(TEMPO_LIMITE_WARM_START_S, tempo_limite_s)
+                search_parameters.time_limit.FromMilliseconds(int(limite * 1000))
+                logger.info(f"Iniciando a resolução do CVRP a partir das rotas anteriores (limite de {limite}s)...")
+                solution = routing.SolveFromAssignmentWithParameters(inicial, search_parameters)
+                warm_start = True
+            else:
+                logger.warning("As rotas anteriores não formam uma solução válida para o modelo atual; usando a busca completa.")
+    if solution is None:
+        logger.info(f"Iniciando a resolução do CVRP com OR-Tools ({primeira_solucao} + {metaheuristica}, limite de {tempo_limite_s:.0f}s)...")
+        search_parameters.time_limit.FromMilliseconds(int(tempo_limite_s * 1000))
+        solution = routing.SolveWithParameters(search_parameters)
+        warm_start = False
+    monitor.relancar_erro()
     logger.info("Resolução do CVRP concluída.")
+    if estatisticas is not None:
+        estatisticas.update({
+            'objetivo': solution.ObjectiveValue() if solution else None,
+            'status': nome_status(routing),
+            'tempo_s': round(time.time() - monitor.inicio, 3),
+            'tempo_limite_s': tempo_limite_s,
+            'tempo_melhor_s': monitor.tempo_melhor_s,
+            'solucoes': monitor.solucoes,
+            'parada_antecipada': monitor.parada_antecipada,
+            'parada_solicitada': monitor.parada_solicitada,
+            'warm_start': warm_start,
+        })
 
     # --- Montagem do Resultado ---
-    routes_data = []
     if solution:
         logger.info("Solução encontrada. Processando rotas...")
-        total_distance_solution = 0
-        pedidos_roteirizados_indices = set()
-
-        for vehicle_id in range(n_veiculos):
-            index = routing.Start(vehicle_id)
-            sequence = 1 # Começa a sequência em 1 para o primeiro cliente
-            vehicle_identifier = (
-                frota['ID Veículo'].iloc[vehicle_id]
-                if 'ID Veículo' in frota.columns and not frota.empty else
-                frota['Placa'].iloc[vehicle_id] if 'Placa' in frota.columns and not frota.empty else f'veiculo_{vehicle_id+1}'
-            )
-            route_distance_vehicle = 0
-            route_load_vehicle = 0
-
-            while not routing.IsEnd(index):
-                node_index = manager.IndexToNode(index)
-                load_var = capacity_dimension.CumulVar(index)
-                current_load = solution.Value(load_var)
-
-                if node_index != depot_index: # Não adiciona o depósito como uma parada na sequência
-                    pedido_original_index = node_index - 1 # Ajusta para índice do DataFrame 'pedidos'
-                    if 0 <= pedido_original_index < n_pedidos:
-                        # Verifica se o pedido já foi roteirizado (não deveria acontecer com CVRP padrão)
-                        if pedido_original_index in pedidos_roteirizados_indices:
-                             logger.warning(f"Pedido {pedido_original_index} aparecendo em múltiplas rotas (Veículo {vehicle_identifier}). Verifique a lógica.")
-                        else:
-                            pedidos_roteirizados_indices.add(pedido_original_index)
-                            pedido_info = pedidos.iloc[pedido_original_index]
-                            routes_data.append({
-                                'Veículo': vehicle_identifier,
-                                'Sequencia': sequence,
-                                'Node_Index_OR': node_index, # Índice do nó no OR-Tools (inclui depósito)
-                                'Pedido_Index_DF': pedido_original_index, # Índice no DataFrame 'pedidos' original
-                                'ID Pedido': pedido_info.get('ID Pedido', f'Pedido_{pedido_original_index}'),
-                                'Cliente': pedido_info.get('Cliente', 'N/A'),
-                                'Endereço': pedido_info.get('Endereço', 'N/A'),
-                                'Demanda': demands[node_index],
-                                'Carga_Acumulada': current_load,
-                                # Adicionar Lat/Lon aqui pode ser útil, mas será feito merge depois
-                            })
-                            sequence += 1
-                            route_load_vehicle += demands[node_index] # Soma a demanda do nó atual
-                    else:
-                         logger.warning(f"Índice de pedido inválido ({pedido_original_index}) encontrado na rota do veículo {vehicle_identifier}.")
-
-                previous_index = index
-                index = solution.Value(routing.NextVar(index))
-                # Calcula a distância do arco
-                arc_distance = routing.GetArcCostForVehicle(previous_index, index, vehicle_id)
-                route_distance_vehicle += arc_distance
-
-            # Adiciona a distância do último nó de volta ao depósito (se houver rota)
-            if routing.IsEnd(index) and manager.IndexToNode(previous_index) != depot_index:
-                 end_node_index = routing.End(vehicle_id)
-                 arc_distance = routing.GetArcCostForVehicle(previous_index, end_node_index, vehicle_id)
-                 route_distance_vehicle += arc_distance
-
-            if sequence > 1: # Se o veículo fez alguma entrega
-                 logger.info(f"Veículo {vehicle_identifier}: {sequence-1} paradas, Carga={route_load_vehicle}, Dist={route_distance_vehicle/1000:.1f}km")
-                 total_distance_solution += route_distance_vehicle
-
-        rotas_df = pd.DataFrame(routes_data)
+        # O percurso das rotas só coleta arrays de inteiros; as colunas saem de uma vez sobre eles
+        veiculos, sequencias, nos, proximos = extrair_paradas(routing, manager, solution)
+        indices = nos - 1 # Índice no DataFrame 'pedidos' (o nó 0 é o depósito)
+        if len(np.unique(nos)) < len(nos):
+            logger.warning("Pedidos aparecendo em múltiplas rotas. Verifique a lógica.")
+
+        def _coluna(coluna, padrao):
+            return pedidos[coluna].to_numpy()[indices] if coluna in pedidos.columns else padrao
+
+        rotas_df = pd.DataFrame({
+            'Veículo': np.asarray(identificadores, dtype=object)[veiculos],
+            'Sequencia': sequencias,
+            'Node_Index_OR': nos, # Índice do nó no OR-Tools (inclui depósito)
+            'Pedido_Index_DF': indices, # Índice no DataFrame 'pedidos' original
+            'ID Pedido': _coluna('ID Pedido', [f'Pedido_{i}' for i in indices]),
+            'Cliente': _coluna('Cliente', 'N/A'),
+            'Endereço': _coluna('Endereço', 'N/A'),
+        })
+        # Carga acumulada ao chegar em cada parada = demandas das paradas anteriores da mesma rota (como o CumulVar)
+        inicio_rota = np.searchsorted(veiculos, veiculos)
+        for nome, demandas, _ in dimensoes:
+            sufixo = nome.replace('Capacity', '') # 'Capacity' -> '', 'Capacity_Cx' -> '_Cx'
+            demanda = np.asarray(demandas, dtype=np.int64)[nos]
+            anteriores = np.cumsum(demanda) - demanda
+            rotas_df['Demanda' + sufixo] = demanda
+            rotas_df['Carga_Acumulada' + sufixo] = anteriores - anteriores[inicio_rota]
+
+        # Custo de cada parada: arco de chegada, mais a volta ao depósito na última parada da rota
+        origens = np.where(sequencias == 1, depot_index, np.roll(nos, 1))
+        custos = distance_matrix[origens, nos].astype(np.int64) + \
+            np.where(proximos == depot_index, distance_matrix[nos, proximos], 0)
+        distancia_veiculo = np.bincount(veiculos, weights=custos, minlength=n_veiculos)
+        carga_veiculo = np.bincount(veiculos, weights=rotas_df['Demanda'], minlength=n_veiculos)
+        paradas_veiculo = np.bincount(veiculos, minlength=n_veiculos)
+        for vehicle_id in np.flatnonzero(paradas_veiculo):
+            logger.info(f"Veículo {identificadores[vehicle_id]}: {paradas_veiculo[vehicle_id]} paradas, "
+                        f"Carga={carga_veiculo[vehicle_id]:.0f}, Dist={distancia_veiculo[vehicle_id]/1000:.1f}km")
+        total_distance_solution = distancia_veiculo.sum()
 
         if rotas_df.empty:
              logger.warning("Solver CVRP encontrou uma solução, mas nenhuma rota válida foi gerada (talvez nenhum pedido atribuído).")
@@ -184,7 +177,7 @@ def solver_cvrp(pedidos, frota, matriz_distancias):
              logger.info(f"Total de {len(rotas_df)} paradas distribuídas.")
              logger.info(f"Distância total (solução OR-Tools): {total_distance_solution / 1000:.1f} km")
              # Verifica se todos os pedidos foram roteirizados
-             pedidos_nao_roteirizados = n_pedidos - len(pedidos_roteirizados_indices)
+             pedidos_nao_roteirizados = n_pedidos - len(np.unique(nos))
              if pedidos_nao_roteirizados > 0:
                   logger.warning(f"{pedidos_nao_roteirizados} pedidos não foram incluídos nas rotas pela solução.")
 
@@ -192,13 +185,7 @@ def solver_cvrp(pedidos, frota, matriz_distancias):
 
     else:
         logger.warning("Solver CVRP não encontrou solução.")
-        status_map = {
-            routing.ROUTING_NOT_SOLVED: 'NOT_SOLVED',
-            routing.ROUTING_FAIL: 'FAIL',
-            routing.ROUTING_FAIL_TIMEOUT: 'FAIL_TIMEOUT',
-            routing.ROUTING_INVALID: 'INVALID',
-        }
-        logger.warning(f"Status da solução: {routing.status()} ({status_map.get(routing.status(), 'UNKNOWN')})")
+        logger.warning(f"Status da solução: {routing.status()} ({nome_status(routing)})")
         # Tentar fornecer mais detalhes sobre a inviabilidade, se possível
         # (Ex: verificar se alguma demanda excede capacidade, etc. - já feito na página)
         return pd.DataFrame() # Retorna DataFrame vazio em caso de falha
@@ -2,12 +2,161 @@ import pandas as pd
 from ortools.constraint_solver import pywrapcp, routing_enums_pb2
 import numpy as np
 import time
+import os
+import mmap
+import shutil
+import logging
+import tempfile
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from routing.ortools_comum import (registrar_transito_matriz, registrar_transito_unario, tempo_limite_adaptativo,
+                                   janela_sem_melhoria, MonitorMelhoria, extrair_paradas)
 
-def solver_cvrp_flex(pedidos, frota, matriz_distancias, depot_index=0, ajuste_capacidade_pct=100, cenarios=None, diagnostico=False, metricas=False):
+# Processos para os cenários: padrão = núcleos disponíveis (variável de ambiente WAZELOG_MAX_PROCESSOS limita)
+MAX_PROCESSOS = int(os.environ["WAZELOG_MAX_PROCESSOS"]) if os.environ.get("WAZELOG_MAX_PROCESSOS") else None
+
+
+def run_solver(pedidos, frota, matriz_distancias, depot_index, ajuste_capacidade_pct, diagnostico=False, metricas=False,
+               tempo_limite_s=None, janela_sem_melhoria_s=None):
+    """
+    Resolve um cenário do CVRP Flex (função de módulo para poder rodar em outro processo).
+    Sem `tempo_limite_s`, o limite cresce com nós e veículos; a busca termina antes se o objetivo
+    não melhorar por `janela_sem_melhoria_s` (padrão: uma fração do limite; 0 desliga).
+    """
+    start_time = time.time()
+    resultado = {
+        'pedidos_result': None,
+        'diagnostico': None,
+        'metricas': None
+    }
+    if pedidos is None or pedidos.empty or frota is None or frota.empty or matriz_distancias is None:
+        resultado['diagnostico'] = 'Dados de entrada ausentes ou vazios.'
+        return resultado
+
+    # Lida direto como array NumPy (int32/memmap), sem converter para listas Python
+    matriz_distancias = np.asarray(matriz_distancias)
+    num_vehicles = len(frota)
+    num_nodes = len(matriz_distancias)
+    if num_nodes < 2 or num_vehicles < 1:
+        resultado['diagnostico'] = 'Frota ou matriz de distâncias insuficiente.'
+        return resultado
+
+    demanda_total = pedidos['Peso dos Itens'].fillna(0).sum()
+    ajuste = max(0, min(ajuste_capacidade_pct, 120)) / 100.0
+    capacidade_total = (frota['Capacidade (Kg)'].fillna(0).astype(float) * ajuste).sum()
+    if capacidade_total < demanda_total:
+        resultado['diagnostico'] = f"Demanda total ({demanda_total}) excede capacidade total da frota ({capacidade_total})."
+        return resultado
+
+    manager = pywrapcp.RoutingIndexManager(num_nodes, num_vehicles, depot_index)
+    routing = pywrapcp.RoutingModel(manager)
+
+    # Trânsitos nativos: a busca local não chama Python a cada arco
+    transit_callback_index = registrar_transito_matriz(routing, manager, matriz_distancias)
+    routing.SetArcCostEvaluatorOfAllVehicles(transit_callback_index)
+
+    demands = [0] + pedidos['Peso dos Itens'].fillna(0).astype(int).tolist()
+    demand_callback_index = registrar_transito_unario(routing, demands)
+
+    capacities = (frota['Capacidade (Kg)'].fillna(0).astype(float) * ajuste).astype(int).tolist()
+    routing.AddDimensionWithVehicleCapacity(
+        demand_callback_index,
+        0,
+        capacities,
+        True,
+        'Capacity')
+
+    search_parameters = pywrapcp.DefaultRoutingSearchParameters()
+    search_parameters.first_solution_strategy = (
+        routing_enums_pb2.FirstSolutionStrategy.PATH_CHEAPEST_ARC)
+    if tempo_limite_s is None:
+        tempo_limite_s = tempo_limite_adaptativo(num_nodes, num_vehicles)
+    search_parameters.time_limit.FromMilliseconds(int(tempo_limite_s * 1000))
+    routing.AddAtSolutionCallback(MonitorMelhoria(routing, janela_sem_melhoria(tempo_limite_s, janela_sem_melhoria_s)))
+
+    solution = routing.SolveWithParameters(search_parameters)
+
+    if solution:
+        veiculos, sequencias, nos, proximos = extrair_paradas(routing, manager, solution)
+        placas = frota['Placa'].to_numpy(dtype=object) if 'Placa' in frota.columns else np.arange(num_vehicles).astype(str).astype(object)
+        # Distância do arco que sai de cada parada (a última volta ao depósito)
+        distancias = matriz_distancias[nos, proximos].astype(np.int64)
+        # Pedido i = nó i + 1; uma única junção com os pedidos (os não atendidos ficam com as colunas vazias)
+        paradas = pd.DataFrame({
+            'Veículo': placas[veiculos],
+            'Sequencia': pd.array(sequencias, dtype='Int64'),
+            'Node_Index_OR': pd.array(nos, dtype='Int64'),
+            'distancia': pd.array(distancias, dtype='Int64'),
+        }, index=pedidos.index[nos - 1])
+        pedidos_result = pedidos.drop(columns=paradas.columns, errors='ignore').join(paradas)
+        pedidos_result['Pedido_Index_DF'] = pedidos_result.index
+        total_dist = int(distancias.sum())
+        veiculos_usados = len(np.unique(veiculos))
+        resultado['pedidos_result'] = pedidos_result
+        if metricas:
+            resultado['metricas'] = {
+                'distancia_total': total_dist,
+                'veiculos_usados': veiculos_usados,
+                'pedidos_atendidos': len(nos),
+                'pedidos_nao_atendidos': int(len(pedidos) - len(nos)),
+                'tempo_execucao_s': round(time.time() - start_time, 3)
+            }
+    else:
+        resultado['diagnostico'] = 'Não foi encontrada solução viável para o cenário.'
+        if diagnostico:
+            resultado['diagnostico'] += f' Demanda total: {demanda_total}, Capacidade total: {capacidade_total}, Veículos: {num_vehicles}'
+    return resultado
+
+
+
+def _run_solver_processo(pedidos, frota, arquivo_matriz, depot_index, ajuste_capacidade_pct, diagnostico, metricas):
+    """Executa run_solver num processo do pool, lendo a matriz compartilhada (.npy mapeado em memória)."""
+    matriz_distancias = np.load(arquivo_matriz, mmap_mode='r')
+    return run_solver(pedidos, frota, matriz_distancias, depot_index, ajuste_capacidade_pct, diagnostico, metricas)
+
+
+def _num_processos(num_cenarios, max_processos=None):
+    """Processos do pool: um por cenário, limitado aos núcleos disponíveis para este processo."""
+    if hasattr(os, "sched_getaffinity"):
+        nucleos = len(os.sched_getaffinity(0))
+    else:
+        nucleos = os.cpu_count() or 1
+    limite = max_processos or MAX_PROCESSOS or nucleos
+    return max(1, min(num_cenarios, limite))
+
+
+def _compartilhar_matrizes(parametros, pasta):
+    """
+    Grava cada matriz distinta dos cenários uma única vez em .npy (ou reaproveita o arquivo de uma
+    matriz que já é memmap .npy); os processos a abrem com mmap, em vez de receberem uma cópia
+    serializada por cenário. Retorna {id(matriz): caminho do arquivo}.
+    """
+    arquivos = {}
+    for params in parametros:
+        matriz = params['matriz_distancias']
+        if matriz is None or id(matriz) in arquivos:
+            continue
+        # Memmap .npy inteiro (ex.: arquivo_memmap de calcular_matriz_distancias): os processos abrem o mesmo arquivo
+        if isinstance(matriz, np.memmap) and isinstance(matriz.base, mmap.mmap) and str(matriz.filename).endswith('.npy'):
+            matriz.flush()
+            arquivos[id(matriz)] = str(matriz.filename)
+            continue
+        arquivo = os.path.join(pasta, f"matriz_{len(arquivos)}.npy")
+        np.save(arquivo, np.asarray(matriz))
+        arquivos[id(matriz)] = arquivo
+    return arquivos
+
+
+def solver_cvrp_flex(pedidos, frota, matriz_distancias, depot_index=0, ajuste_capacidade_pct=100, cenarios=None, diagnostico=False, metricas=False,
+                     max_processos=None, ao_concluir_cenario=None):
     """
     Resolve o problema CVRP permitindo ajuste percentual da capacidade dos veículos.
     Suporta simulação de cenários, diagnóstico de inviabilidade e retorno de métricas detalhadas.
-    
+
+    Com mais de um cenário, cada cenário roda num processo de um ProcessPoolExecutor (um por núcleo
+    disponível), então uma bateria de cenários leva perto do tempo de uma única resolução. A matriz
+    de distâncias é compartilhada entre os processos por um arquivo .npy mapeado em memória.
+
     Args:
         pedidos (pd.DataFrame): DataFrame dos pedidos, deve conter 'Peso dos Itens'.
         frota (pd.DataFrame): DataFrame da frota, deve conter 'Capacidade (Kg)'.
@@ -17,126 +166,60 @@ def solver_cvrp_flex(pedidos, frota, matriz_distancias, depot_index=0, ajuste_ca
         cenarios (list): Lista de dicionários com parâmetros para simulação de cenários.
         diagnostico (bool): Se True, retorna diagnóstico detalhado em caso de inviabilidade.
         metricas (bool): Se True, retorna métricas detalhadas da solução.
-    
+        max_processos (int, optional): Máximo de processos para os cenários. Padrão: núcleos disponíveis
+                                       (ou WAZELOG_MAX_PROCESSOS). 1 = cenários em sequência, sem processos.
+        ao_concluir_cenario (function, optional): Chamada com (nome do cenário, resultado) assim que cada
+                                                  cenário termina, na ordem de conclusão.
+
     Returns:
         dict: Resultados por cenário, incluindo solução, diagnóstico e métricas.
     """
-    def run_solver(pedidos, frota, matriz_distancias, depot_index, ajuste_capacidade_pct):
-        start_time = time.time()
-        resultado = {
-            'pedidos_result': None,
-            'diagnostico': None,
-            'metricas': None
-        }
-        if pedidos is None or pedidos.empty or frota is None or frota.empty or matriz_distancias is None:
-            resultado['diagnostico'] = 'Dados de entrada ausentes ou vazios.'
-            return resultado
-
-        num_vehicles = len(frota)
-        num_nodes = len(matriz_distancias)
-        if num_nodes < 2 or num_vehicles < 1:
-            resultado['diagnostico'] = 'Frota ou matriz de distâncias insuficiente.'
-            return resultado
-
-        demanda_total = pedidos['Peso dos Itens'].fillna(0).sum()
-        ajuste = max(0, min(ajuste_capacidade_pct, 120)) / 100.0
-        capacidade_total = (frota['Capacidade (Kg)'].fillna(0).astype(float) * ajuste).sum()
-        if capacidade_total < demanda_total:
-            resultado['diagnostico'] = f"Demanda total ({demanda_total}) excede capacidade total da frota ({capacidade_total})."
-            return resultado
-
-        manager = pywrapcp.RoutingIndexManager(num_nodes, num_vehicles, depot_index)
-        routing = pywrapcp.RoutingModel(manager)
-
-        def distance_callback(from_index, to_index):
-            from_node = manager.IndexToNode(from_index)
-            to_node = manager.IndexToNode(to_index)
-            return int(matriz_distancias[from_node][to_node])
-
-        transit_callback_index = routing.RegisterTransitCallback(distance_callback)
-        routing.SetArcCostEvaluatorOfAllVehicles(transit_callback_index)
-
-        demands = [0] + pedidos['Peso dos Itens'].fillna(0).astype(int).tolist()
-        def demand_callback(from_index):
-            from_node = manager.IndexToNode(from_index)
-            return demands[from_node]
-        demand_callback_index = routing.RegisterUnaryTransitCallback(demand_callback)
-
-        capacities = (frota['Capacidade (Kg)'].fillna(0).astype(float) * ajuste).astype(int).tolist()
-        routing.AddDimensionWithVehicleCapacity(
-            demand_callback_index,
-            0,
-            capacities,
-            True,
-            'Capacity')
-
-        search_parameters = pywrapcp.DefaultRoutingSearchParameters()
-        search_parameters.first_solution_strategy = (
-            routing_enums_pb2.FirstSolutionStrategy.PATH_CHEAPEST_ARC)
-        search_parameters.time_limit.seconds = 60
-
-        solution = routing.SolveWithParameters(search_parameters)
-
-        pedidos_result = pedidos.copy()
-        pedidos_result['Veículo'] = None
-        pedidos_result['Sequencia'] = None
-        pedidos_result['Node_Index_OR'] = None
-        pedidos_result['distancia'] = None
-        total_dist = 0
-        veiculos_usados = 0
-        pedidos_atendidos = set()
-
-        if solution:
-            for vehicle_id in range(num_vehicles):
-                index = routing.Start(vehicle_id)
-                seq = 1
-                placa = frota.iloc[vehicle_id]['Placa'] if 'Placa' in frota.columns and vehicle_id < len(frota) else str(vehicle_id)
-                route_dist = 0
-                used = False
-                while not routing.IsEnd(index):
-                    node_index = manager.IndexToNode(index)
-                    if node_index != depot_index and node_index-1 < len(pedidos):
-                        pedidos_result.at[node_index-1, 'Veículo'] = placa
-                        pedidos_result.at[node_index-1, 'Sequencia'] = seq
-                        pedidos_result.at[node_index-1, 'Node_Index_OR'] = node_index
-                        next_index = solution.Value(routing.NextVar(index))
-                        dist = matriz_distancias[node_index][manager.IndexToNode(next_index)]
-                        pedidos_result.at[node_index-1, 'distancia'] = dist
-                        route_dist += dist
-                        seq += 1
-                        pedidos_atendidos.add(node_index-1)
-                        used = True
-                    index = solution.Value(routing.NextVar(index))
-                if used:
-                    veiculos_usados += 1
-                    total_dist += route_dist
-            pedidos_result['Pedido_Index_DF'] = pedidos_result.index
-            resultado['pedidos_result'] = pedidos_result
-            if metricas:
-                resultado['metricas'] = {
-                    'distancia_total': total_dist,
-                    'veiculos_usados': veiculos_usados,
-                    'pedidos_atendidos': len(pedidos_atendidos),
-                    'pedidos_nao_atendidos': int(len(pedidos) - len(pedidos_atendidos)),
-                    'tempo_execucao_s': round(time.time() - start_time, 3)
-                }
-        else:
-            resultado['diagnostico'] = 'Não foi encontrada solução viável para o cenário.'
-            if diagnostico:
-                resultado['diagnostico'] += f' Demanda total: {demanda_total}, Capacidade total: {capacidade_total}, Veículos: {num_vehicles}'
-        return resultado
-
+    if not cenarios:
+        cenarios = [{}]
+    parametros = [{
+        'pedidos': cenario.get('pedidos', pedidos),
+        'frota': cenario.get('frota', frota),
+        'matriz_distancias': cenario.get('matriz_distancias', matriz_distancias),
+        'depot_index': cenario.get('depot_index', depot_index),
+        'ajuste_capacidade_pct': cenario.get('ajuste_capacidade_pct', ajuste_capacidade_pct)
+    } for cenario in cenarios]
+    nomes = [f'Cenário_{i+1}' for i in range(len(parametros))]
     resultados = {}
-    if cenarios:
-        for i, cenario in enumerate(cenarios):
-            params = {
-                'pedidos': cenario.get('pedidos', pedidos),
-                'frota': cenario.get('frota', frota),
-                'matriz_distancias': cenario.get('matriz_distancias', matriz_distancias),
-                'depot_index': cenario.get('depot_index', depot_index),
-                'ajuste_capacidade_pct': cenario.get('ajuste_capacidade_pct', ajuste_capacidade_pct)
-            }
-            resultados[f'Cenário_{i+1}'] = run_solver(**params)
-    else:
-        resultados['Cenário_1'] = run_solver(pedidos, frota, matriz_distancias, depot_index, ajuste_capacidade_pct)
-    return resultados
+
+    def _concluir(nome, resultado):
+        resultados[nome] = resultado
+        if ao_concluir_cenario:
+            ao_concluir_cenario(nome, resultado)
+
+    num_processos = _num_processos(len(parametros), max_processos)
+    if num_processos == 1:
+        for nome, params in zip(nomes, parametros):
+            _concluir(nome, run_solver(**params, diagnostico=diagnostico, metricas=metricas))
+        return resultados
+
+    pasta = tempfile.mkdtemp(prefix="cvrp_flex_")
+    try:
+        arquivos = _compartilhar_matrizes(parametros, pasta)
+        logging.info(f"CVRP Flex: {len(parametros)} cenários em {num_processos} processos.")
+        # spawn: o app (Streamlit/FastAPI) tem várias threads, e fork com threads ativas pode travar o processo filho
+        with ProcessPoolExecutor(max_workers=num_processos, mp_context=multiprocessing.get_context("spawn")) as executor:
+            futures = {}
+            for nome, params in zip(nomes, parametros):
+                if params['matriz_distancias'] is None:
+                    _concluir(nome, run_solver(**params, diagnostico=diagnostico, metricas=metricas))
+                    continue
+                future = executor.submit(_run_solver_processo, params['pedidos'], params['frota'], arquivos[id(params['matriz_distancias'])],
+                                         params['depot_index'], params['ajuste_capacidade_pct'], diagnostico, metricas)
+                futures[future] = nome
+            for future in as_completed(futures):
+                nome = futures[future]
+                try:
+                    resultado = future.result()
+                except Exception as e:
+                    logging.error(f"CVRP Flex: falha ao resolver o {nome} em processo separado: {e}")
+                    resultado = {'pedidos_result': None, 'diagnostico': f'Erro ao resolver o cenário: {e}', 'metricas': None}
+                _concluir(nome, resultado)
+    finally:
+        shutil.rmtree(pasta, ignore_errors=True)
+    # Mesma ordem dos cenários de entrada
+    return {nome: resultados[nome] for nome in nomes}
@@ -3,6 +3,7 @@ Pré-processamento e clusterização de pedidos para roteirização.
 """
 
 from sklearn.cluster import KMeans
+import numpy as np
 import pandas as pd # Adicionar import
 
 def agrupar_por_regiao(pedidos_df, n_clusters=300):
@@ -39,3 +40,57 @@ def clusterizar_geograficamente(pedidos_df, n_clusters=None):
     pedidos_df.loc[coords.index, 'regiao'] = kmeans.fit_predict(coords)
 
     return pedidos_df
+
+def _coordenadas_planas(pedidos_df):
+    """Coordenadas (n x 2) com a longitude escalada pelo cosseno da latitude média, para o KMeans medir distâncias comparáveis."""
+    colunas = ['Latitude', 'Longitude'] if 'Latitude' in pedidos_df.columns else ['latitude', 'longitude']
+    if colunas[0] not in pedidos_df.columns or colunas[1] not in pedidos_df.columns:
+        raise ValueError("DataFrame deve conter colunas 'Latitude' e 'Longitude' para clusterização.")
+    coords = np.array(pedidos_df[colunas].apply(pd.to_numeric, errors='coerce'), dtype=float)
+    if np.isnan(coords).any():
+        raise ValueError("Existem pedidos sem coordenadas válidas para clusterização.")
+    coords[:, 1] *= np.cos(np.radians(coords[:, 0].mean()))
+    return coords
+
+def clusterizar_por_capacidade(pedidos_df, n_clusters, demandas=None, folga=0.1):
+    """
+    Clusterização geográfica com limite de demanda por cluster.
+
+    O KMeans define os centros; depois cada pedido vai para o centro mais próximo que ainda
+    comporta a sua demanda (limite = demanda média por cluster x (1 + folga)). Os pedidos com
+    maior diferença entre o centro mais próximo e o segundo mais próximo escolhem primeiro,
+    então quem sobra para um centro mais distante são os pedidos de fronteira.
+
+    Args:
+        pedidos_df (pd.DataFrame): Pedidos com 'Latitude' e 'Longitude' (ou 'latitude' e 'longitude').
+        n_clusters (int): Número de clusters.
+        demandas (array-like, optional): Demanda de cada pedido. Padrão: 1 por pedido.
+        folga (float): Quanto cada cluster pode passar da demanda média (0.1 = 10%).
+
+    Returns:
+        tuple: (rótulos np.ndarray com o cluster de cada pedido, centros np.ndarray n_clusters x 2 nas coordenadas escaladas)
+    """
+    coords = _coordenadas_planas(pedidos_df)
+    n_clusters = max(1, min(int(n_clusters), len(coords)))
+    demandas = np.ones(len(coords)) if demandas is None else np.asarray(demandas, dtype=float)
+
+    kmeans = KMeans(n_clusters=n_clusters, random_state=42, n_init=10)
+    kmeans.fit(coords)
+    centros = kmeans.cluster_centers_
+    if n_clusters == 1:
+        return np.zeros(len(coords), dtype=int), centros
+
+    distancias = np.linalg.norm(coords[:, None, :] - centros[None, :, :], axis=2)
+    preferencias = np.argsort(distancias, axis=1)
+    ordenadas = np.take_along_axis(distancias, preferencias, axis=1)
+    ordem = np.argsort(-(ordenadas[:, 1] - ordenadas[:, 0]), kind='stable')
+
+    limite = demandas.sum() / n_clusters * (1 + folga)
+    carga = np.zeros(n_clusters)
+    rotulos = np.empty(len(coords), dtype=int)
+    for i in ordem:
+        # Pedido maior que o limite de qualquer cluster com espaço fica no centro mais próximo
+        destino = next((c for c in preferencias[i] if carga[c] + demandas[i] <= limite), preferencias[i][0])
+        rotulos[i] = destino
+        carga[destino] += demandas[i]
+    return rotulos, centros
@@ -0,0 +1,318 @@
+"""
+Roteirização por decomposição ("cluster first, route second") para dias com muitos pedidos.
+
+Em vez de um único modelo OR-Tools com todos os pedidos (que com 3.000+ paradas não converge
+dentro do limite de tempo), os pedidos são divididos em regiões geográficas com demanda
+equilibrada (routing/dados.py::clusterizar_por_capacidade), cada região recebe um subconjunto
+da frota proporcional à sua demanda e cada sub-CVRP é resolvido independentemente, em paralelo
+num ProcessPoolExecutor (como os cenários do CVRP Flex). No final, um reparo de fronteira
+opcional move paradas entre rotas de regiões vizinhas quando isso encurta o total.
+"""
+import os
+import math
+import logging
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
+import pandas as pd
+from sklearn.neighbors import NearestNeighbors
+
+from routing.cvrp import solver_cvrp
+from routing.cvrp_flex import _num_processos
+from routing.dados import clusterizar_por_capacidade, _coordenadas_planas
+from routing.distancias import MatrizEsparsa
+from routing.ortools_comum import dimensoes_capacidade
+
+# --- Constantes ---
+# Acima deste número de pedidos, a roteirização CVRP usa a decomposição por padrão
+LIMITE_DECOMPOSICAO = int(os.environ.get("WAZELOG_LIMITE_DECOMPOSICAO", "1500"))
+PEDIDOS_POR_CLUSTER = 400 # Tamanho alvo de cada sub-CVRP
+FOLGA_CLUSTER = 0.1 # Quanto a demanda de um cluster pode passar da média
+K_VIZINHOS_FRONTEIRA = 5 # Vizinhos geográficos usados para detectar paradas de fronteira
+MAX_PASSADAS_REPARO = 3
+DEPOT_INDEX = 0 # Como em solver_cvrp: depósito no índice 0 e o pedido i no nó i + 1
+
+
+def _matrizes_capacidade(pedidos, frota):
+    """
+    Dimensões de capacidade de solver_cvrp (ortools_comum.dimensoes_capacidade) como arrays:
+    (nomes, demandas dimensões x nós com o depósito no nó 0, capacidades dimensões x veículos).
+    """
+    dimensoes = dimensoes_capacidade(pedidos, frota)
+    nomes = [nome for nome, _, _ in dimensoes]
+    demandas = np.array([demandas for _, demandas, _ in dimensoes], dtype=np.int64)
+    capacidades = np.array([capacidades for _, _, capacidades in dimensoes], dtype=np.int64)
+    return nomes, demandas, capacidades
+
+def _identificadores(frota):
+    """Identificador de cada veículo como aparece na coluna 'Veículo' das rotas de solver_cvrp."""
+    if 'ID Veículo' in frota.columns:
+        return frota['ID Veículo'].tolist()
+    if 'Placa' in frota.columns:
+        return frota['Placa'].tolist()
+    return [f'veiculo_{i+1}' for i in range(len(frota))]
+
+def _submatriz(matriz_distancias, nos):
+    """Submatriz densa nos x nos (depósito + pedidos de um cluster)."""
+    if isinstance(matriz_distancias, MatrizEsparsa):
+        return matriz_distancias.submatriz(nos)
+    return np.ascontiguousarray(np.asarray(matriz_distancias)[np.ix_(nos, nos)])
+
+def _custos(matriz_distancias, origens, destinos):
+    """Custos dos arcos (origens[i], destinos[i]) como int64."""
+    if isinstance(matriz_distancias, MatrizEsparsa):
+        return matriz_distancias.pares(origens, destinos).astype(np.int64)
+    return np.asarray(matriz_distancias)[np.asarray(origens), np.asarray(destinos)].astype(np.int64)
+
+def _distribuir_veiculos(demandas_cluster, capacidades):
+    """
+    Índices dos veículos de cada cluster: do maior para o menor, cada veículo vai para o cluster
+    com mais demanda ainda descoberta (os veículos que sobram reforçam os clusters mais justos).
+    """
+    descoberta = np.asarray(demandas_cluster, dtype=float).copy()
+    veiculos = [[] for _ in range(len(descoberta))]
+    for v in np.argsort(-capacidades, kind='stable'):
+        cluster = int(np.argmax(descoberta))
+        veiculos[cluster].append(int(v))
+        descoberta[cluster] -= capacidades[v]
+    return veiculos
+
+
+def _resolver_clusters(tarefas, max_processos=None, ao_concluir=None):
+    """
+    Resolve cada tarefa (pedidos, frota, submatriz) com solver_cvrp, em processos separados se
+    houver mais de um núcleo disponível. Retorna a lista de DataFrames na ordem das tarefas.
+    """
+    resultados = [None] * len(tarefas)
+    concluidos = 0
+
+    def _concluir(i, rotas):
+        nonlocal concluidos
+        resultados[i] = rotas if rotas is not None else pd.DataFrame()
+        concluidos += 1
+        if ao_concluir:
+            ao_concluir(concluidos, len(tarefas))
+
+    num_processos = _num_processos(len(tarefas), max_processos)
+    if num_processos == 1:
+        for i, tarefa in enumerate(tarefas):
+            _concluir(i, solver_cvrp(*tarefa))
+        return resultados
+
+    logging.info(f"Decomposição: {len(tarefas)} clusters em {num_processos} processos.")
+    # spawn: o app (Streamlit/FastAPI) tem várias threads, e fork com threads ativas pode travar o processo filho
+    with ProcessPoolExecutor(max_workers=num_processos, mp_context=multiprocessing.get_context("spawn")) as executor:
+        futures = {executor.submit(solver_cvrp, *tarefa): i for i, tarefa in enumerate(tarefas)}
+        for future in as_completed(futures):
+            i = futures[future]
+            try:
+                rotas = future.result()
+            except Exception as e:
+                logging.error(f"Decomposição: falha ao resolver o cluster {i} em processo separado: {e}")
+                rotas = None
+            _concluir(i, rotas)
+    return resultados
+
+def _mapear_rotas(rotas, indices_pedidos, cluster, tem_id_pedido):
+    """Converte os índices locais de um sub-CVRP (nó e pedido) para os do problema completo."""
+    rotas = rotas.copy()
+    nos = np.concatenate([[DEPOT_INDEX], indices_pedidos + 1])
+    rotas['Node_Index_OR'] = nos[rotas['Node_Index_OR'].astype(int).to_numpy()]
+    rotas['Pedido_Index_DF'] = indices_pedidos[rotas['Pedido_Index_DF'].astype(int).to_numpy()]
+    if not tem_id_pedido:
+        rotas['ID Pedido'] = [f'Pedido_{i}' for i in rotas['Pedido_Index_DF']]
+    rotas['Cluster'] = cluster
+    return rotas
+
+
+def reparar_fronteiras(rotas_df, pedidos, frota, matriz_distancias, k_vizinhos=K_VIZINHOS_FRONTEIRA, max_passadas=MAX_PASSADAS_REPARO):
+    """
+    Reparo de fronteira entre clusters: move uma parada para a rota de um cluster vizinho quando
+    a inserção mais barata nessa rota custa menos do que a remoção economiza na rota atual.
+
+    Só são testadas as paradas de fronteira (com algum dos `k_vizinhos` pedidos geograficamente mais
+    próximos atendido por outro cluster) e as rotas desses vizinhos, respeitando todas as dimensões de
+    capacidade de solver_cvrp (peso e, quando pedidos e frota têm as duas colunas, caixas).
+
+    Args:
+        rotas_df (pd.DataFrame): Rotas de solver_cvrp_decomposto (com 'Cluster', 'Demanda', 'Node_Index_OR').
+        pedidos (pd.DataFrame): Pedidos (índice 0..n-1, mesma ordem da matriz).
+        frota (pd.DataFrame): Frota usada na roteirização.
+        matriz_distancias (array-like): Matriz completa (ndarray, memmap ou MatrizEsparsa).
+        k_vizinhos (int): Vizinhos geográficos de cada parada considerados.
+        max_passadas (int): Máximo de passadas pelas paradas de fronteira.
+
+    Returns:
+        tuple: (rotas_df reparado, número de paradas movidas)
+    """
+    if rotas_df is None or rotas_df.empty or rotas_df['Cluster'].nunique() < 2:
+        return rotas_df, 0
+
+    # Peso e, se cadastradas, caixas: um movimento só vale se couber em todas as dimensões do veículo de destino
+    nomes, demanda, capacidades = _matrizes_capacidade(pedidos, frota)
+    capacidade = {}
+    for v, identificador in enumerate(_identificadores(frota)):
+        capacidade.setdefault(identificador, capacidades[:, v])
+    sem_capacidade = np.zeros(len(nomes), dtype=np.int64)
+    rotas_df = rotas_df.sort_values(['Veículo', 'Sequencia'])
+    rotas = {veiculo: grupo['Node_Index_OR'].astype(int).tolist() for veiculo, grupo in rotas_df.groupby('Veículo', sort=False)}
+    cluster_veiculo = rotas_df.groupby('Veículo', sort=False)['Cluster'].first().to_dict()
+    carga = {veiculo: demanda[:, nos].sum(axis=1) for veiculo, nos in rotas.items()}
+    veiculo_do_no = {no: veiculo for veiculo, nos in rotas.items() for no in nos}
+
+    # Vizinhos geográficos de cada parada (em nós da matriz)
+    coords = _coordenadas_planas(pedidos)
+    vizinhanca = NearestNeighbors(n_neighbors=min(k_vizinhos + 1, len(coords))).fit(coords)
+    _, vizinhos = vizinhanca.kneighbors(coords)
+    vizinhos = vizinhos[:, 1:] + 1
+
+    movimentos = 0
+    for _ in range(max_passadas):
+        movimentos_passada = 0
+        for no in list(veiculo_do_no):
+            veiculo = veiculo_do_no[no]
+            candidatos = {veiculo_do_no.get(int(v)) for v in vizinhos[no - 1]} - {None}
+            candidatos = [c for c in candidatos if cluster_veiculo[c] != cluster_veiculo[veiculo]
+                          and (carga[c] + demanda[:, no] <= capacidade.get(c, sem_capacidade)).all()]
+            if not candidatos:
+                continue
+            rota = rotas[veiculo]
+            pos = rota.index(no)
+            anterior = rota[pos - 1] if pos > 0 else DEPOT_INDEX
+            proximo = rota[pos + 1] if pos + 1 < len(rota) else DEPOT_INDEX
+            ganho = _custos(matriz_distancias, [anterior, no, anterior], [no, proximo, proximo])
+            ganho = ganho[0] + ganho[1] - ganho[2]
+
+            melhor = None
+            for candidato in candidatos:
+                nos = [DEPOT_INDEX] + rotas[candidato] + [DEPOT_INDEX]
+                de, para = np.array(nos[:-1]), np.array(nos[1:])
+                custo = (_custos(matriz_distancias, de, np.full(len(de), no)) + _custos(matriz_distancias, np.full(len(para), no), para)
+                         - _custos(matriz_distancias, de, para))
+                posicao = int(np.argmin(custo))
+                if custo[posicao] < ganho and (melhor is None or custo[posicao] < melhor[0]):
+                    melhor = (custo[posicao], candidato, posicao)
+            if melhor is None:
+                continue
+
+            _, destino, posicao = melhor
+            rota.pop(pos)
+            rotas[destino].insert(posicao, no)
+            carga[veiculo] = carga[veiculo] - demanda[:, no]
+            carga[destino] = carga[destino] + demanda[:, no]
+            veiculo_do_no[no] = destino
+            movimentos_passada += 1
+        movimentos += movimentos_passada
+        if movimentos_passada == 0:
+            break
+
+    if movimentos == 0:
+        return rotas_df.reset_index(drop=True), 0
+
+    # Remonta sequência, demanda e carga acumulada de cada dimensão (na chegada, como no OR-Tools) e cluster de cada parada
+    linhas = rotas_df.set_index(rotas_df['Node_Index_OR'].astype(int))
+    partes = []
+    for veiculo, nos in rotas.items():
+        if not nos:
+            continue
+        parte = linhas.loc[nos].copy()
+        parte['Veículo'] = veiculo
+        parte['Sequencia'] = np.arange(1, len(nos) + 1)
+        for k, nome in enumerate(nomes):
+            sufixo = nome.replace('Capacity', '') # 'Capacity' -> '', 'Capacity_Cx' -> '_Cx'
+            demandas_rota = demanda[k, nos]
+            parte['Demanda' + sufixo] = demandas_rota
+            parte['Carga_Acumulada' + sufixo] = np.cumsum(demandas_rota) - demandas_rota
+        parte['Cluster'] = cluster_veiculo[veiculo]
+        partes.append(parte)
+    return pd.concat(partes).reset_index(drop=True), movimentos
+
+
+def solver_cvrp_decomposto(pedidos, frota, matriz_distancias, pedidos_por_cluster=PEDIDOS_POR_CLUSTER, reparo_fronteiras=True,
+                           max_processos=None, ao_concluir_cluster=None):
+    """
+    CVRP por decomposição: clusters geográficos com demanda equilibrada, um subconjunto da frota
+    por cluster e um solver_cvrp independente por cluster, em paralelo.
+
+    Pedidos de clusters sem solução (ex.: frota do cluster justa demais) são resolvidos de novo,
+    juntos, com os veículos desses clusters e os que ficaram sem rota nos demais.
+
+    Args:
+        pedidos (pd.DataFrame): Pedidos (o pedido i corresponde ao nó i + 1 da matriz).
+        frota (pd.DataFrame): Veículos, com 'Capacidade (Kg)' e/ou 'Capacidade (Cx)'.
+        matriz_distancias (array-like): Matriz completa com o depósito no índice 0 (ndarray, memmap ou MatrizEsparsa).
+        pedidos_por_cluster (int): Tamanho alvo de cada sub-CVRP.
+        reparo_fronteiras (bool): Se True, aplica `reparar_fronteiras` no final.
+        max_processos (int, optional): Máximo de processos. Padrão: núcleos disponíveis (ou WAZELOG_MAX_PROCESSOS).
+        ao_concluir_cluster (function, optional): Chamada com (clusters concluídos, total) a cada cluster resolvido.
+
+    Returns:
+        pd.DataFrame: Rotas no formato de solver_cvrp, com a coluna extra 'Cluster'. Vazio se não houver solução.
+    """
+    if pedidos.empty or frota.empty:
+        logging.warning("Decomposição: pedidos ou frota vazios.")
+        return pd.DataFrame()
+    if matriz_distancias is None or len(matriz_distancias) != len(pedidos) + 1:
+        logging.error("Decomposição: matriz de distâncias ausente ou com tamanho diferente de pedidos + depósito.")
+        return pd.DataFrame()
+
+    pedidos = pedidos.reset_index(drop=True)
+    frota = frota.reset_index(drop=True)
+    if 'ID Veículo' not in frota.columns and 'Placa' not in frota.columns:
+        # Sem identificador, solver_cvrp numeraria os veículos de cada cluster a partir de 1
+        frota = frota.assign(**{'ID Veículo': _identificadores(frota)})
+    # Clusters e divisão da frota pela primeira dimensão (peso; caixas sem peso cadastrado)
+    _, demandas, capacidades = _matrizes_capacidade(pedidos, frota)
+    demandas, capacidades = demandas[0, 1:], capacidades[0]
+
+    n_clusters = min(math.ceil(len(pedidos) / max(1, pedidos_por_cluster)), len(frota))
+    if n_clusters <= 1:
+        logging.info("Decomposição: um único cluster, resolvendo o problema inteiro.")
+        rotas = solver_cvrp(pedidos, frota, matriz_distancias)
+        return rotas.assign(Cluster=0) if rotas is not None and not rotas.empty else pd.DataFrame()
+
+    rotulos, _ = clusterizar_por_capacidade(pedidos, n_clusters, demandas, folga=FOLGA_CLUSTER)
+    indices_cluster = [np.flatnonzero(rotulos == c) for c in range(n_clusters)]
+    veiculos_cluster = _distribuir_veiculos([demandas[idx].sum() for idx in indices_cluster], capacidades)
+    logging.info(f"Decomposição: {len(pedidos)} pedidos em {n_clusters} clusters "
+                 f"({', '.join(f'{len(idx)}p/{len(v)}v' for idx, v in zip(indices_cluster, veiculos_cluster))}).")
+
+    def _tarefa(idx, veiculos):
+        nos = np.concatenate([[DEPOT_INDEX], idx + 1])
+        return pedidos.iloc[idx], frota.iloc[veiculos], _submatriz(matriz_distancias, nos)
+
+    tarefas = [_tarefa(idx, veiculos) for idx, veiculos in zip(indices_cluster, veiculos_cluster)]
+    resultados = _resolver_clusters(tarefas, max_processos, ao_concluir_cluster)
+
+    tem_id_pedido = 'ID Pedido' in pedidos.columns
+    partes, sem_solucao = [], []
+    for c, rotas in enumerate(resultados):
+        if rotas.empty:
+            sem_solucao.append(c)
+        else:
+            partes.append(_mapear_rotas(rotas, indices_cluster[c], c, tem_id_pedido))
+
+    if sem_solucao:
+        # Nova tentativa com os pedidos sem solução e todos os veículos sem rota
+        usados = set(pd.concat(partes)['Veículo']) if partes else set()
+        veiculos_livres = [v for v, ident in enumerate(_identificadores(frota)) if ident not in usados]
+        idx = np.sort(np.concatenate([indices_cluster[c] for c in sem_solucao]))
+        logging.warning(f"Decomposição: {len(sem_solucao)} cluster(s) sem solução; tentando {len(idx)} pedidos "
+                        f"com {len(veiculos_livres)} veículos livres.")
+        rotas = solver_cvrp(*_tarefa(idx, veiculos_livres)) if veiculos_livres else pd.DataFrame()
+        if rotas is not None and not rotas.empty:
+            partes.append(_mapear_rotas(rotas, idx, n_clusters, tem_id_pedido))
+        else:
+            logging.warning(f"Decomposição: {len(idx)} pedidos ficaram sem rota.")
+
+    if not partes:
+        logging.warning("Decomposição: nenhum cluster teve solução.")
+        return pd.DataFrame()
+    rotas_df = pd.concat(partes, ignore_index=True)
+
+    if reparo_fronteiras:
+        rotas_df, movimentos = reparar_fronteiras(rotas_df, pedidos, frota, matriz_distancias)
+        logging.info(f"Decomposição: reparo de fronteira moveu {movimentos} parada(s).")
+    logging.info(f"Decomposição: {len(rotas_df)} de {len(pedidos)} pedidos roteirizados em {rotas_df['Veículo'].nunique()} veículos.")
+    return rotas_df
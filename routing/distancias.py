@@ -8,25 +8,83 @@ import logging
 import json
 import traceback # Adicionado para log de erro completo
 import os # Adicionado para ler variáveis de ambiente
+import threading
+import sqlite3
+import math
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from sklearn.neighbors import BallTree
+from routing.osrm_client import osrm_get, OSRM_SERVER_URL, MAX_CONEXOES_POR_HOST, CircuitoAbertoError, espera_retentativa
 
 # --- Constantes ---
-# Use a variável de ambiente OSRM_BASE_URL se definida, senão usa localhost:5000
-OSRM_SERVER_URL = os.environ.get("OSRM_BASE_URL", "http://localhost:5000")
+# OSRM_SERVER_URL (variável de ambiente OSRM_BASE_URL) e a sessão HTTP ficam em routing/osrm_client.py
 MAX_RETRIES = 3
-# --- AJUSTE AQUI ---
-RETRY_DELAY = 15 # Segundos entre retentativas
+# Espera entre retentativas: exponencial com jitter (ver osrm_client.espera_retentativa)
 DEFAULT_TIMEOUT = 180 # Timeout para cada requisição OSRM em segundos
+# Prazo total de um bloco, somando todas as tentativas e esperas
+PRAZO_POR_BLOCO = float(os.environ.get("OSRM_PRAZO_BLOCO", "240"))
+# Máximo de requisições Table em andamento ao mesmo tempo (ajustar conforme a capacidade do servidor OSRM)
+MAX_CONCURRENT_REQUESTS = MAX_CONEXOES_POR_HOST # Variável de ambiente OSRM_MAX_CONCURRENT
 # -------------------
+# Limite de coordenadas da Table API (osrm-routed --max-table-size). Se não definido, é detectado no servidor.
+OSRM_MAX_TABLE_SIZE = int(os.environ["OSRM_MAX_TABLE_SIZE"]) if os.environ.get("OSRM_MAX_TABLE_SIZE") else None
+DEFAULT_MAX_TABLE_SIZE = 100 # Padrão do osrm-routed, usado se a detecção falhar
+TABLE_SIZE_CANDIDATES = (1000, 500, 250, 100, 50, 25) # Tamanhos testados na detecção (do maior para o menor)
+MAX_URL_LENGTH = int(os.environ.get("OSRM_MAX_URL_LENGTH", "8192")) # Tamanho máximo da URL de cada requisição
+URL_CHARS_PER_COORD = 26 # Estimativa: "-46.123456,-23.123456;" + índice em sources/destinations
+# Cache persistente de pares (origem, destino) já consultados no OSRM
+CACHE_DB_PATH = os.environ.get("OSRM_CACHE_PATH", os.path.join(os.path.dirname(__file__), '..', 'database', 'cache_distancias.db'))
+CACHE_MAX_PARES = int(os.environ.get("OSRM_CACHE_MAX_PARES", "5000000")) # Acima disso, descarta os pontos menos usados
+CACHE_PRECISAO = 5 # Casas decimais usadas na chave das coordenadas (~1 m)
+# Manifesto da matriz da base de clientes, gerada fora do horário de pico por routing/pre_calculo.py
+PRE_CALCULO_PATH = os.environ.get("OSRM_MATRIZ_CLIENTES", os.path.join(os.path.dirname(__file__), '..', 'database', 'matriz_clientes.json'))
+OSRM_PROFILE = "driving"
+PROVIDERS = ("osrm", "haversine")
 INFINITE_VALUE = 9999999 # Valor para representar "infinito" ou falha
+# int32 comporta INFINITE_VALUE e metade da memória de int64 (5.000 pontos: ~100 MB por matriz)
+MATRIX_DTYPE = np.int32
+# Estimativa pela distância em linha reta (provider="haversine"), calibrada com pares reais do cache
+EARTH_RADIUS_M = 6371000
+DEFAULT_FATOR_CIRCUITO = 1.3 # Distância pelas ruas / distância em linha reta
+DEFAULT_VELOCIDADE_KMH = 40 # Mesma velocidade média usada em routing/simulador.py
+MIN_AMOSTRAS_CALIBRACAO = 30
+MAX_AMOSTRAS_ASSIMETRIA = 20000 # Pares completos (ida e volta) usados para aprender o fator do modo simétrico
+# Modo esparso: acima de LIMITE_MATRIZ_DENSA pontos, só os arcos entre vizinhos próximos vão ao OSRM
+DEFAULT_K_VIZINHOS = 20
+LIMITE_MATRIZ_DENSA = 3000
 
 # Configuração do logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
+
+class TabelaGrandeDemaisError(Exception):
+    """O servidor OSRM recusou a tabela por exceder o seu --max-table-size (code 'TooBig')."""
+
 # --- AJUSTE AQUI: Adicionar extra_params=None ---
-def _get_osrm_table_batch(url_base, coords_str, metrica, timeout=DEFAULT_TIMEOUT, extra_params=None):
-    """Faz a requisição OSRM Table API para um lote, com retentativas."""
+def _get_osrm_table_batch(url_base, coords_str, metricas, timeout=DEFAULT_TIMEOUT, extra_params=None, prazo=PRAZO_POR_BLOCO):
+    """
+    Faz a requisição OSRM Table API para um lote, com retentativas.
+    `metricas` é uma tupla de métricas ("duration", "distance") pedidas na mesma resposta;
+    retorna um dict {metrica: submatriz} ou None em caso de falha. Uma recusa 'TooBig' não é
+    falha do servidor: levanta TabelaGrandeDemaisError para o bloco ser dividido.
+
+    Entre tentativas espera um tempo exponencial com jitter, e todas as tentativas
+    dividem o mesmo `prazo` (segundos): o timeout de cada uma é limitado ao que resta
+    dele. Com o circuito do servidor aberto, desiste na hora, sem retentar.
+    """
+    limite_prazo = time.monotonic() + prazo
+
+    def _aguardar(attempt):
+        """Espera a próxima tentativa; retorna False se ela não caberia mais no prazo."""
+        espera = espera_retentativa(attempt)
+        if time.monotonic() + espera >= limite_prazo:
+            logging.error(f"Prazo de {prazo:.0f}s do bloco esgotado após {attempt} tentativa(s).")
+            return False
+        logging.info(f"Tentando novamente em {espera:.1f}s...")
+        time.sleep(espera)
+        return True
+
     # --- AJUSTE AQUI: Mesclar parâmetros ---
-    params = {"annotations": metrica}
+    params = {"annotations": ",".join(metricas)}
     if extra_params:
         params.update(extra_params)
     # --------------------------------------
@@ -35,33 +93,42 @@ def _get_osrm_table_batch(url_base, coords_str, metrica, timeout=DEFAULT_TIMEOUT
 
     for attempt in range(1, MAX_RETRIES + 1):
         response = None # Garante que response esteja definida
+        timeout_tentativa = min(timeout, limite_prazo - time.monotonic())
+        if timeout_tentativa <= 0:
+            break
         try:
             # Log da URL completa apenas na primeira tentativa para reduzir verbosidade
             # --- AJUSTE AQUI: Incluir params no log da URL ---
             params_str = "&".join([f"{k}={v}" for k, v in params.items()])
             log_url = f"{full_url}?{params_str}" if attempt == 1 else f"{url_base}... (params omitidos)"
             # -------------------------------------------------
-            logging.info(f"Consultando OSRM Table API via GET (Batch - Tentativa {attempt}/{MAX_RETRIES}): {log_url} (timeout={timeout}s)")
+            logging.info(f"Consultando OSRM Table API via GET (Batch - Tentativa {attempt}/{MAX_RETRIES}): {log_url} (timeout={timeout_tentativa:.0f}s)")
             # --- AJUSTE AQUI: Passar o dicionário 'params' mesclado ---
-            response = requests.get(full_url, params=params, timeout=timeout)
+            response = osrm_get(full_url, params=params, timeout=timeout_tentativa)
             # ---------------------------------------------------------
             response.raise_for_status() # Levanta exceção para status HTTP 4xx/5xx
             logging.info(f"OSRM Status Code (Batch): {response.status_code}")
             data = response.json()
-            metric_key = f"{metrica}s"
-            if metric_key not in data:
-                logging.error(f"Resposta OSRM não contém a chave esperada '{metric_key}'. Resposta: {data}")
-                return None # Falha, não retenta (erro de formato de resposta)
-            return data[metric_key] # Sucesso! Retorna os dados
+            resultado = {}
+            for metrica in metricas:
+                metric_key = f"{metrica}s"
+                if metric_key not in data:
+                    logging.error(f"Resposta OSRM não contém a chave esperada '{metric_key}'. Resposta: {data}")
+                    return None # Falha, não retenta (erro de formato de resposta)
+                resultado[metrica] = data[metric_key]
+            return resultado # Sucesso! Retorna os dados
+
+        except CircuitoAbertoError as e:
+            logging.warning(f"Requisição OSRM não enviada: {e}")
+            return None # Não adianta retentar enquanto o circuito estiver aberto
 
         except requests.exceptions.Timeout as e:
             last_exception = e
             logging.warning(f"Timeout na requisição OSRM (Tentativa {attempt}/{MAX_RETRIES}): {e}.")
             if attempt == MAX_RETRIES:
                 logging.error(f"Máximo de retentativas ({MAX_RETRIES}) atingido devido a Timeout.")
-            else:
-                logging.info(f"Tentando novamente em {RETRY_DELAY}s...")
-                time.sleep(RETRY_DELAY)
+            elif not _aguardar(attempt):
+                break
 
         except requests.exceptions.RequestException as e:
             last_exception = e
@@ -69,6 +136,12 @@ def _get_osrm_table_batch(url_base, coords_str, metrica, timeout=DEFAULT_TIMEOUT
 
             # Erro 400 (Bad Request) - Não retentar
             if e.response is not None and status_code == 400:
+                 try:
+                     codigo = e.response.json().get("code")
+                 except ValueError:
+                     codigo = None
+                 if codigo == "TooBig":
+                     raise TabelaGrandeDemaisError(f"Tabela recusada pelo OSRM (TooBig): {len(coords_str.split(';'))} coordenadas.") from e
                  logging.error(f"Erro HTTP 400 (Bad Request) do OSRM API. Verifique a string de coordenadas e a URL.")
                  # Usar e.request.url se disponível para a URL exata enviada
                  # --- AJUSTE AQUI: Incluir params no log da URL ---
@@ -94,9 +167,8 @@ def _get_osrm_table_batch(url_base, coords_str, metrica, timeout=DEFAULT_TIMEOUT
                          logging.error(f"Corpo da resposta OSRM (falha final): {error_body}")
                      except json.JSONDecodeError:
                          logging.error(f"Corpo da resposta OSRM (falha final, não JSON): {e.response.text}")
-            else:
-                 logging.info(f"Tentando novamente em {RETRY_DELAY}s...")
-                 time.sleep(RETRY_DELAY)
+            elif not _aguardar(attempt):
+                 break
 
         except json.JSONDecodeError as e:
              last_exception = e
@@ -105,12 +177,11 @@ def _get_osrm_table_batch(url_base, coords_str, metrica, timeout=DEFAULT_TIMEOUT
                  logging.error(f"Texto da resposta inválida: {response.text}")
              if attempt == MAX_RETRIES:
                  logging.error(f"Máximo de retentativas ({MAX_RETRIES}) atingido após erro de JSON.")
-             else:
-                 logging.info(f"Tentando novamente em {RETRY_DELAY}s...")
-                 time.sleep(RETRY_DELAY)
+             elif not _aguardar(attempt):
+                 break
 
     # Se o loop terminar (todas as tentativas falharam), retorna None
-    logging.error(f"Falha ao obter dados do OSRM após {MAX_RETRIES} tentativas. Última exceção: {last_exception}")
+    logging.error(f"Falha ao obter dados do OSRM para o bloco. Última exceção: {last_exception}")
     return None
 
 # --- Funções de Validação Adicionadas ---
@@ -136,139 +207,1462 @@ def _validar_coordenadas(pontos_lote):
 # --- Fim Funções de Validação ---
 
 
-def calcular_matriz_distancias(pontos, provider="osrm", metrica="duration", progress_callback=None):
+_limites_tabela_detectados = {} # Cache do limite detectado por servidor OSRM
+_limites_tabela_lock = threading.Lock()
+
+def _formatar_coordenadas(pontos_lote):
+    """Formata pontos (lat, lon) no padrão do OSRM (lon,lat;lon,lat), com 6 casas decimais para encurtar a URL."""
+    return ";".join([f"{lon:.6f},{lat:.6f}" for lat, lon in pontos_lote])
+
+def _max_coords_por_url():
+    """Número máximo de coordenadas que cabem em uma URL da Table API."""
+    overhead = len(OSRM_SERVER_URL) + 100 # Caminho e demais parâmetros
+    return max(2, (MAX_URL_LENGTH - overhead) // URL_CHARS_PER_COORD)
+
+def detectar_limite_tabela(ponto_referencia=None, timeout=30):
     """
-    Calcula a matriz de distâncias ou tempos usando OSRM Table API em lotes,
-    validando coordenadas antes de cada requisição.
+    Detecta o limite de coordenadas da Table API do servidor OSRM (--max-table-size).
+
+    Envia tabelas de N cópias do mesmo ponto, do maior candidato para o menor: o OSRM
+    recusa com erro 'TooBig' antes de calcular, então só a primeira tabela aceita tem custo.
+    O resultado fica em cache por servidor. A variável de ambiente OSRM_MAX_TABLE_SIZE
+    dispensa a detecção.
+
+    Cada sonda é retentada como os blocos (espera exponencial com jitter). Se uma delas ficar
+    sem resposta conclusiva, o limite real é desconhecido: retorna DEFAULT_MAX_TABLE_SIZE (ou
+    o candidato não testado, se menor) sem guardar em cache, e os blocos que o servidor
+    recusar são divididos durante o cálculo (ver `_consultar_blocos`).
 
     Args:
-        pontos (list): Lista de tuplas (latitude, longitude).
-        provider (str): Provedor de roteamento (atualmente apenas "osrm").
-        metrica (str): "duration" (tempo em segundos) ou "distance" (distância em metros).
-        progress_callback (function, optional): Função para reportar progresso (recebe float 0.0 a 1.0).
+        ponto_referencia (tuple, optional): Ponto (lat, lon) usado na sonda. Padrão: centro de São Paulo.
+        timeout (int): Timeout de cada requisição de sonda em segundos.
 
     Returns:
-        numpy.ndarray or None: Matriz NxN com os valores da métrica, ou None se ocorrer erro crítico.
-                               Retorna INFINITE_VALUE para pares impossíveis de rotear.
+        int: Maior número de coordenadas por tabela aceito pelo servidor.
+    """
+    if OSRM_MAX_TABLE_SIZE:
+        return OSRM_MAX_TABLE_SIZE
+    with _limites_tabela_lock:
+        if OSRM_SERVER_URL in _limites_tabela_detectados:
+            return _limites_tabela_detectados[OSRM_SERVER_URL]
+
+        lat, lon = ponto_referencia if ponto_referencia is not None else (-23.5505, -46.6333)
+        url_base = f"{OSRM_SERVER_URL}/table/v1/driving/"
+        max_coords = _max_coords_por_url()
+        for candidato in TABLE_SIZE_CANDIDATES:
+            if candidato > max_coords:
+                continue # Não cabe na URL, não adianta testar
+            codigo = _sondar_tabela(url_base + _formatar_coordenadas([(lat, lon)] * candidato), timeout)
+            if codigo == "Ok":
+                logging.info(f"Limite da Table API do OSRM detectado: {candidato} coordenadas.")
+                _limites_tabela_detectados[OSRM_SERVER_URL] = candidato
+                return candidato
+            if codigo != "TooBig":
+                # Só os candidatos maiores foram recusados; não guarda em cache: o servidor pode voltar depois
+                limite = min(DEFAULT_MAX_TABLE_SIZE, candidato)
+                logging.warning(f"Sem resposta conclusiva ao detectar o limite da Table API (tabela de {candidato}, code={codigo}). "
+                                f"Usando {limite} provisoriamente; tabelas recusadas serão divididas.")
+                return limite
+
+        limite = min(TABLE_SIZE_CANDIDATES)
+        logging.warning(f"Servidor OSRM recusou todos os tamanhos testados. Usando {limite}.")
+        _limites_tabela_detectados[OSRM_SERVER_URL] = limite
+        return limite
+
+def _sondar_tabela(url, timeout):
+    """
+    Envia uma tabela de sonda, retentando falhas de conexão, timeouts e respostas 5xx.
+
+    Returns:
+        str or None: 'code' da resposta do OSRM ('Ok', 'TooBig', ...), ou None se o servidor não respondeu.
+    """
+    for attempt in range(1, MAX_RETRIES + 1):
+        try:
+            response = osrm_get(url, params={"annotations": "duration"}, timeout=timeout)
+        except CircuitoAbertoError as e:
+            logging.warning(f"Sonda da Table API não enviada: {e}")
+            return None # Não adianta retentar enquanto o circuito estiver aberto
+        except requests.exceptions.RequestException as e:
+            logging.warning(f"Falha na sonda da Table API do OSRM (Tentativa {attempt}/{MAX_RETRIES}): {e}")
+        else:
+            if response.status_code == 200:
+                return "Ok"
+            if response.status_code < 500:
+                try:
+                    return response.json().get("code")
+                except ValueError:
+                    return None
+            logging.warning(f"Sonda da Table API do OSRM com status {response.status_code} (Tentativa {attempt}/{MAX_RETRIES}).")
+        if attempt < MAX_RETRIES:
+            time.sleep(espera_retentativa(attempt))
+    return None
+
+def _reduzir_limite_tabela(limite):
+    """Guarda em cache um limite menor para o servidor, depois de uma tabela recusada; retorna o limite vigente."""
+    with _limites_tabela_lock:
+        atual = _limites_tabela_detectados.get(OSRM_SERVER_URL)
+        if atual is None or limite < atual:
+            _limites_tabela_detectados[OSRM_SERVER_URL] = limite
+            logging.warning(f"Servidor OSRM recusou uma tabela (TooBig): limite da Table API reduzido para {limite} coordenadas.")
+            return limite
+        return atual
+
+def _dimensionar_bloco(num_origens, num_destinos, limite_tabela, max_coords):
+    """
+    Escolhe o tamanho (origens x destinos) dos blocos retangulares de requisição.
+
+    O OSRM aceita tabelas com origens*destinos <= limite_tabela², e a URL comporta no
+    máximo `max_coords` coordenadas (origens + destinos, no pior caso sem sobreposição).
+    """
+    max_celulas = limite_tabela * limite_tabela
+    lado = max(1, min(limite_tabela, max_coords // 2))
+    if num_origens <= lado:
+        tam_origens = num_origens
+        tam_destinos = min(num_destinos, max_celulas // tam_origens, max_coords - tam_origens)
+    elif num_destinos <= lado:
+        tam_destinos = num_destinos
+        tam_origens = min(num_origens, max_celulas // tam_destinos, max_coords - tam_destinos)
+    else:
+        tam_origens = tam_destinos = lado
+    tam_origens, tam_destinos = max(1, tam_origens), max(1, tam_destinos)
+    # Rebalanceia para blocos de tamanho parecido (evita um último bloco com 1 ou 2 pontos)
+    tam_origens = -(-num_origens // -(-num_origens // tam_origens))
+    tam_destinos = -(-num_destinos // -(-num_destinos // tam_destinos))
+    return tam_origens, tam_destinos
+
+def _planejar_blocos(indices_origem, indices_destino, limite_tabela):
+    """
+    Divide origens x destinos em blocos retangulares que respeitam o limite do servidor e da URL.
+
+    Returns:
+        tuple: (lista de pares (origens, destinos) com índices globais, (tamanho_origens, tamanho_destinos))
+    """
+    indices_origem, indices_destino = list(indices_origem), list(indices_destino)
+    if not indices_origem or not indices_destino:
+        return [], (0, 0)
+    tam_origens, tam_destinos = _dimensionar_bloco(len(indices_origem), len(indices_destino), limite_tabela, _max_coords_por_url())
+    blocos = [
+        (indices_origem[i:i + tam_origens], indices_destino[j:j + tam_destinos])
+        for i in range(0, len(indices_origem), tam_origens)
+        for j in range(0, len(indices_destino), tam_destinos)
+    ]
+    return blocos, (tam_origens, tam_destinos)
+
+def _blocos_um_sentido(blocos_indices, pendente):
+    """
+    Modo simétrico: descarta os blocos cujos pares já estão cobertos, em algum dos sentidos,
+    por blocos anteriores. Numa matriz inteira sobram só os blocos da diagonal e os de cima dela.
+    `pendente` (máscara NxN dos pares ainda sem consulta) é atualizada.
+    """
+    selecionados = []
+    for origens, destinos in blocos_indices:
+        ida = np.ix_(origens, destinos)
+        if pendente[ida].any():
+            selecionados.append((origens, destinos))
+            pendente[ida] = False
+            pendente[np.ix_(destinos, origens)] = False
+    return selecionados
+
+
+# --- Cache Persistente de Pares ---
+_cache_conn = None
+_cache_lock = threading.Lock()
+
+def _get_cache_connection():
+    """Abre (uma única vez) a conexão com o banco SQLite do cache de pares e cria as tabelas."""
+    global _cache_conn
+    if _cache_conn is None:
+        os.makedirs(os.path.dirname(os.path.abspath(CACHE_DB_PATH)), exist_ok=True)
+        conn = sqlite3.connect(CACHE_DB_PATH, check_same_thread=False)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        # Pontos identificados pelas coordenadas arredondadas; 'acesso' permite descartar os menos usados
+        conn.execute('''CREATE TABLE IF NOT EXISTS pontos (
+            id INTEGER PRIMARY KEY,
+            lat_q INTEGER NOT NULL,
+            lon_q INTEGER NOT NULL,
+            acesso REAL,
+            UNIQUE (lat_q, lon_q)
+        )''')
+        conn.execute('''CREATE TABLE IF NOT EXISTS pares (
+            perfil TEXT NOT NULL,
+            metrica TEXT NOT NULL,
+            origem INTEGER NOT NULL,
+            destino INTEGER NOT NULL,
+            valor INTEGER NOT NULL,
+            PRIMARY KEY (perfil, metrica, origem, destino)
+        ) WITHOUT ROWID''')
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_pares_destino ON pares (destino)")
+        conn.commit()
+        _cache_conn = conn
+    return _cache_conn
+
+def _chave_coordenada(lat, lon):
+    """Converte (lat, lon) na chave inteira usada no cache."""
+    fator = 10 ** CACHE_PRECISAO
+    return int(round(lat * fator)), int(round(lon * fator))
+
+def _ids_pontos_cache(conn, pontos):
+    """Retorna o id de cada ponto no cache (cadastrando os novos) e marca o acesso. Pontos inválidos recebem -1."""
+    agora = time.time()
+    chaves = [_chave_coordenada(lat, lon) if _is_valid_lat_lon(lat, lon) else None for lat, lon in pontos]
+    validas = list({c for c in chaves if c is not None})
+    conn.executemany("INSERT OR IGNORE INTO pontos (lat_q, lon_q, acesso) VALUES (?, ?, ?)", [(la, lo, agora) for la, lo in validas])
+    ids_por_chave = {}
+    for i in range(0, len(validas), 400): # Limite de variáveis por consulta do SQLite
+        lote = validas[i:i + 400]
+        filtro = " OR ".join(["(lat_q = ? AND lon_q = ?)"] * len(lote))
+        valores = [v for chave in lote for v in chave]
+        for id_ponto, lat_q, lon_q in conn.execute(f"SELECT id, lat_q, lon_q FROM pontos WHERE {filtro}", valores):
+            ids_por_chave[(lat_q, lon_q)] = id_ponto
+    conn.executemany("UPDATE pontos SET acesso = ? WHERE id = ?", [(agora, id_ponto) for id_ponto in ids_por_chave.values()])
+    return np.array([ids_por_chave[c] if c is not None else -1 for c in chaves], dtype=np.int64)
+
+def buscar_pares_cache(pontos, metrica, perfil=OSRM_PROFILE, apenas=None):
+    """
+    Busca no cache persistente os valores já conhecidos entre todos os pares de `pontos`.
+    Com `apenas` (posições em `pontos`), busca só os pares que envolvem esses pontos.
+
+    Returns:
+        tuple: (valores, conhecidos, ids) — matriz NxN de valores (INFINITE_VALUE onde não há cache),
+               máscara booleana NxN dos pares encontrados e o id de cada ponto no cache (-1 se inválido).
     """
     n = len(pontos)
-    if n == 0:
-        logging.warning("Lista de pontos vazia.")
-        return np.array([[]])
-    if provider != "osrm":
-        raise NotImplementedError("Apenas o provedor 'osrm' é suportado no momento.") # Corrigido: Adicionado raise
-    if metrica not in ["duration", "distance"]:
-        raise ValueError("Métrica deve ser 'duration' ou 'distance'.") # Corrigido: Adicionado raise
+    valores = np.full((n, n), INFINITE_VALUE, dtype=MATRIX_DTYPE)
+    conhecidos = np.zeros((n, n), dtype=bool)
+    with _cache_lock:
+        conn = _get_cache_connection()
+        ids = _ids_pontos_cache(conn, pontos)
+        selecionados = np.ones(n, dtype=bool) if apenas is None else np.isin(np.arange(n), apenas)
+        conn.execute("CREATE TEMP TABLE IF NOT EXISTS consulta_pontos (pos INTEGER, id INTEGER, selecionado INTEGER)")
+        conn.execute("DELETE FROM consulta_pontos")
+        conn.executemany("INSERT INTO consulta_pontos (pos, id, selecionado) VALUES (?, ?, ?)",
+                         [(pos, int(id_ponto), int(selecionados[pos])) for pos, id_ponto in enumerate(ids) if id_ponto >= 0])
+        conn.execute("CREATE INDEX IF NOT EXISTS temp.idx_consulta_id ON consulta_pontos (id)")
+        # CROSS JOIN fixa a ordem no SQLite: parte dos pontos consultados em vez de varrer todos os pares do perfil
+        # Pares saindo dos pontos selecionados (índice da chave primária por origem)
+        consultas = ['''SELECT o.pos, d.pos, p.valor
+                        FROM consulta_pontos o
+                        CROSS JOIN pares p ON p.perfil = ? AND p.metrica = ? AND p.origem = o.id
+                        JOIN consulta_pontos d ON d.id = p.destino
+                        WHERE o.selecionado = 1''']
+        if apenas is not None:
+            # Pares chegando aos pontos selecionados a partir dos demais (índice por destino)
+            consultas.append('''SELECT o.pos, d.pos, p.valor
+                                FROM consulta_pontos d
+                                CROSS JOIN pares p ON p.destino = d.id AND p.perfil = ? AND p.metrica = ?
+                                JOIN consulta_pontos o ON o.id = p.origem
+                                WHERE d.selecionado = 1 AND o.selecionado = 0''')
+        for consulta in consultas:
+            cursor = conn.execute(consulta, (perfil, metrica))
+            # Lê em lotes para não materializar milhões de tuplas de uma vez
+            while True:
+                linhas = cursor.fetchmany(200000)
+                if not linhas:
+                    break
+                resultado = np.array(linhas, dtype=np.int64)
+                valores[resultado[:, 0], resultado[:, 1]] = resultado[:, 2]
+                conhecidos[resultado[:, 0], resultado[:, 1]] = True
+        conn.commit()
+    return valores, conhecidos, ids
+
+def salvar_pares_cache(ids, origens, destinos, submatriz, metrica, perfil=OSRM_PROFILE):
+    """Grava no cache os valores de um bloco (origens x destinos, índices na lista de pontos) vindos do OSRM."""
+    ids_origem = ids[list(origens)]
+    ids_destino = ids[list(destinos)]
+    registros = [
+        (perfil, metrica, int(id_o), int(id_d), int(submatriz[i, j]))
+        for i, id_o in enumerate(ids_origem) if id_o >= 0
+        for j, id_d in enumerate(ids_destino) if id_d >= 0
+    ]
+    if not registros:
+        return
+    with _cache_lock:
+        conn = _get_cache_connection()
+        conn.executemany("INSERT OR REPLACE INTO pares (perfil, metrica, origem, destino, valor) VALUES (?, ?, ?, ?, ?)", registros)
+        conn.commit()
 
-    url_base = f"{OSRM_SERVER_URL}/table/v1/driving/"
-    final_matrix = np.full((n, n), INFINITE_VALUE, dtype=int) # Usar int para tempos/distâncias
-    np.fill_diagonal(final_matrix, 0)
+def aplicar_limite_cache(max_pares=None):
+    """
+    Mantém o cache abaixo de `max_pares` pares, descartando os pares dos pontos acessados há mais tempo.
+    Ao exceder o limite, reduz o cache a ~90% dele para não podar a cada chamada.
+    """
+    max_pares = CACHE_MAX_PARES if max_pares is None else max_pares
+    with _cache_lock:
+        conn = _get_cache_connection()
+        total = conn.execute("SELECT COUNT(*) FROM pares").fetchone()[0]
+        if total <= max_pares:
+            return 0
+        alvo = int(max_pares * 0.9)
+        removidos = 0
+        pontos_antigos = [row[0] for row in conn.execute("SELECT id FROM pontos ORDER BY acesso ASC")]
+        for i in range(0, len(pontos_antigos), 50):
+            if total - removidos <= alvo:
+                break
+            lote = pontos_antigos[i:i + 50]
+            marcadores = ",".join("?" * len(lote))
+            cursor = conn.execute(f"DELETE FROM pares WHERE origem IN ({marcadores}) OR destino IN ({marcadores})", lote + lote)
+            conn.execute(f"DELETE FROM pontos WHERE id IN ({marcadores})", lote)
+            removidos += cursor.rowcount
+        conn.commit()
+    logging.info(f"Cache de distâncias podado: {removidos} pares removidos (limite {max_pares}).")
+    return removidos
 
-    # --- AJUSTE AQUI ---
-    max_coords_per_request = 15 # Reduzido de 20 para 15
-    # -------------------
-    num_batches = (n + max_coords_per_request - 1) // max_coords_per_request
-    batches = [list(range(i * max_coords_per_request, min((i + 1) * max_coords_per_request, n))) for i in range(num_batches)]
-    total_requests = num_batches * num_batches
+def limpar_cache_distancias():
+    """Remove todos os pares e pontos do cache persistente."""
+    with _cache_lock:
+        conn = _get_cache_connection()
+        conn.execute("DELETE FROM pares")
+        conn.execute("DELETE FROM pontos")
+        conn.commit()
 
-    logging.info(f"Dividindo {n} pontos em {num_batches} lotes (máx {max_coords_per_request} por lote). Total de {total_requests} requisições OSRM.")
-    request_count = 0
+def _blocos_faltantes(faltando):
+    """
+    Cobre a máscara NxN de pares faltantes com retângulos (origens, destinos).
+
+    Pontos com a maioria dos arcos faltando (ex.: pedidos novos) viram as faixas
+    novos x todos e todos x novos; o restante esparso (ex.: pares descartados do cache)
+    é agrupado nas linhas e colunas que ainda faltam. Assim, N pontos conhecidos
+    mais K novos custam O(K x N) consultas em vez de O(N²).
+    """
+    n = faltando.shape[0]
+    if not faltando.any():
+        return []
+    # Só entram nos retângulos pontos com algum arco faltando (exclui, p.ex., coordenadas inválidas)
+    envolvidos = np.flatnonzero(faltando.any(axis=1) | faltando.any(axis=0))
+    arcos_faltando = faltando.sum(axis=1) + faltando.sum(axis=0)
+    novos = np.flatnonzero(arcos_faltando > max(1, n - 1))
+    antigos = np.setdiff1d(envolvidos, novos)
+    retangulos = []
+    if len(novos):
+        retangulos.append((novos.tolist(), envolvidos.tolist()))
+        if len(antigos):
+            retangulos.append((antigos.tolist(), novos.tolist()))
+    resto = faltando.copy()
+    resto[novos, :] = False
+    resto[:, novos] = False
+    linhas = np.flatnonzero(resto.any(axis=1))
+    if len(linhas):
+        colunas = np.flatnonzero(resto[linhas].any(axis=0))
+        retangulos.append((linhas.tolist(), colunas.tolist()))
+    return retangulos
+# --- Fim Cache Persistente ---
+
+
+# --- Matriz Pré-calculada ---
+_pre_calculo = {'chave': None, 'dados': None}
+_pre_calculo_lock = threading.Lock()
+
+def carregar_matriz_pre_calculada(caminho=None):
+    """
+    Carrega a matriz pré-calculada da base de clientes (manifesto JSON + um .npy por métrica,
+    abertos com mmap), mantendo-a em memória enquanto o manifesto não mudar.
 
+    Args:
+        caminho (str, optional): Caminho do manifesto. Padrão: PRE_CALCULO_PATH.
+
+    Returns:
+        dict or None: {'pontos': lista de (lat, lon), 'matrizes': {metrica: numpy.memmap}, 'gerado_em': str},
+                      ou None se não houver matriz pré-calculada válida.
+    """
+    caminho = caminho or PRE_CALCULO_PATH
     try:
-        for r_idx, batch_origem_indices_global in enumerate(batches):
-            for c_idx, batch_destino_indices_global in enumerate(batches):
-                request_count += 1
-                logging.info(f"Calculando submatriz Lote {r_idx+1}/{num_batches} -> Lote {c_idx+1}/{num_batches} (Req {request_count}/{total_requests})")
-
-                # --- Validação dos Pontos do Lote Combinado ---
-                # Combina índices globais de origem e destino, removendo duplicatas e mantendo a ordem
-                combined_indices_global = sorted(list(set(batch_origem_indices_global + batch_destino_indices_global)))
-                pontos_lote_combinado = [pontos[i] for i in combined_indices_global]
-
-                # Valida as coordenadas *deste lote combinado*
-                osrm_points_coords, indices_validos_no_lote_combinado = _validar_coordenadas(pontos_lote_combinado)
-
-                # Mapeia índices válidos no lote combinado de volta para índices globais
-                indices_globais_validos = [combined_indices_global[i] for i in indices_validos_no_lote_combinado]
-
-                # Mapeia índices globais de origem/destino para índices *dentro da lista de pontos válidos* (osrm_points_coords)
-                # que será enviada ao OSRM. Cria um dicionário para busca rápida.
-                map_global_to_osrm_idx = {osrm_idx: global_idx for osrm_idx, global_idx in enumerate(indices_globais_validos)}
-
-                # Filtra os índices globais de origem/destino para incluir apenas os que são válidos
-                batch_origem_indices_validos_global = [idx for idx in batch_origem_indices_global if idx in map_global_to_osrm_idx]
-                batch_destino_indices_validos_global = [idx for idx in batch_destino_indices_global if idx in map_global_to_osrm_idx]
-
-                # Obtém os índices correspondentes na lista que vai para o OSRM
-                osrm_sources_indices = [map_global_to_osrm_idx[idx] for idx in batch_origem_indices_validos_global]
-                osrm_destinations_indices = [map_global_to_osrm_idx[idx] for idx in batch_destino_indices_validos_global]
-                # --- Fim Validação ---
-
-
-                # --- Requisição OSRM com Pontos Válidos ---
-                # Não faz requisição se houver menos de 2 pontos válidos em sources ou destinations
-                if len(osrm_sources_indices) < 2 or len(osrm_destinations_indices) < 2:
-                    logging.warning(f"Lote ignorado: menos de 2 pontos em sources ou destinations (sources={len(osrm_sources_indices)}, destinations={len(osrm_destinations_indices)}). Pulando requisição OSRM.")
-                    if progress_callback:
-                        progress_callback(request_count / total_requests)
-                    continue
+        estado = os.stat(caminho)
+    except OSError:
+        return None
+    chave = (os.path.abspath(caminho), estado.st_mtime_ns, estado.st_size)
+    with _pre_calculo_lock:
+        if _pre_calculo['chave'] == chave:
+            return _pre_calculo['dados']
+        dados = None
+        try:
+            with open(caminho, encoding="utf-8") as f:
+                manifesto = json.load(f)
+            pontos = [tuple(p) for p in manifesto['pontos']]
+            pasta = os.path.dirname(os.path.abspath(caminho))
+            matrizes = {metrica: np.load(os.path.join(pasta, arquivo), mmap_mode='r')
+                        for metrica, arquivo in manifesto['arquivos'].items()}
+            if any(matriz.shape != (len(pontos), len(pontos)) for matriz in matrizes.values()):
+                logging.warning(f"Matriz pré-calculada em {caminho} com dimensões diferentes da lista de pontos. Ignorando.")
+            else:
+                dados = {'pontos': pontos, 'matrizes': matrizes, 'gerado_em': manifesto.get('gerado_em')}
+                logging.info(f"Matriz pré-calculada carregada: {len(pontos)} pontos, gerada em {dados['gerado_em']}.")
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            logging.warning(f"Não foi possível carregar a matriz pré-calculada {caminho}: {e}")
+        _pre_calculo['chave'], _pre_calculo['dados'] = chave, dados
+        return dados
+# --- Fim Matriz Pré-calculada ---
+
+
+# --- Estimativa Haversine ---
+_calibracao_estimativa = None
+
+def calibrar_estimativa(max_amostras=20000, forcar=False):
+    """
+    Calibra o fator de circuito (ruas / linha reta) e a velocidade média a partir de pares
+    reais do OSRM guardados no cache persistente. Sem amostras suficientes, usa os padrões
+    DEFAULT_FATOR_CIRCUITO e DEFAULT_VELOCIDADE_KMH.
+
+    Args:
+        max_amostras (int): Máximo de pares lidos do cache.
+        forcar (bool): Se True, recalibra mesmo que já exista calibração nesta execução.
+
+    Returns:
+        dict: {'fator_circuito', 'velocidade_mps', 'amostras'}
+    """
+    global _calibracao_estimativa
+    if _calibracao_estimativa is not None and not forcar:
+        return _calibracao_estimativa
+
+    calibracao = {
+        'fator_circuito': DEFAULT_FATOR_CIRCUITO,
+        'velocidade_mps': DEFAULT_VELOCIDADE_KMH * 1000 / 3600,
+        'amostras': 0,
+    }
+    linhas = []
+    try:
+        with _cache_lock:
+            conn = _get_cache_connection()
+            # Sorteia origens e lê seus pares pelo índice (perfil, metrica, origem), sem varrer a tabela
+            origens = [row[0] for row in conn.execute("SELECT id FROM pontos ORDER BY RANDOM() LIMIT 300")]
+            if origens:
+                marcadores = ",".join("?" * len(origens))
+                linhas = conn.execute(f'''SELECT po.lat_q, po.lon_q, pd.lat_q, pd.lon_q, dist.valor, dur.valor
+                                         FROM pares dist
+                                         JOIN pares dur ON dur.perfil = dist.perfil AND dur.metrica = 'duration'
+                                                       AND dur.origem = dist.origem AND dur.destino = dist.destino
+                                         JOIN pontos po ON po.id = dist.origem
+                                         JOIN pontos pd ON pd.id = dist.destino
+                                         WHERE dist.perfil = ? AND dist.metrica = 'distance' AND dist.origem IN ({marcadores})
+                                               AND dist.origem != dist.destino
+                                         LIMIT ?''', [OSRM_PROFILE] + origens + [max_amostras]).fetchall()
+    except sqlite3.Error as e:
+        logging.warning(f"Não foi possível ler o cache para calibrar a estimativa: {e}. Usando valores padrão.")
+
+    if linhas:
+        dados = np.array(linhas, dtype=float)
+        coords = dados[:, :4] / (10 ** CACHE_PRECISAO)
+        linha_reta = _haversine_m(coords[:, 0], coords[:, 1], coords[:, 2], coords[:, 3])
+        calibracao = _ajustar_calibracao(linha_reta, dados[:, 4], dados[:, 5]) or calibracao
+
+    logging.info(f"Estimativa calibrada: fator de circuito {calibracao['fator_circuito']:.3f}, "
+                 f"velocidade {calibracao['velocidade_mps'] * 3.6:.1f} km/h ({calibracao['amostras']} pares do cache).")
+    _calibracao_estimativa = calibracao
+    return calibracao
+
+def _ajustar_calibracao(linha_reta, distancia, duracao):
+    """Fator de circuito (mediana) e velocidade média a partir de pares reais; None se houver poucas amostras."""
+    # Ignora pares muito curtos (ruído do snapping) e pares sem rota
+    validos = (linha_reta > 500) & (distancia < INFINITE_VALUE) & (duracao < INFINITE_VALUE) & (duracao > 0)
+    if validos.sum() < MIN_AMOSTRAS_CALIBRACAO:
+        return None
+    return {
+        'fator_circuito': float(np.median(distancia[validos] / linha_reta[validos])),
+        'velocidade_mps': float(distancia[validos].sum() / duracao[validos].sum()),
+        'amostras': int(validos.sum()),
+    }
+
+def _haversine_m(lat_o, lon_o, lat_d, lon_d):
+    """Distância em linha reta (m) com broadcasting NumPy; entradas em graus."""
+    lat_o, lon_o, lat_d, lon_d = map(np.radians, (lat_o, lon_o, lat_d, lon_d))
+    a = np.sin((lat_d - lat_o) / 2) ** 2 + np.cos(lat_o) * np.cos(lat_d) * np.sin((lon_d - lon_o) / 2) ** 2
+    return 2 * EARTH_RADIUS_M * np.arcsin(np.sqrt(np.clip(a, 0, 1)))
+
+def _vetores_unitarios(lat, lon):
+    """Coordenadas (graus) como vetores unitários 3D na esfera."""
+    lat, lon = np.radians(lat), np.radians(lon)
+    return np.column_stack([np.cos(lat) * np.cos(lon), np.cos(lat) * np.sin(lon), np.sin(lat)])
+
+def _coordenadas_array(pontos):
+    """Converte a lista de pontos em arrays de latitude e longitude e uma máscara de coordenadas válidas."""
+    validos = np.array([_is_valid_lat_lon(*p) for p in pontos], dtype=bool)
+    coords = np.array([p if v else (0.0, 0.0) for p, v in zip(pontos, validos)], dtype=float).reshape(-1, 2)
+    return coords[:, 0], coords[:, 1], validos
+
+def _estimar_bloco(lat, lon, validos, origens, destinos, metrica, calibracao, pares=False):
+    """
+    Estima a submatriz origens x destinos (metros ou segundos) pela distância em linha reta calibrada.
+    Com pares=True, estima só os arcos (origens[i], destinos[i]) e retorna um vetor.
+    """
+    origens, destinos = np.asarray(origens), np.asarray(destinos)
+    # Corda entre vetores unitários (produto matricial) em vez de trigonometria por célula
+    vetores_origem = _vetores_unitarios(lat[origens], lon[origens])
+    vetores_destino = _vetores_unitarios(lat[destinos], lon[destinos])
+    produto = np.einsum('ij,ij->i', vetores_origem, vetores_destino) if pares else vetores_origem @ vetores_destino.T
+    distancia = np.clip(2 - 2 * produto, 0, 4, out=produto)
+    distancia = np.sqrt(distancia, out=distancia)
+    distancia = np.arcsin(np.minimum(distancia / 2, 1), out=distancia)
+    distancia *= 2 * EARTH_RADIUS_M * calibracao['fator_circuito']
+    valores = distancia if metrica == "distance" else distancia / calibracao['velocidade_mps']
+    valores = np.minimum(np.rint(valores), INFINITE_VALUE)
+    if pares:
+        valores[~(validos[origens] & validos[destinos])] = INFINITE_VALUE
+    else:
+        valores[~validos[origens], :] = INFINITE_VALUE
+        valores[:, ~validos[destinos]] = INFINITE_VALUE
+    return valores.astype(MATRIX_DTYPE)
+
+def _estimar_matrizes(pontos, metricas, matrizes, calibracao=None, linhas_por_faixa=1024):
+    """
+    Preenche as matrizes das `metricas` com a estimativa calibrada, em faixas de linhas
+    para limitar a memória temporária em float64.
+    """
+    n = len(pontos)
+    calibracao = calibracao or calibrar_estimativa()
+    lat, lon, validos = _coordenadas_array(pontos)
+    todos = np.arange(n)
+    for inicio in range(0, n, linhas_por_faixa):
+        linhas = todos[inicio:inicio + linhas_por_faixa]
+        for metrica in metricas:
+            matrizes[metrica][linhas, :] = _estimar_bloco(lat, lon, validos, linhas, todos, metrica, calibracao)
+    for metrica in metricas:
+        np.fill_diagonal(matrizes[metrica], 0)
+    return matrizes
+# --- Fim Estimativa Haversine ---
 
-                if not osrm_points_coords or len(osrm_points_coords) < 1 or not osrm_sources_indices or not osrm_destinations_indices:
-                     logging.warning(f"Nenhum ponto válido ou nenhuma origem/destino válido no lote combinado (Req {request_count}). Pulando requisição OSRM.")
-                     if progress_callback:
-                        progress_callback(request_count / total_requests)
-                     continue
-
-                batch_coords_str = ";".join([f"{lon},{lat}" for lat, lon in osrm_points_coords])
-
-                # Adiciona os parâmetros sources e destinations
-                sources_param = ";".join(map(str, osrm_sources_indices))
-                destinations_param = ";".join(map(str, osrm_destinations_indices))
-                params_com_indices = {"sources": sources_param, "destinations": destinations_param}
-
-                # --- AJUSTE AQUI: Usar extra_params ---
-                # Chama a função _get_osrm_table_batch passando a URL base e os parâmetros extras
-                partial_matrix_raw = _get_osrm_table_batch(url_base, batch_coords_str, metrica, timeout=DEFAULT_TIMEOUT, extra_params=params_com_indices)
-                # --------------------------------------
-
-
-                if partial_matrix_raw is None:
-                    # O log de erro detalhado já acontece dentro de _get_osrm_table_batch
-                    logging.error(f"Falha crítica ao obter dados do OSRM para o lote (Req {request_count}/{total_requests}). Abortando cálculo da matriz.")
-                    return None # Aborta se a requisição falhar após retentativas
-
-                # --- Preenchimento da Matriz Final ---
-                # A matriz retornada pelo OSRM com sources/destinations tem shape (len(sources), len(destinations))
-                # Iteramos sobre os resultados e colocamos na matriz final usando os índices globais válidos
-                expected_rows = len(osrm_sources_indices)
-                expected_cols = len(osrm_destinations_indices)
-                actual_rows = len(partial_matrix_raw) if partial_matrix_raw is not None else 0
-                actual_cols = len(partial_matrix_raw[0]) if actual_rows > 0 and partial_matrix_raw[0] is not None else 0
-
-                if actual_rows != expected_rows or actual_cols != expected_cols:
-                     logging.error(f"Erro: Dimensões da matriz OSRM ({actual_rows}x{actual_cols}) "
-                                   f"não correspondem aos índices de origem/destino enviados ({expected_rows}x{expected_cols}). Req {request_count}")
-                     # Considerar isso um erro crítico também? Por enquanto, loga e continua, pode preencher errado.
-                     # return None # Descomentar para abortar
+def _preparar_pontos(pontos):
+    """
+    Valida e formata as coordenadas de todos os pontos uma única vez por cálculo,
+    para que cada bloco só precise indexar arrays (em vez de refazer listas, sets e dicts).
+    """
+    validos = np.array([_is_valid_lat_lon(lat, lon) for lat, lon in pontos], dtype=bool)
+    for i in np.flatnonzero(~validos):
+        logging.warning(f"Coordenada inválida: índice {i}, valor {pontos[i]}. Será ignorada.")
+    coords = np.array([f"{lon:.6f},{lat:.6f}" if valido else "" for (lat, lon), valido in zip(pontos, validos)], dtype=object)
+    return {'validos': validos, 'coords': coords}
+
+
+def _preparar_bloco(preparo, batch_origem_indices_global, batch_destino_indices_global):
+    """
+    Monta os dados da requisição OSRM de um bloco (origens x destinos), a partir dos pontos
+    já validados e formatados por `_preparar_pontos`.
+
+    Returns:
+        dict or None: Dados do bloco (coordenadas, parâmetros e índices globais válidos, em arrays),
+                      ou None se o bloco não tiver pontos suficientes para consulta.
+    """
+    validos = preparo['validos']
+    origens = np.asarray(batch_origem_indices_global, dtype=np.int64)
+    destinos = np.asarray(batch_destino_indices_global, dtype=np.int64)
+    origens = origens[validos[origens]]
+    destinos = destinos[validos[destinos]]
+
+    # Não faz requisição se não houver ponto válido em sources ou destinations.
+    # (Blocos retangulares podem ter uma única origem ou destino legítimo, ex.: último bloco.)
+    if not len(origens) or not len(destinos):
+        logging.warning(f"Lote ignorado: nenhum ponto válido em sources ou destinations (sources={len(origens)}, destinations={len(destinos)}). Pulando requisição OSRM.")
+        return None
+
+    # Coordenadas enviadas: união ordenada de origens e destinos; sources/destinations são posições nela
+    combinados = np.union1d(origens, destinos)
+    sources = np.searchsorted(combinados, origens)
+    destinations = np.searchsorted(combinados, destinos)
+
+    return {
+        'coords_str': ";".join(preparo['coords'][combinados]),
+        'extra_params': {"sources": ";".join(map(str, sources.tolist())), "destinations": ";".join(map(str, destinations.tolist()))},
+        'origens': origens,
+        'destinos': destinos,
+    }
+
+
+def _consultar_blocos(executor, url_base, blocos, metricas, preparo, limite_tabela, metadados):
+    """
+    Dispara os blocos no executor e gera (bloco, resposta) conforme ficam prontos (resposta None = falha).
+
+    Um bloco recusado com 'TooBig' (limite acima do real, ex.: sonda sem resposta) não conta como
+    falha: o lado do bloco cai pela metade, o novo limite fica em cache para o servidor e o bloco é
+    replanejado em blocos menores, disparados no lugar dele. `metadados` acompanha 'limite_tabela',
+    'num_requisicoes' e 'blocos_recusados'.
+    """
+    def _enviar(bloco):
+        return executor.submit(_get_osrm_table_batch, url_base, bloco['coords_str'], metricas,
+                               timeout=DEFAULT_TIMEOUT, extra_params=bloco['extra_params'])
+
+    pendentes = {_enviar(bloco): bloco for bloco in blocos}
+    while pendentes:
+        prontos, _ = wait(pendentes, return_when=FIRST_COMPLETED)
+        for future in prontos:
+            bloco = pendentes.pop(future)
+            try:
+                resposta = future.result()
+            except TabelaGrandeDemaisError as e:
+                lado = math.isqrt(len(bloco['origens']) * len(bloco['destinos'])) // 2
+                if lado < 1:
+                    logging.error(f"{e} Bloco de 1x1 recusado: tratado como falha.")
+                    resposta = None
                 else:
-                    for i, source_global_idx in enumerate(batch_origem_indices_validos_global):
-                        for j, dest_global_idx in enumerate(batch_destino_indices_validos_global):
-                            value = partial_matrix_raw[i][j]
-                            # OSRM retorna null para rotas impossíveis
-                            final_matrix[source_global_idx, dest_global_idx] = int(value) if value is not None else INFINITE_VALUE
+                    limite_tabela = min(limite_tabela, _reduzir_limite_tabela(lado))
+                    metadados['limite_tabela'] = limite_tabela
+                    metadados['blocos_recusados'] += 1
+                    partes = _planejar_blocos(bloco['origens'], bloco['destinos'], limite_tabela)[0]
+                    for num_parte, (origens, destinos) in enumerate(partes, start=1):
+                        parte = _preparar_bloco(preparo, origens, destinos)
+                        parte['label'] = f"{bloco.get('label', 'Bloco')}, parte {num_parte}/{len(partes)} ({len(origens)}x{len(destinos)})"
+                        pendentes[_enviar(parte)] = parte
+                    metadados['num_requisicoes'] += len(partes)
+                    continue
+            yield bloco, resposta
+
+
+def _preencher_bloco(final_matrix, bloco, partial_matrix_raw, request_label):
+    """
+    Copia a submatriz retornada pelo OSRM para a matriz final, usando os índices globais do bloco.
+    Converte a resposta em array uma única vez (null -> INFINITE_VALUE) e grava com np.ix_.
+    Retorna False se as dimensões da resposta não baterem com o bloco enviado.
+    """
+    # A matriz retornada pelo OSRM com sources/destinations tem shape (len(sources), len(destinations))
+    expected_shape = (len(bloco['origens']), len(bloco['destinos']))
+    try:
+        # OSRM retorna null para rotas impossíveis: vira nan na conversão para float
+        valores = np.array(partial_matrix_raw, dtype=float)
+    except (TypeError, ValueError):
+        valores = None
+    if valores is None or valores.shape != expected_shape:
+        logging.error(f"Erro: Dimensões da matriz OSRM ({None if valores is None else valores.shape}) "
+                      f"não correspondem aos índices de origem/destino enviados {expected_shape}. {request_label}")
+        return False
+
+    valores[np.isnan(valores)] = INFINITE_VALUE
+    # A conversão para MATRIX_DTYPE trunca, como o int() célula a célula de antes
+    final_matrix[np.ix_(bloco['origens'], bloco['destinos'])] = valores
+    return True
+
+
+def _alocar_matriz(n, arquivo_memmap=None):
+    """
+    Aloca uma matriz NxN (MATRIX_DTYPE) preenchida com INFINITE_VALUE e diagonal zero.
+    Com `arquivo_memmap`, a matriz é um arquivo .npy mapeado em memória (np.load(..., mmap_mode='r') reabre).
+    """
+    if arquivo_memmap:
+        os.makedirs(os.path.dirname(os.path.abspath(arquivo_memmap)), exist_ok=True)
+        matriz = np.lib.format.open_memmap(arquivo_memmap, mode='w+', dtype=MATRIX_DTYPE, shape=(n, n))
+        matriz[:] = INFINITE_VALUE
+    else:
+        matriz = np.full((n, n), INFINITE_VALUE, dtype=MATRIX_DTYPE)
+    np.fill_diagonal(matriz, 0)
+    return matriz
+
+
+# --- Modo Simétrico ---
+def _amostrar_pares_completos(matriz, origens, destinos, amostras):
+    """
+    Guarda em `amostras` (listas 'ida' e 'volta') os pares que o bloco trouxe nos dois sentidos
+    (pontos que são origem e destino ao mesmo tempo, como nos blocos da diagonal).
+    'ida' é o sentido i -> j com i < j (o que o modo simétrico consulta) e 'volta' o sentido j -> i.
+    """
+    if sum(len(ida) for ida in amostras['ida']) >= MAX_AMOSTRAS_ASSIMETRIA:
+        return
+    comuns = np.intersect1d(origens, destinos)
+    if len(comuns) < 2:
+        return
+    submatriz = matriz[np.ix_(comuns, comuns)]
+    superior = np.triu_indices(len(comuns), 1)
+    amostras['ida'].append(submatriz[superior])
+    amostras['volta'].append(submatriz.T[superior])
 
-                # Atualiza progresso
+def _ajustar_assimetria(amostras):
+    """
+    Fator de assimetria (soma das voltas / soma das idas) dos pares completos amostrados e o erro
+    relativo mediano de estimar a volta como ida x fator. Com poucas amostras, fator 1.0 (espelho puro).
+    """
+    ida = np.concatenate(amostras['ida']).astype(float) if amostras['ida'] else np.array([])
+    volta = np.concatenate(amostras['volta']).astype(float) if amostras['volta'] else np.array([])
+    validos = (ida > 0) & (volta > 0) & (ida < INFINITE_VALUE) & (volta < INFINITE_VALUE)
+    if validos.sum() < MIN_AMOSTRAS_CALIBRACAO:
+        return {'fator': 1.0, 'amostras': int(validos.sum()), 'erro_mediano': None}
+    ida, volta = ida[validos], volta[validos]
+    fator = float(volta.sum() / ida.sum())
+    return {
+        'fator': fator,
+        'amostras': int(validos.sum()),
+        'erro_mediano': float(np.median(np.abs(volta - fator * ida) / volta)),
+    }
+
+def _espelhar_pares(matriz, faltando, fator):
+    """
+    Preenche os pares de `faltando` cujo sentido oposto já é conhecido: abaixo da diagonal,
+    valor = oposto x fator; acima dela, valor = oposto / fator. Retorna quantos pares foram espelhados.
+    """
+    origens, destinos = np.nonzero(faltando & ~faltando.T)
+    if not len(origens):
+        return 0
+    opostos = matriz[destinos, origens].astype(float)
+    valores = opostos * np.where(origens > destinos, fator, 1 / fator)
+    matriz[origens, destinos] = np.where(opostos >= INFINITE_VALUE, INFINITE_VALUE, np.rint(valores))
+    return len(origens)
+# --- Fim Modo Simétrico ---
+
+
+def _calcular_matrizes(pontos, metricas, provider="osrm", progress_callback=None, requisicoes_simultaneas=None, usar_cache=True,
+                       arquivo_memmap=None, fallback="haversine", reaproveitar=None, simetrica=False, fator_assimetria=None,
+                       usar_pre_calculo=True):
+    """
+    Escolhe o motor de cálculo das matrizes. Com provider="haversine", nenhuma requisição
+    é feita: as matrizes saem da distância em linha reta calibrada (`calibrar_estimativa`),
+    o que monta milhares de pontos em menos de um segundo. Com fallback="haversine", a mesma
+    estimativa substitui só os blocos que o OSRM não conseguiu responder (retentativas
+    esgotadas ou circuito aberto) e, em último caso, a matriz inteira. `simetrica` e
+    `fator_assimetria` só afetam o OSRM (a estimativa haversine já é simétrica).
+
+    Com `usar_pre_calculo` e sem matrizes antigas, os pontos presentes na matriz pré-calculada
+    da base de clientes (`carregar_matriz_pre_calculada`) têm seus pares recortados dela; só os
+    pares que envolvem pontos fora dela vão ao cache e ao OSRM.
+
+    Returns:
+        tuple: (dict {metrica: numpy.ndarray} ou None em caso de erro crítico, dict de metadados)
+    """
+    metricas = tuple(metricas)
+    if provider not in PROVIDERS:
+        raise NotImplementedError(f"Provedor '{provider}' não suportado. Use um de: {', '.join(PROVIDERS)}.")
+    if fallback not in (None, "haversine"):
+        raise ValueError("fallback deve ser None ou 'haversine'.")
+    if not metricas or any(m not in ["duration", "distance"] for m in metricas):
+        raise ValueError("Métrica deve ser 'duration' ou 'distance'.") # Corrigido: Adicionado raise
+
+    if provider == "osrm":
+        pontos_pre_calculados = 0
+        if usar_pre_calculo and reaproveitar is None and pontos:
+            pre_calculo = carregar_matriz_pre_calculada()
+            if pre_calculo is not None and all(m in pre_calculo['matrizes'] for m in metricas):
+                indices_pre = _indices_reaproveitados(pre_calculo['pontos'], pontos)
+                pontos_pre_calculados = int((indices_pre >= 0).sum())
+                if pontos_pre_calculados:
+                    logging.info(f"{pontos_pre_calculados} de {len(pontos)} pontos recortados da matriz pré-calculada.")
+                    reaproveitar = (pre_calculo['matrizes'], indices_pre)
+        matrizes, metadados = _calcular_matrizes_osrm(pontos, metricas, progress_callback=progress_callback,
+                                                      requisicoes_simultaneas=requisicoes_simultaneas,
+                                                      usar_cache=usar_cache, arquivo_memmap=arquivo_memmap,
+                                                      estimar_blocos_falhos=(fallback == "haversine"),
+                                                      reaproveitar=reaproveitar, simetrica=simetrica,
+                                                      fator_assimetria=fator_assimetria)
+        metadados['pontos_pre_calculados'] = pontos_pre_calculados
+        if matrizes is not None or fallback is None or not pontos:
+            return matrizes, metadados
+        logging.warning("OSRM indisponível ou com falha: usando a estimativa haversine calibrada para a matriz inteira.")
+    else:
+        metadados = {'provider': provider, 'metrica': ",".join(metricas), 'n_pontos': len(pontos), 'num_requisicoes': 0}
+        if not pontos:
+            return {m: np.array([[]]) for m in metricas}, metadados
+
+    inicio = time.time()
+    n = len(pontos)
+    calibracao = calibrar_estimativa()
+    matrizes = {
+        metrica: _alocar_matriz(n, f"{arquivo_memmap}_{metrica}.npy" if arquivo_memmap else None)
+        for metrica in metricas
+    }
+    _estimar_matrizes(pontos, metricas, matrizes, calibracao)
+    if progress_callback:
+        progress_callback(1.0)
+    metadados['provider_usado'] = "haversine"
+    metadados['calibracao'] = calibracao
+    metadados['tempo_s'] = round((metadados.get('tempo_s') or 0) + time.time() - inicio, 3)
+    return matrizes, metadados
+
+
+def _calcular_matrizes_osrm(pontos, metricas, progress_callback=None, requisicoes_simultaneas=None, usar_cache=True,
+                            arquivo_memmap=None, estimar_blocos_falhos=False, reaproveitar=None, simetrica=False,
+                            fator_assimetria=None):
+    """
+    Núcleo do cálculo de matrizes via OSRM Table API: monta as matrizes de todas as
+    `metricas` pedidas a partir do mesmo conjunto de requisições (annotations=duration,distance).
+
+    O tamanho dos blocos (origens x destinos) é escolhido a partir do limite de
+    coordenadas do servidor (detectado via `detectar_limite_tabela`) e do tamanho
+    máximo de URL. Os blocos são consultados em paralelo por um pool de threads
+    limitado a `requisicoes_simultaneas` requisições em andamento; as matrizes são
+    preenchidas à medida que cada bloco chega.
+
+    Com `usar_cache`, os pares já consultados são lidos do cache persistente
+    (SQLite em CACHE_DB_PATH) e só os pares faltantes vão ao OSRM; os novos valores
+    são gravados no cache, que é podado ao passar de CACHE_MAX_PARES pares.
+
+    As matrizes usam MATRIX_DTYPE (int32). Com `arquivo_memmap` (prefixo de caminho),
+    cada métrica é gravada em '<prefixo>_<metrica>.npy' mapeado em memória.
+
+    Com `estimar_blocos_falhos`, um bloco que falhar recebe a estimativa haversine calibrada
+    (nunca gravada no cache) em vez de abortar o cálculo; os blocos estimados ficam nos metadados.
+
+    `reaproveitar` é uma tupla (matrizes_antigas, indices_antigos): para cada ponto, o índice
+    dele nas matrizes antigas (-1 se for novo). Os pares entre pontos já conhecidos são copiados
+    delas, e só as linhas e colunas dos pontos novos são buscadas no cache e no OSRM.
+
+    Com `simetrica`, assume d(i,j) ≈ d(j,i): só um sentido de cada par vai ao OSRM (numa matriz
+    inteira, os blocos da diagonal e acima dela, cerca de metade das requisições) e o outro é
+    espelhado, multiplicado pelo fator de assimetria. Sem `fator_assimetria`, o fator de cada
+    métrica é aprendido dos pares que vieram completos (ida e volta) nos blocos da diagonal.
+
+    Returns:
+        tuple: (dict {metrica: numpy.ndarray} ou None em caso de erro crítico, dict de metadados)
+    """
+    n = len(pontos)
+    provider = "osrm"
+    if n == 0:
+        logging.warning("Lista de pontos vazia.")
+        return {m: np.array([[]]) for m in metricas}, {'provider': provider, 'metrica': ",".join(metricas), 'n_pontos': 0, 'num_requisicoes': 0}
+    if requisicoes_simultaneas is None:
+        requisicoes_simultaneas = MAX_CONCURRENT_REQUESTS
+    requisicoes_simultaneas = max(1, int(requisicoes_simultaneas))
+    inicio = time.time()
+
+    url_base = f"{OSRM_SERVER_URL}/table/v1/{OSRM_PROFILE}/"
+    matrizes = {
+        metrica: _alocar_matriz(n, f"{arquivo_memmap}_{metrica}.npy" if arquivo_memmap else None)
+        for metrica in metricas
+    }
+    faltando = np.zeros((n, n), dtype=bool)
+    reaproveitados = np.array([], dtype=np.int64)
+    if reaproveitar is not None:
+        indices_antigos = np.asarray(reaproveitar[1])
+        reaproveitados = np.flatnonzero(indices_antigos >= 0)
+
+    # --- Pares já conhecidos no cache persistente ---
+    # Um par só deixa de ser consultado se estiver no cache para todas as métricas pedidas
+    ids_cache = None
+    pares_cache = 0
+    if usar_cache:
+        # Com matrizes antigas, só interessam no cache os pares que envolvem pontos novos
+        apenas = np.flatnonzero(indices_antigos < 0) if reaproveitar is not None else None
+        try:
+            for metrica in metricas:
+                valores_cache, conhecidos, ids_cache = buscar_pares_cache(pontos, metrica, apenas=apenas)
+                np.fill_diagonal(conhecidos, True)
+                matrizes[metrica][conhecidos] = valores_cache[conhecidos]
+                np.fill_diagonal(matrizes[metrica], 0)
+                faltando |= ~conhecidos
+        except sqlite3.Error as e:
+            logging.warning(f"Cache de distâncias indisponível ({e}). Consultando todos os pares no OSRM.")
+            ids_cache = None
+    if ids_cache is None:
+        faltando[:] = True
+        np.fill_diagonal(faltando, False)
+
+    # --- Pares entre pontos que já estavam nas matrizes antigas ---
+    pares_reaproveitados = len(reaproveitados) * max(0, len(reaproveitados) - 1)
+    if len(reaproveitados):
+        matrizes_antigas = reaproveitar[0]
+        bloco_novo = np.ix_(reaproveitados, reaproveitados)
+        bloco_antigo = np.ix_(indices_antigos[reaproveitados], indices_antigos[reaproveitados])
+        for metrica in metricas:
+            matrizes[metrica][bloco_novo] = np.asarray(matrizes_antigas[metrica])[bloco_antigo]
+            np.fill_diagonal(matrizes[metrica], 0)
+        faltando[bloco_novo] = False
+    if ids_cache is not None:
+        pares_cache = int(n * (n - 1) - faltando.sum() - pares_reaproveitados)
+
+    # Pontos inválidos nunca serão roteáveis: não geram requisições
+    invalidos = [i for i, p in enumerate(pontos) if not _is_valid_lat_lon(*p)]
+    faltando[invalidos, :] = False
+    faltando[:, invalidos] = False
+
+    # Modo simétrico: par com um sentido já conhecido é só espelhado; com os dois faltando, consulta um sentido
+    pendente = faltando & faltando.T if simetrica else faltando
+
+    # --- Dimensionamento dos blocos a partir do limite do servidor ---
+    blocos_indices, tamanho_bloco, limite_tabela = [], (0, 0), None
+    retangulos = _blocos_faltantes(pendente)
+    if retangulos:
+        ponto_referencia = next((p for p in pontos if _is_valid_lat_lon(*p)), None)
+        limite_tabela = detectar_limite_tabela(ponto_referencia)
+        for origens, destinos in retangulos:
+            blocos_retangulo, tamanho = _planejar_blocos(origens, destinos, limite_tabela)
+            if simetrica:
+                blocos_retangulo = _blocos_um_sentido(blocos_retangulo, pendente)
+            blocos_indices.extend(blocos_retangulo)
+            if tamanho[0] * tamanho[1] > tamanho_bloco[0] * tamanho_bloco[1]:
+                tamanho_bloco = tamanho
+    total_requests = max(1, len(blocos_indices))
+
+    metadados = {
+        'provider': provider,
+        'metrica': ",".join(metricas),
+        'n_pontos': n,
+        'limite_tabela': limite_tabela,
+        'tamanho_bloco': tamanho_bloco,
+        'num_requisicoes': len(blocos_indices),
+        'blocos_recusados': 0,
+        'requisicoes_simultaneas': requisicoes_simultaneas,
+        'pares_cache': pares_cache,
+        'pares_reaproveitados': pares_reaproveitados,
+        'pares_consultados': sum(len(o) * len(d) for o, d in blocos_indices) if simetrica else int(faltando.sum()),
+        'provider_usado': provider,
+        'blocos_estimados': [],
+        'pares_estimados': 0,
+        'simetrica': simetrica,
+        'tempo_s': None,
+    }
+    estimativa = {}
+    amostras_assimetria = {metrica: {'ida': [], 'volta': []} for metrica in metricas}
+
+    def _resultado(resultado):
+        if resultado is not None and metadados['pares_estimados']:
+            metadados['provider_usado'] = "osrm+haversine"
+            metadados['calibracao'] = estimativa['calibracao']
+        metadados['tempo_s'] = round(time.time() - inicio, 3)
+        return resultado, metadados
+
+    def _estimar_bloco_falho(bloco):
+        """Preenche um bloco sem resposta do OSRM com a estimativa calibrada."""
+        if not estimativa:
+            estimativa['coordenadas'] = _coordenadas_array(pontos)
+            estimativa['calibracao'] = calibrar_estimativa()
+        lat, lon, validos = estimativa['coordenadas']
+        for metrica in metricas:
+            matrizes[metrica][np.ix_(bloco['origens'], bloco['destinos'])] = _estimar_bloco(
+                lat, lon, validos, bloco['origens'], bloco['destinos'], metrica, estimativa['calibracao'])
+            np.fill_diagonal(matrizes[metrica], 0)
+        metadados['blocos_estimados'].append((len(bloco['origens']), len(bloco['destinos'])))
+        metadados['pares_estimados'] += len(bloco['origens']) * len(bloco['destinos'])
+        if simetrica:
+            faltando[np.ix_(bloco['origens'], bloco['destinos'])] = False
+
+    def _espelhar():
+        """Modo simétrico: completa o sentido não consultado de cada par."""
+        metadados['assimetria'] = {}
+        for metrica in metricas:
+            if fator_assimetria is not None:
+                ajuste = {'fator': float(fator_assimetria), 'amostras': 0, 'erro_mediano': None}
+            else:
+                ajuste = _ajustar_assimetria(amostras_assimetria[metrica])
+                if ajuste['erro_mediano'] is None:
+                    logging.warning(f"Poucos pares completos para aprender a assimetria de '{metrica}': espelhando com fator 1.0.")
+            metadados['pares_espelhados'] = _espelhar_pares(matrizes[metrica], faltando, ajuste['fator'])
+            metadados['assimetria'][metrica] = ajuste
+        logging.info(f"Modo simétrico: {metadados['pares_espelhados']} pares espelhados (assimetria: "
+                     + ", ".join(f"{m} x{a['fator']:.3f}" for m, a in metadados['assimetria'].items()) + ").")
+
+    logging.info(f"{n} pontos: {pares_cache} pares vindos do cache, {metadados['pares_consultados']} pares a consultar em "
+                 f"{len(blocos_indices)} blocos de até {tamanho_bloco[0]}x{tamanho_bloco[1]} (limite da tabela: {limite_tabela}, "
+                 f"{requisicoes_simultaneas} requisições simultâneas).")
+
+    # Monta todos os blocos antes de disparar as requisições
+    blocos = []
+    preparo = _preparar_pontos(pontos) if blocos_indices else None
+    for num_bloco, (origens, destinos) in enumerate(blocos_indices, start=1):
+        bloco = _preparar_bloco(preparo, origens, destinos)
+        if bloco is not None:
+            bloco['label'] = f"Bloco {num_bloco}/{total_requests} ({len(origens)}x{len(destinos)})"
+            blocos.append(bloco)
+    metadados['num_requisicoes'] = len(blocos)
+
+    # Blocos ignorados na validação (ou matriz toda no cache) contam como concluídos para o progresso
+    ignorados = completed_requests = total_requests - len(blocos)
+    if progress_callback and completed_requests:
+        progress_callback(completed_requests / total_requests)
+
+    executor = ThreadPoolExecutor(max_workers=requisicoes_simultaneas, thread_name_prefix="osrm_table")
+    try:
+        # Preenche as matrizes na thread chamadora, conforme os blocos ficam prontos
+        for bloco, partial_matrices_raw in _consultar_blocos(executor, url_base, blocos, metricas, preparo, limite_tabela, metadados):
+            completed_requests += 1
+            # Blocos recusados (TooBig) dão lugar às suas partes no total
+            total_requests = max(1, ignorados + metadados['num_requisicoes'] - metadados['blocos_recusados'])
+            request_label = f"{bloco['label']} (Req {completed_requests}/{total_requests})"
+
+            if partial_matrices_raw is None and estimar_blocos_falhos:
+                logging.warning(f"Sem resposta do OSRM para o {request_label}: usando a estimativa haversine neste bloco.")
+                _estimar_bloco_falho(bloco)
                 if progress_callback:
-                    progress_callback(request_count / total_requests)
-                # --- Fim Preenchimento ---
+                    progress_callback(completed_requests / total_requests)
+                continue
+            if partial_matrices_raw is None:
+                # O log de erro detalhado já acontece dentro de _get_osrm_table_batch
+                logging.error(f"Falha crítica ao obter dados do OSRM para o {request_label}. Abortando cálculo da matriz.")
+                return _resultado(None) # Aborta se a requisição falhar após retentativas
 
-        logging.info(f"Matriz de '{metrica}' ({final_matrix.shape}) calculada com sucesso usando lotes.")
-        return final_matrix
+            logging.info(f"Submatriz recebida: {request_label}")
+            preenchido = True
+            for metrica in metricas:
+                if not _preencher_bloco(matrizes[metrica], bloco, partial_matrices_raw[metrica], request_label):
+                    preenchido = False
+                    continue
+                if simetrica and fator_assimetria is None:
+                    _amostrar_pares_completos(matrizes[metrica], bloco['origens'], bloco['destinos'], amostras_assimetria[metrica])
+                if ids_cache is not None:
+                    try:
+                        submatriz = matrizes[metrica][np.ix_(bloco['origens'], bloco['destinos'])]
+                        salvar_pares_cache(ids_cache, bloco['origens'], bloco['destinos'], submatriz, metrica)
+                    except sqlite3.Error as e:
+                        logging.warning(f"Não foi possível gravar o bloco no cache de distâncias: {e}")
+            if simetrica and preenchido:
+                faltando[np.ix_(bloco['origens'], bloco['destinos'])] = False
+
+            # Atualiza progresso
+            if progress_callback:
+                progress_callback(completed_requests / total_requests)
+
+        logging.info(f"Matriz(es) de '{metadados['metrica']}' ({n}, {n}) calculada(s) com sucesso em {metadados['num_requisicoes']} requisições"
+                     f" ({len(metadados['blocos_estimados'])} bloco(s) estimado(s)).")
+        if simetrica:
+            _espelhar()
+        if ids_cache is not None and blocos:
+            try:
+                aplicar_limite_cache()
+            except sqlite3.Error as e:
+                logging.warning(f"Falha ao podar o cache de distâncias: {e}")
+        return _resultado(matrizes)
 
     except Exception as e:
         logging.error(f"Erro inesperado durante cálculo da matriz OSRM em lote: {e}")
         logging.error(traceback.format_exc()) # Log completo do traceback
-        return None
+        return _resultado(None)
+    finally:
+        # Em caso de falha, descarta os blocos que ainda não começaram
+        executor.shutdown(wait=True, cancel_futures=True)
+
+
+def calcular_matriz_distancias(pontos, provider="osrm", metrica="duration", progress_callback=None, requisicoes_simultaneas=None,
+                               retornar_metadados=False, usar_cache=True, arquivo_memmap=None, fallback="haversine",
+                               simetrica=False, fator_assimetria=None, usar_pre_calculo=True):
+    """
+    Calcula a matriz de distâncias ou tempos usando OSRM Table API em blocos,
+    validando coordenadas antes de cada requisição.
+
+    As requisições são dimensionadas pelo limite do servidor, feitas em paralelo e
+    aproveitam o cache persistente de pares (ver `_calcular_matrizes_osrm`).
+    Para obter tempos e distâncias juntos, use `calcular_matrizes_tempo_distancia`.
+
+    Args:
+        pontos (list): Lista de tuplas (latitude, longitude).
+        provider (str): "osrm" (padrão) ou "haversine" (estimativa vetorizada pela distância em linha reta,
+                        calibrada com pares do cache; sem requisições, para simulações rápidas).
+        metrica (str): "duration" (tempo em segundos) ou "distance" (distância em metros).
+        progress_callback (function, optional): Função para reportar progresso (recebe float 0.0 a 1.0).
+                                                É sempre chamada na thread que invocou esta função.
+        requisicoes_simultaneas (int, optional): Máximo de requisições OSRM em paralelo.
+                                                 Padrão: MAX_CONCURRENT_REQUESTS (1 = modo sequencial).
+        retornar_metadados (bool): Se True, retorna a tupla (matriz, metadados), com o limite de tabela,
+                                   tamanho de bloco, número de requisições, pares vindos do cache e tempo de cálculo.
+        usar_cache (bool): Se True, usa o cache persistente de pares (padrão).
+        arquivo_memmap (str, optional): Prefixo de caminho para gravar a matriz em '<prefixo>_<metrica>.npy'
+                                        mapeado em memória, em vez de mantê-la na RAM (instâncias grandes).
+        fallback (str, optional): "haversine" (padrão): blocos sem resposta do OSRM (retentativas esgotadas ou
+                                  circuito aberto) recebem a estimativa calibrada e, em último caso, a matriz
+                                  inteira. None devolve None se o OSRM falhar (ex.: pré-cálculo, que não deve
+                                  guardar estimativas). metadados['provider_usado'] indica qual motor gerou a matriz.
+        simetrica (bool): Se True, aproxima d(j,i) por d(i,j): consulta só um sentido de cada par (cerca de
+                          metade das requisições) e espelha o outro. Para simulações rápidas; não é exato em
+                          vias de mão única. metadados['assimetria'] traz o fator usado e o erro mediano amostrado.
+        fator_assimetria (float, optional): Fator aplicado aos valores espelhados abaixo da diagonal
+                                            (d(j,i) = d(i,j) x fator, j > i). Padrão: aprendido dos pares completos
+                                            dos blocos da diagonal (1.0 se houver poucos).
+        usar_pre_calculo (bool): Se True (padrão), recorta as linhas e colunas dos pontos que estão na matriz
+                                 pré-calculada da base de clientes (routing/pre_calculo.py), sem consultá-los.
+
+    Returns:
+        numpy.ndarray or None: Matriz NxN (int32) com os valores da métrica, ou None se ocorrer erro crítico.
+                               Retorna INFINITE_VALUE para pares impossíveis de rotear.
+    """
+    matrizes, metadados = _calcular_matrizes(pontos, (metrica,), provider=provider, progress_callback=progress_callback,
+                                             requisicoes_simultaneas=requisicoes_simultaneas, usar_cache=usar_cache,
+                                             arquivo_memmap=arquivo_memmap, fallback=fallback, simetrica=simetrica,
+                                             fator_assimetria=fator_assimetria, usar_pre_calculo=usar_pre_calculo)
+    matriz = matrizes[metrica] if matrizes is not None else None
+    return (matriz, metadados) if retornar_metadados else matriz
+
+
+def calcular_matrizes_tempo_distancia(pontos, provider="osrm", progress_callback=None, requisicoes_simultaneas=None,
+                                      retornar_metadados=False, usar_cache=True, arquivo_memmap=None, fallback="haversine",
+                                      simetrica=False, fator_assimetria=None, usar_pre_calculo=True):
+    """
+    Calcula as matrizes de tempo (s) e de distância (m) com uma única passada de requisições
+    (annotations=duration,distance), em vez de montar a matriz duas vezes.
+
+    Args:
+        Mesmos de `calcular_matriz_distancias`, exceto `metrica`.
+
+    Returns:
+        tuple: (matriz_tempos, matriz_distancias), ambas numpy.ndarray NxN (int32), ou (None, None) em caso de erro.
+               Com `retornar_metadados`, retorna (matriz_tempos, matriz_distancias, metadados).
+    """
+    matrizes, metadados = _calcular_matrizes(pontos, ("duration", "distance"), provider=provider, progress_callback=progress_callback,
+                                             requisicoes_simultaneas=requisicoes_simultaneas, usar_cache=usar_cache,
+                                             arquivo_memmap=arquivo_memmap, fallback=fallback, simetrica=simetrica,
+                                             fator_assimetria=fator_assimetria, usar_pre_calculo=usar_pre_calculo)
+    matriz_tempos = matrizes["duration"] if matrizes is not None else None
+    matriz_distancias = matrizes["distance"] if matrizes is not None else None
+    if retornar_metadados:
+        return matriz_tempos, matriz_distancias, metadados
+    return matriz_tempos, matriz_distancias
+
+def _indices_reaproveitados(pontos_antigos, pontos_novos):
+    """Para cada ponto novo, o índice de um ponto igual (coordenadas arredondadas) na lista antiga, ou -1."""
+    posicoes = {}
+    for i, (lat, lon) in enumerate(pontos_antigos):
+        if _is_valid_lat_lon(lat, lon):
+            posicoes.setdefault(_chave_coordenada(lat, lon), i)
+    return np.array([posicoes.get(_chave_coordenada(lat, lon), -1) if _is_valid_lat_lon(lat, lon) else -1
+                     for lat, lon in pontos_novos], dtype=np.int64)
+
+def _atualizar_matrizes(matrizes_antigas, pontos_antigos, pontos_novos, metricas, **kwargs):
+    """Núcleo de `atualizar_matriz_distancias` / `atualizar_matrizes_tempo_distancia`."""
+    if any(matriz is None or np.shape(matriz) != (len(pontos_antigos), len(pontos_antigos)) for matriz in matrizes_antigas.values()):
+        logging.warning("Matriz antiga ausente ou com dimensões diferentes da lista de pontos antiga. Calculando do zero.")
+        return _calcular_matrizes(pontos_novos, metricas, **kwargs)
+    indices_antigos = _indices_reaproveitados(pontos_antigos, pontos_novos)
+    logging.info(f"Atualização incremental: {int((indices_antigos >= 0).sum())} de {len(pontos_novos)} pontos reaproveitados "
+                 f"da matriz anterior ({len(pontos_antigos)} pontos).")
+    return _calcular_matrizes(pontos_novos, metricas, reaproveitar=(matrizes_antigas, indices_antigos), **kwargs)
+
+def atualizar_matriz_distancias(matriz_antiga, pontos_antigos, pontos_novos, metrica="duration", progress_callback=None,
+                                requisicoes_simultaneas=None, retornar_metadados=False, usar_cache=True, arquivo_memmap=None,
+                                fallback="haversine", simetrica=False, fator_assimetria=None):
+    """
+    Atualiza uma matriz já calculada quando pedidos entram ou saem da lista, sem recalcular tudo.
+
+    Os pontos de `pontos_novos` que já estavam em `pontos_antigos` (mesmas coordenadas) reaproveitam
+    suas linhas e colunas da matriz antiga; só os pares que envolvem pontos novos são buscados no
+    cache e no OSRM. Pontos removidos simplesmente não aparecem na nova matriz. Para 1.000 pontos
+    com 20 novos, isso dá cerca de 2 x 20 x 1.000 pares consultados em vez de 1.000.000.
+
+    Args:
+        matriz_antiga (numpy.ndarray): Matriz NxN calculada para `pontos_antigos`.
+        pontos_antigos (list): Lista de tuplas (latitude, longitude) da matriz antiga.
+        pontos_novos (list): Nova lista de tuplas (latitude, longitude), em qualquer ordem.
+        Demais: como em `calcular_matriz_distancias` (provider fixo em "osrm").
+
+    Returns:
+        numpy.ndarray or None: Matriz MxM para `pontos_novos` (com `retornar_metadados`, a tupla
+                               (matriz, metadados), onde metadados['pares_reaproveitados'] conta os pares copiados).
+    """
+    matrizes, metadados = _atualizar_matrizes({metrica: matriz_antiga}, pontos_antigos, pontos_novos, (metrica,),
+                                              progress_callback=progress_callback, requisicoes_simultaneas=requisicoes_simultaneas,
+                                              usar_cache=usar_cache, arquivo_memmap=arquivo_memmap, fallback=fallback,
+                                              simetrica=simetrica, fator_assimetria=fator_assimetria)
+    matriz = matrizes[metrica] if matrizes is not None else None
+    return (matriz, metadados) if retornar_metadados else matriz
+
+def atualizar_matrizes_tempo_distancia(matriz_tempos, matriz_distancias, pontos_antigos, pontos_novos, progress_callback=None,
+                                       requisicoes_simultaneas=None, retornar_metadados=False, usar_cache=True, arquivo_memmap=None,
+                                       fallback="haversine", simetrica=False, fator_assimetria=None):
+    """
+    Versão de `atualizar_matriz_distancias` para o par (tempos, distâncias), com uma única passada
+    de requisições para os pontos novos.
+
+    Returns:
+        tuple: (matriz_tempos, matriz_distancias) para `pontos_novos`, ou (None, None) em caso de erro.
+               Com `retornar_metadados`, retorna (matriz_tempos, matriz_distancias, metadados).
+    """
+    matrizes, metadados = _atualizar_matrizes({"duration": matriz_tempos, "distance": matriz_distancias}, pontos_antigos,
+                                              pontos_novos, ("duration", "distance"), progress_callback=progress_callback,
+                                              requisicoes_simultaneas=requisicoes_simultaneas, usar_cache=usar_cache,
+                                              arquivo_memmap=arquivo_memmap, fallback=fallback, simetrica=simetrica,
+                                              fator_assimetria=fator_assimetria)
+    matriz_tempos = matrizes["duration"] if matrizes is not None else None
+    matriz_distancias = matrizes["distance"] if matrizes is not None else None
+    if retornar_metadados:
+        return matriz_tempos, matriz_distancias, metadados
+    return matriz_tempos, matriz_distancias
+
+# --- Modo Esparso (k vizinhos mais próximos) ---
+class MatrizEsparsa:
+    """
+    Matriz NxN em que só os arcos entre vizinhos próximos vêm do OSRM; os demais são
+    estimados pela distância em linha reta calibrada. Guarda apenas os arcos exatos
+    (chaves origem*N+destino ordenadas) e as coordenadas.
+
+    Pode ser usada no lugar de um numpy.ndarray: `matriz[i, j]`, `matriz[i]`, `len(matriz)`
+    e `matriz.shape` funcionam sem montar a matriz inteira, e `np.asarray(matriz)`
+    (usado pelos solvers) monta e guarda a versão densa uma única vez.
+    """
+    def __init__(self, lat, lon, validos, chaves, valores, metrica, calibracao):
+        self.n = len(lat)
+        self.shape = (self.n, self.n)
+        self.dtype = np.dtype(MATRIX_DTYPE)
+        self.metrica = metrica
+        self.calibracao = calibracao
+        self._lat, self._lon, self._validos = lat, lon, validos
+        self._chaves = chaves
+        self._valores = valores
+        self._densa = None
+
+    @property
+    def num_arcos_exatos(self):
+        return len(self._chaves)
+
+    def __len__(self):
+        return self.n
+
+    def _estimar(self, origens, destinos):
+        return _estimar_bloco(self._lat, self._lon, self._validos, origens, destinos, self.metrica, self.calibracao)
+
+    def linha(self, i):
+        """Linha i completa (arcos exatos sobre a estimativa)."""
+        i = int(i) % self.n
+        valores = self._estimar([i], np.arange(self.n))[0]
+        inicio, fim = np.searchsorted(self._chaves, [i * self.n, (i + 1) * self.n])
+        valores[self._chaves[inicio:fim] - i * self.n] = self._valores[inicio:fim]
+        valores[i] = 0
+        return valores
+
+    def pares(self, origens, destinos):
+        """Valores dos arcos (origens[i], destinos[i]), sem montar linhas nem a matriz inteira."""
+        origens, destinos = np.asarray(origens, dtype=np.int64), np.asarray(destinos, dtype=np.int64)
+        if self._densa is not None:
+            return self._densa[origens, destinos]
+        valores = _estimar_bloco(self._lat, self._lon, self._validos, origens, destinos, self.metrica, self.calibracao, pares=True)
+        if len(self._chaves):
+            chaves = origens * self.n + destinos
+            pos = np.minimum(np.searchsorted(self._chaves, chaves), len(self._chaves) - 1)
+            exatos = self._chaves[pos] == chaves
+            valores[exatos] = self._valores[pos[exatos]]
+        valores[origens == destinos] = 0
+        return valores
+
+    def submatriz(self, indices):
+        """Submatriz densa indices x indices (ex.: depósito + pedidos de uma região), sem montar a matriz inteira."""
+        indices = np.asarray(indices, dtype=np.int64)
+        if self._densa is not None:
+            return np.asarray(self._densa[np.ix_(indices, indices)])
+        bloco = self._estimar(indices, indices)
+        # Arcos exatos com origem e destino entre os `indices`
+        ordem = np.argsort(indices)
+        ordenados = indices[ordem]
+        origens, destinos = self._chaves // self.n, self._chaves % self.n
+        dentro = np.isin(origens, ordenados) & np.isin(destinos, ordenados)
+        linhas = ordem[np.searchsorted(ordenados, origens[dentro])]
+        colunas = ordem[np.searchsorted(ordenados, destinos[dentro])]
+        bloco[linhas, colunas] = self._valores[dentro]
+        np.fill_diagonal(bloco, 0)
+        return bloco
+
+    def __getitem__(self, indice):
+        if self._densa is not None:
+            return self._densa[indice]
+        if isinstance(indice, (int, np.integer)):
+            return self.linha(indice)
+        if isinstance(indice, tuple) and len(indice) == 2 and all(isinstance(x, (int, np.integer)) for x in indice):
+            i, j = int(indice[0]) % self.n, int(indice[1]) % self.n
+            if i == j:
+                return MATRIX_DTYPE(0)
+            chave = i * self.n + j
+            pos = np.searchsorted(self._chaves, chave)
+            if pos < len(self._chaves) and self._chaves[pos] == chave:
+                return self._valores[pos]
+            return self._estimar([i], [j])[0, 0]
+        return np.asarray(self)[indice]
+
+    def densificar(self, arquivo_memmap=None, linhas_por_faixa=1024):
+        """Monta a matriz densa (int32), opcionalmente em um .npy mapeado em memória, e a guarda para os próximos usos."""
+        matriz = _alocar_matriz(self.n, arquivo_memmap)
+        todos = np.arange(self.n)
+        for inicio in range(0, self.n, linhas_por_faixa):
+            linhas = todos[inicio:inicio + linhas_por_faixa]
+            matriz[linhas, :] = self._estimar(linhas, todos)
+        matriz[self._chaves // self.n, self._chaves % self.n] = self._valores
+        np.fill_diagonal(matriz, 0)
+        self._densa = matriz
+        return matriz
+
+    def __array__(self, dtype=None, copy=None):
+        matriz = self._densa if self._densa is not None else self.densificar()
+        if dtype is not None and np.dtype(dtype) != matriz.dtype:
+            return matriz.astype(dtype)
+        return matriz
+
+def _ordem_espacial(lat, lon, bits=16):
+    """Ordena os pontos pela curva Z (Morton), para que índices vizinhos fiquem próximos no mapa."""
+    def _quantizar(v):
+        amplitude = max(float(np.ptp(v)), 1e-12) if len(v) else 1.0
+        return ((v - v.min()) / amplitude * (2 ** bits - 1)).astype(np.uint64)
+    x, y = _quantizar(lon), _quantizar(lat)
+    chave = np.zeros(len(lat), dtype=np.uint64)
+    for b in range(bits):
+        chave |= ((x >> b) & 1) << (2 * b)
+        chave |= ((y >> b) & 1) << (2 * b + 1)
+    return np.argsort(chave, kind="stable")
+
+def _grupos_vizinhanca(lat, lon, validos, k_vizinhos, tamanho_grupo):
+    """
+    Agrupa as origens válidas em faixas contíguas da curva Z e, para cada grupo, reúne os
+    destinos candidatos: os k vizinhos de cada origem (BallTree) e os pontos que têm a
+    origem entre os seus k vizinhos (arcos de volta).
+
+    Returns:
+        list: pares (origens, destinos) de índices globais.
+    """
+    indices_validos = np.flatnonzero(validos)
+    m = len(indices_validos)
+    k = min(k_vizinhos, m - 1)
+    if k < 1:
+        return []
+    coords_rad = np.radians(np.column_stack([lat[indices_validos], lon[indices_validos]]))
+    _, vizinhos = BallTree(coords_rad, metric="haversine").query(coords_rad, k=k + 1)
+    origem_arcos = np.repeat(np.arange(m), k + 1)
+    destino_arcos = vizinhos.ravel()
+    origem_arcos, destino_arcos = np.concatenate([origem_arcos, destino_arcos]), np.concatenate([destino_arcos, origem_arcos])
+
+    ordem = _ordem_espacial(lat[indices_validos], lon[indices_validos])
+    grupo_de = np.empty(m, dtype=np.int64)
+    grupo_de[ordem] = np.arange(m) // tamanho_grupo
+    grupo_arcos = grupo_de[origem_arcos]
+    por_grupo = np.argsort(grupo_arcos, kind="stable")
+    limites = np.searchsorted(grupo_arcos[por_grupo], np.arange(grupo_de.max() + 2))
+
+    grupos = []
+    for g in range(len(limites) - 1):
+        origens = indices_validos[ordem[g * tamanho_grupo:(g + 1) * tamanho_grupo]]
+        destinos = indices_validos[np.unique(destino_arcos[por_grupo[limites[g]:limites[g + 1]]])]
+        grupos.append((np.sort(origens).tolist(), destinos.tolist()))
+    return grupos
+
+def calcular_matrizes_esparsas(pontos, metricas=("duration", "distance"), k_vizinhos=DEFAULT_K_VIZINHOS, progress_callback=None,
+                               requisicoes_simultaneas=None, usar_cache=True, retornar_metadados=False, fallback="haversine"):
+    """
+    Modo esparso para instâncias grandes (milhares de pontos), onde a matriz completa exigiria
+    O(N²) consultas ao OSRM.
+
+    Para cada ponto, escolhe os `k_vizinhos` mais próximos com uma BallTree sobre as coordenadas
+    e consulta no OSRM apenas os arcos entre esses vizinhos (agrupados em blocos de pontos
+    próximos). Os demais arcos são estimados pela distância em linha reta, calibrada com os
+    próprios arcos exatos consultados. Os arcos consultados são gravados no cache persistente.
+
+    Args:
+        pontos (list): Lista de tuplas (latitude, longitude).
+        metricas (tuple): Métricas desejadas ("duration" e/ou "distance").
+        k_vizinhos (int): Número de vizinhos por ponto com arcos exatos.
+        progress_callback, requisicoes_simultaneas, usar_cache, retornar_metadados, fallback:
+            Como em `calcular_matriz_distancias`. Com fallback="haversine" (padrão), os arcos de
+            blocos sem resposta do OSRM ficam com a estimativa (e, em último caso, a matriz inteira).
+
+    Returns:
+        dict or None: {metrica: MatrizEsparsa}, ou None em caso de erro crítico.
+                      Com `retornar_metadados`, retorna a tupla (matrizes, metadados).
+    """
+    metricas = tuple(metricas)
+    if not metricas or any(m not in ["duration", "distance"] for m in metricas):
+        raise ValueError("Métrica deve ser 'duration' ou 'distance'.")
+    if fallback not in (None, "haversine"):
+        raise ValueError("fallback deve ser None ou 'haversine'.")
+    if requisicoes_simultaneas is None:
+        requisicoes_simultaneas = MAX_CONCURRENT_REQUESTS
+    requisicoes_simultaneas = max(1, int(requisicoes_simultaneas))
+    inicio = time.time()
+    n = len(pontos)
+    lat, lon, validos = _coordenadas_array(pontos)
+
+    metadados = {
+        'provider': "osrm",
+        'modo': "esparso",
+        'metrica': ",".join(metricas),
+        'n_pontos': n,
+        'k_vizinhos': k_vizinhos,
+        'limite_tabela': None,
+        'num_requisicoes': 0,
+        'blocos_recusados': 0,
+        'requisicoes_simultaneas': requisicoes_simultaneas,
+        'arcos_exatos': 0,
+        'blocos_estimados': [],
+        'provider_usado': "osrm",
+        'tempo_s': None,
+    }
+
+    def _resultado(chaves, valores, calibracao):
+        matrizes = {m: MatrizEsparsa(lat, lon, validos, chaves, valores[m], m, calibracao) for m in metricas}
+        metadados['arcos_exatos'] = len(chaves)
+        metadados['calibracao'] = calibracao
+        metadados['tempo_s'] = round(time.time() - inicio, 3)
+        return (matrizes, metadados) if retornar_metadados else matrizes
+
+    def _falha():
+        if fallback == "haversine":
+            logging.warning("OSRM indisponível ou com falha: usando só a estimativa haversine calibrada no modo esparso.")
+            metadados['provider_usado'] = "haversine"
+            vazio = np.array([], dtype=np.int64)
+            return _resultado(vazio, {m: np.array([], dtype=MATRIX_DTYPE) for m in metricas}, calibrar_estimativa())
+        metadados['tempo_s'] = round(time.time() - inicio, 3)
+        return (None, metadados) if retornar_metadados else None
+
+    # --- Planejamento: grupos de origens próximas x destinos candidatos, divididos pelo limite do servidor ---
+    ponto_referencia = next((p for p, v in zip(pontos, validos) if v), None)
+    limite_tabela = detectar_limite_tabela(ponto_referencia) if ponto_referencia is not None else DEFAULT_MAX_TABLE_SIZE
+    metadados['limite_tabela'] = limite_tabela
+    tamanho_grupo = max(1, min(limite_tabela, _max_coords_por_url() // 2))
+    blocos = []
+    preparo = _preparar_pontos(pontos)
+    for origens, destinos in _grupos_vizinhanca(lat, lon, validos, k_vizinhos, tamanho_grupo):
+        for origens_bloco, destinos_bloco in _planejar_blocos(origens, destinos, limite_tabela)[0]:
+            bloco = _preparar_bloco(preparo, origens_bloco, destinos_bloco)
+            if bloco is not None:
+                blocos.append(bloco)
+    metadados['num_requisicoes'] = len(blocos)
+    logging.info(f"Modo esparso: {n} pontos, {k_vizinhos} vizinhos por ponto, {len(blocos)} requisições "
+                 f"(limite da tabela: {limite_tabela}, {requisicoes_simultaneas} requisições simultâneas).")
+
+    ids_cache = None
+    if usar_cache and blocos:
+        try:
+            with _cache_lock:
+                conn = _get_cache_connection()
+                ids_cache = _ids_pontos_cache(conn, pontos)
+                conn.commit()
+        except sqlite3.Error as e:
+            logging.warning(f"Cache de distâncias indisponível ({e}). Os arcos consultados não serão gravados.")
+
+    # Sempre pede as duas anotações: a calibração da estimativa usa distância e tempo
+    metricas_osrm = ("duration", "distance")
+    url_base = f"{OSRM_SERVER_URL}/table/v1/{OSRM_PROFILE}/"
+    partes_chaves, partes_valores = [], {m: [] for m in metricas_osrm}
+    executor = ThreadPoolExecutor(max_workers=requisicoes_simultaneas, thread_name_prefix="osrm_table")
+    try:
+        consultas = _consultar_blocos(executor, url_base, blocos, metricas_osrm, preparo, limite_tabela, metadados)
+        for concluidos, (bloco, resposta) in enumerate(consultas, start=1):
+            if resposta is None and fallback == "haversine":
+                # Os arcos do bloco simplesmente ficam com a estimativa (e fora do cache)
+                logging.warning(f"Sem resposta do OSRM para um bloco {len(bloco['origens'])}x{len(bloco['destinos'])} no modo esparso: "
+                                f"seus arcos ficam com a estimativa haversine.")
+                metadados['blocos_estimados'].append((len(bloco['origens']), len(bloco['destinos'])))
+                continue
+            if resposta is None:
+                logging.error(f"Falha crítica ao obter dados do OSRM no modo esparso (bloco {len(bloco['origens'])}x{len(bloco['destinos'])}).")
+                return _falha()
+            origens, destinos = bloco['origens'], bloco['destinos']
+            for metrica in metricas_osrm:
+                # OSRM retorna null (nan) para rotas impossíveis
+                submatriz = np.array(resposta[metrica], dtype=float)
+                if submatriz.shape != (len(origens), len(destinos)):
+                    logging.error(f"Erro: Dimensões da matriz OSRM {submatriz.shape} não correspondem ao bloco "
+                                  f"({len(origens)}x{len(destinos)}) no modo esparso.")
+                    return _falha()
+                submatriz = np.where(np.isnan(submatriz), INFINITE_VALUE, submatriz).astype(MATRIX_DTYPE)
+                partes_valores[metrica].append(submatriz.ravel())
+                if ids_cache is not None:
+                    try:
+                        salvar_pares_cache(ids_cache, bloco['origens'], bloco['destinos'], submatriz, metrica)
+                    except sqlite3.Error as e:
+                        logging.warning(f"Não foi possível gravar o bloco no cache de distâncias: {e}")
+            partes_chaves.append((origens[:, None] * n + destinos[None, :]).ravel())
+            if progress_callback:
+                progress_callback(concluidos / (metadados['num_requisicoes'] - metadados['blocos_recusados']))
+    except Exception as e:
+        logging.error(f"Erro inesperado durante cálculo da matriz esparsa: {e}")
+        logging.error(traceback.format_exc())
+        return _falha()
+    finally:
+        executor.shutdown(wait=True, cancel_futures=True)
+
+    if ids_cache is not None and blocos:
+        try:
+            aplicar_limite_cache()
+        except sqlite3.Error as e:
+            logging.warning(f"Falha ao podar o cache de distâncias: {e}")
+
+    chaves = np.concatenate(partes_chaves) if partes_chaves else np.array([], dtype=np.int64)
+    ordem = np.argsort(chaves, kind="stable")
+    chaves = chaves[ordem]
+    valores = {m: np.concatenate(partes_valores[m])[ordem] if partes_chaves else np.array([], dtype=MATRIX_DTYPE)
+               for m in metricas_osrm}
+
+    # Calibra a estimativa com os arcos exatos desta instância (mesma região e horário)
+    linha_reta = _haversine_m(lat[chaves // n], lon[chaves // n], lat[chaves % n], lon[chaves % n]) if len(chaves) else np.array([])
+    calibracao = _ajustar_calibracao(linha_reta, valores["distance"].astype(float), valores["duration"].astype(float)) \
+        or calibrar_estimativa()
+    logging.info(f"Modo esparso: {len(chaves)} arcos exatos de {n * (n - 1)} ({len(chaves) / max(1, n * (n - 1)):.1%}); "
+                 f"fator de circuito {calibracao['fator_circuito']:.3f}, velocidade {calibracao['velocidade_mps'] * 3.6:.1f} km/h.")
+    return _resultado(chaves, valores, calibracao)
+# --- Fim Modo Esparso ---
+
 
 def calcular_distancia(ponto_a, ponto_b, provider="osrm", metrica="duration"):
     """
@@ -305,7 +1699,7 @@ def calcular_distancia(ponto_a, ponto_b, provider="osrm", metrica="duration"):
 
     try:
         logging.info(f"Consultando OSRM Route API: {url}")
-        response = requests.get(url, params=params, timeout=30) # Timeout de 30s
+        response = osrm_get(url, params=params, timeout=30) # Timeout de 30s
         response.raise_for_status()
         data = response.json()
 
@@ -0,0 +1,342 @@
+"""
+Funções comuns aos solvers OR-Tools (cvrp.py, cvrp_flex.py).
+
+Os custos dos arcos e as demandas são registrados como trânsitos nativos do OR-Tools
+(matriz e vetor guardados em C++), em vez de callbacks Python: a busca local chama o
+trânsito milhões de vezes, e cada chamada a um callback Python atravessa a fronteira
+C++/Python e disputa o GIL. Com trânsitos nativos, a busca roda inteira em C++ e faz
+muito mais iterações dentro do mesmo limite de tempo.
+"""
+import os
+import time
+import logging
+
+import numpy as np
+import pandas as pd
+from ortools.constraint_solver import routing_enums_pb2
+
+# Acima deste número de nós, a matriz continua num callback Python: RegisterTransitMatrix só
+# aceita lista de listas, e a conversão de N² inteiros Python custaria memória demais
+LIMITE_MATRIZ_NATIVA = int(os.environ.get("WAZELOG_LIMITE_MATRIZ_NATIVA", "2500"))
+# Limite de tempo da busca quando ela parte de rotas anteriores (warm start) em vez de PATH_CHEAPEST_ARC
+TEMPO_LIMITE_WARM_START_S = int(os.environ.get("WAZELOG_TEMPO_WARM_START", "5"))
+# Abaixo desta fração de pedidos reconhecidos nas rotas anteriores, não vale a pena partir delas
+FRACAO_MINIMA_WARM_START = 0.5
+# Limite de tempo adaptativo: cresce com nós e veículos, entre o mínimo e o máximo
+TEMPO_LIMITE_MIN_S = 2
+TEMPO_LIMITE_MAX_S = int(os.environ.get("WAZELOG_TEMPO_LIMITE_MAX", "120"))
+SEGUNDOS_POR_NO = 0.05
+VEICULOS_REFERENCIA = 20 # A cada VEICULOS_REFERENCIA veículos, o tempo por nó dobra
+# Parada antecipada: encerra a busca quando o objetivo não melhora há tanto tempo. Sem a variável de
+# ambiente, a janela é FRACAO_JANELA_SEM_MELHORIA do limite de tempo (no mínimo 1 s)
+JANELA_SEM_MELHORIA_S = float(os.environ["WAZELOG_JANELA_SEM_MELHORIA"]) if os.environ.get("WAZELOG_JANELA_SEM_MELHORIA") else None
+FRACAO_JANELA_SEM_MELHORIA = 0.25
+
+
+def registrar_transito_matriz(routing, manager, matriz):
+    """
+    Registra a matriz NxN (indexada por nó) como trânsito do modelo.
+
+    Args:
+        routing (pywrapcp.RoutingModel): Modelo.
+        manager (pywrapcp.RoutingIndexManager): Gerenciador de índices do modelo.
+        matriz (array-like): Matriz de custos inteiros entre os nós (ndarray, memmap ou MatrizEsparsa).
+
+    Returns:
+        int: Índice do trânsito registrado (para SetArcCostEvaluatorOfAllVehicles / AddDimension).
+    """
+    matriz = np.asarray(matriz)
+    if len(matriz) <= LIMITE_MATRIZ_NATIVA:
+        # Conversão única para inteiros Python; o OR-Tools copia a matriz para C++
+        return routing.RegisterTransitMatrix(matriz.astype(np.int64).tolist())
+
+    logging.info(f"Matriz com {len(matriz)} nós acima de LIMITE_MATRIZ_NATIVA ({LIMITE_MATRIZ_NATIVA}): usando callback Python.")
+    def distance_callback(from_index, to_index):
+        return int(matriz[manager.IndexToNode(from_index), manager.IndexToNode(to_index)])
+    return routing.RegisterTransitCallback(distance_callback)
+
+
+def registrar_transito_unario(routing, valores):
+    """Registra um valor por nó (ex.: demanda) como trânsito unário nativo. Retorna o índice do trânsito."""
+    return routing.RegisterUnaryTransitVector([int(valor) for valor in valores])
+
+
+def dimensoes_capacidade(pedidos, frota):
+    """
+    Dimensões de capacidade do modelo: lista de (nome, demanda de cada nó com 0 no depósito, capacidade de cada veículo).
+
+    Peso ('Peso dos Itens' x 'Capacidade (Kg)') e caixas ('Qtde. dos Itens' x 'Capacidade (Cx)') entram juntos
+    quando pedidos e frota têm as colunas dos dois, para que uma rota não estoure as caixas de um caminhão que
+    ainda tem peso sobrando. Na dimensão de caixas, veículo sem 'Capacidade (Cx)' cadastrada (vazia ou 0) não é
+    limitado por caixas. Sem os dois pares, usa a coluna de demanda e a de capacidade que existirem.
+    A primeira dimensão se chama sempre 'Capacity'.
+    """
+    def _demandas(coluna):
+        return [0] + pd.to_numeric(pedidos[coluna], errors='coerce').fillna(1).astype(int).tolist()
+
+    def _capacidades(coluna):
+        return pd.to_numeric(frota[coluna], errors='coerce').fillna(1).astype(int).clip(lower=1).tolist()
+
+    if {'Peso dos Itens', 'Qtde. dos Itens'}.issubset(pedidos.columns) and {'Capacidade (Kg)', 'Capacidade (Cx)'}.issubset(frota.columns):
+        demandas_cx = _demandas('Qtde. dos Itens')
+        capacidades_cx = pd.to_numeric(frota['Capacidade (Cx)'], errors='coerce')
+        capacidades_cx = capacidades_cx.where(capacidades_cx > 0, max(sum(demandas_cx), 1)).astype(int).tolist()
+        return [('Capacity', _demandas('Peso dos Itens'), _capacidades('Capacidade (Kg)')),
+                ('Capacity_Cx', demandas_cx, capacidades_cx)]
+
+    if 'Peso dos Itens' in pedidos.columns and 'Capacidade (Kg)' in frota.columns:
+        return [('Capacity', _demandas('Peso dos Itens'), _capacidades('Capacidade (Kg)'))]
+    if 'Qtde. dos Itens' in pedidos.columns and 'Capacidade (Cx)' in frota.columns:
+        return [('Capacity', _demandas('Qtde. dos Itens'), _capacidades('Capacidade (Cx)'))]
+
+    coluna_demanda = next((c for c in ('Peso dos Itens', 'Qtde. dos Itens') if c in pedidos.columns), None)
+    if coluna_demanda:
+        demandas = _demandas(coluna_demanda)
+    else:
+        logging.warning("Coluna de demanda ('Peso dos Itens' ou 'Qtde. dos Itens') não encontrada. Usando demanda 1 para todos.")
+        demandas = [0] + [1] * len(pedidos)
+    coluna_capacidade = next((c for c in ('Capacidade (Kg)', 'Capacidade (Cx)') if c in frota.columns), None)
+    if coluna_capacidade:
+        capacidades = _capacidades(coluna_capacidade)
+    else:
+        logging.warning("Coluna de capacidade ('Capacidade (Kg)' ou 'Capacidade (Cx)') não encontrada. Usando capacidade 1000 para todos.")
+        capacidades = [1000] * len(frota)
+    return [('Capacity', demandas, capacidades)]
+
+
+def registrar_dimensoes_capacidade(routing, dimensoes):
+    """Adiciona cada dimensão de `dimensoes_capacidade` ao modelo, com a demanda como trânsito unário nativo."""
+    for nome, demandas, capacidades in dimensoes:
+        routing.AddDimensionWithVehicleCapacity(registrar_transito_unario(routing, demandas), 0, capacidades, True, nome)
+
+
+def tempo_limite_adaptativo(n_nos, n_veiculos):
+    """Limite de tempo da busca (s): SEGUNDOS_POR_NO por nó, ampliado pelo número de veículos, entre TEMPO_LIMITE_MIN_S e TEMPO_LIMITE_MAX_S."""
+    tempo = SEGUNDOS_POR_NO * n_nos * (1 + n_veiculos / VEICULOS_REFERENCIA)
+    return round(float(min(TEMPO_LIMITE_MAX_S, max(TEMPO_LIMITE_MIN_S, tempo))), 1)
+
+
+def janela_sem_melhoria(tempo_limite_s, janela_s=None):
+    """Janela da parada antecipada: `janela_s` se informada (0 desliga), senão JANELA_SEM_MELHORIA_S, senão uma fração do limite."""
+    if janela_s is not None:
+        return janela_s
+    if JANELA_SEM_MELHORIA_S is not None:
+        return JANELA_SEM_MELHORIA_S
+    return max(1.0, tempo_limite_s * FRACAO_JANELA_SEM_MELHORIA)
+
+
+class MonitorMelhoria:
+    """
+    Callback de solução (routing.AddAtSolutionCallback) que registra cada melhora do objetivo e encerra
+    a busca quando ele não melhora há `janela_s` segundos (None ou 0: só registra).
+
+    A verificação acontece a cada solução aceita pela busca; com metaheurística isso ocorre várias
+    vezes por segundo, então a parada fica próxima da janela.
+
+    `ao_melhorar` recebe, a cada nova melhor solução, um dict com 'objetivo', 'veiculos' (veículos
+    usados), 'tempo_s' e, com `incluir_rotas`, 'rotas' (lista de nós de cada veículo, sem o depósito).
+    `deve_parar` é consultado a cada solução: se retornar True, a busca termina com a melhor solução
+    até ali (ex.: o operador achou o plano bom o bastante). O OR-Tools descarta exceções levantadas
+    dentro do callback, então elas encerram a busca e são relançadas por `relancar_erro`.
+    """
+
+    def __init__(self, routing, janela_s=None, ao_melhorar=None, deve_parar=None, incluir_rotas=False, manager=None):
+        self.routing = routing
+        self.manager = manager
+        self.janela_s = janela_s
+        self.ao_melhorar = ao_melhorar
+        self.deve_parar = deve_parar
+        self.incluir_rotas = incluir_rotas
+        self.inicio = time.time()
+        self.melhorias = [] # (instante, custo) de cada solução melhor que as anteriores
+        self.solucoes = 0
+        self.parada_antecipada = False
+        self.parada_solicitada = False
+        self.erro = None
+
+    def __call__(self):
+        try:
+            self._registrar()
+        except BaseException as e: # Inclui as exceções de controle do Streamlit (botão Stop, rerun)
+            self.erro = e
+            self.routing.solver().FinishCurrentSearch()
+
+    def _registrar(self):
+        self.solucoes += 1
+        agora = time.time() - self.inicio
+        custo = self.routing.CostVar().Value()
+        if not self.melhorias or custo < self.melhorias[-1][1]:
+            self.melhorias.append((agora, custo))
+            if self.ao_melhorar is not None:
+                self.ao_melhorar(self._evento(agora, custo))
+        elif self.janela_s and agora - self.melhorias[-1][0] > self.janela_s and not self.parada_antecipada:
+            logging.info(f"Busca encerrada: objetivo sem melhora há {agora - self.melhorias[-1][0]:.1f}s (custo {self.melhorias[-1][1]}).")
+            self.parada_antecipada = True
+            self.routing.solver().FinishCurrentSearch()
+        if self.deve_parar is not None and not self.parada_solicitada and self.deve_parar():
+            logging.info(f"Busca encerrada a pedido do usuário (custo {self.melhorias[-1][1]}).")
+            self.parada_solicitada = True
+            self.routing.solver().FinishCurrentSearch()
+
+    def _evento(self, agora, custo):
+        """Dados da solução atual para `ao_melhorar` (lidos das variáveis do modelo, que estão fixadas no callback)."""
+        routing = self.routing
+        rotas = []
+        for v in range(routing.vehicles()):
+            index = routing.NextVar(routing.Start(v)).Value()
+            rota = []
+            while not routing.IsEnd(index):
+                rota.append(self.manager.IndexToNode(index) if self.manager is not None else index)
+                if not self.incluir_rotas:
+                    break # Para contar os veículos basta saber se a rota tem alguma parada
+                index = routing.NextVar(index).Value()
+            rotas.append(rota)
+        evento = {'objetivo': custo, 'veiculos': sum(1 for rota in rotas if rota), 'tempo_s': round(agora, 3)}
+        if self.incluir_rotas:
+            evento['rotas'] = rotas
+        return evento
+
+    def relancar_erro(self):
+        """Relança a exceção capturada dentro do callback (se houve), depois que a busca terminou."""
+        if self.erro is not None:
+            raise self.erro
+
+    @property
+    def tempo_melhor_s(self):
+        """Instante (s) em que a melhor solução apareceu, ou None."""
+        return round(self.melhorias[-1][0], 3) if self.melhorias else None
+
+
+def extrair_paradas(routing, manager, solution):
+    """
+    Percorre as rotas da solução e devolve arrays inteiros com uma posição por parada (sem o depósito),
+    em ordem de veículo e de visita: (veículo, sequência a partir de 1, nó, próximo nó).
+    O próximo nó da última parada é o depósito.
+
+    O laço só lê os nós; colunas e custos são montados depois, de uma vez, sobre os arrays
+    (montar DataFrame linha a linha custava segundos com alguns milhares de paradas).
+    """
+    veiculos, nos = [], []
+    for v in range(routing.vehicles()):
+        index = solution.Value(routing.NextVar(routing.Start(v)))
+        while not routing.IsEnd(index):
+            veiculos.append(v)
+            nos.append(manager.IndexToNode(index))
+            index = solution.Value(routing.NextVar(index))
+    veiculos = np.array(veiculos, dtype=np.int64)
+    nos = np.array(nos, dtype=np.int64)
+    inicio_rota = np.searchsorted(veiculos, veiculos) # Posição da primeira parada do veículo de cada parada
+    sequencias = np.arange(len(nos)) - inicio_rota + 1
+    deposito = manager.IndexToNode(routing.End(0))
+    ultima = np.diff(veiculos, append=-1) != 0 # Última parada de cada rota
+    proximos = np.where(ultima, deposito, np.append(nos[1:], deposito))
+    return veiculos, sequencias, nos, proximos
+
+
+def nome_status(routing):
+    """Nome do status da última resolução (ex.: 'ROUTING_FAIL_TIMEOUT')."""
+    try:
+        return routing_enums_pb2.RoutingSearchStatus.Value.Name(routing.status())
+    except ValueError:
+        return 'UNKNOWN'
+
+
+def _chaves_pedidos(rotas, pedidos):
+    """
+    Nó atual (pedido i = nó i + 1) de cada parada das rotas anteriores, ou None se o pedido não existe mais.
+    Casa pelo 'ID Pedido' (se os pedidos tiverem essa coluna), senão pelas coordenadas, senão pelo Node_Index_OR.
+    """
+    n = len(pedidos)
+    if 'ID Pedido' in pedidos.columns and 'ID Pedido' in rotas.columns:
+        # IDs numéricos podem voltar como float nas rotas (linha de DataFrame com colunas mistas): '123.0' -> '123'
+        def _ids(df):
+            return df['ID Pedido'].astype(str).str.replace(r'\.0$', '', regex=True).tolist()
+        chaves_pedidos, chaves_rotas = _ids(pedidos), _ids(rotas)
+    elif all(coluna in df.columns for df in (pedidos, rotas) for coluna in ('Latitude', 'Longitude')):
+        def _coordenadas(df):
+            lat = pd.to_numeric(df['Latitude'], errors='coerce').round(5)
+            lon = pd.to_numeric(df['Longitude'], errors='coerce').round(5)
+            return list(zip(lat, lon))
+        chaves_pedidos, chaves_rotas = _coordenadas(pedidos), _coordenadas(rotas)
+    else:
+        nos = pd.to_numeric(rotas['Node_Index_OR'], errors='coerce')
+        return [int(no) if pd.notna(no) and 1 <= no <= n else None for no in nos]
+
+    # Um para um: pedidos com a mesma chave (ex.: mesmo endereço) são consumidos em ordem
+    nos_por_chave = {}
+    for i, chave in enumerate(chaves_pedidos):
+        nos_por_chave.setdefault(chave, []).append(i + 1)
+    return [nos_por_chave[chave].pop(0) if nos_por_chave.get(chave) else None for chave in chaves_rotas]
+
+
+def montar_rotas_iniciais(rotas_anteriores, pedidos, veiculos, dimensoes, matriz):
+    """
+    Converte rotas de uma roteirização anterior (DataFrame com 'Veículo', 'Sequencia' e 'Node_Index_OR',
+    como as de solver_cvrp, dos cenários salvos ou de data/Roteirizacao.csv) em rotas iniciais para
+    RoutingModel.ReadAssignmentFromRoutes.
+
+    Paradas de pedidos ou veículos que não existem mais são descartadas, paradas que passariam da
+    capacidade ficam de fora e os pedidos fora das rotas anteriores entram na posição de menor custo.
+
+    Args:
+        rotas_anteriores (pd.DataFrame): Rotas anteriores.
+        pedidos (pd.DataFrame): Pedidos atuais (o pedido i corresponde ao nó i + 1).
+        veiculos (list): Identificador de cada veículo atual (como na coluna 'Veículo').
+        dimensoes (list): Dimensões de capacidade, como em `dimensoes_capacidade`.
+        matriz (np.ndarray): Matriz de custos entre os nós.
+
+    Returns:
+        list or None: Uma lista de nós (sem o depósito) por veículo, ou None se as rotas anteriores não servirem.
+    """
+    if rotas_anteriores is None or rotas_anteriores.empty or \
+            not {'Veículo', 'Sequencia'}.issubset(rotas_anteriores.columns) or \
+            not ({'Node_Index_OR', 'ID Pedido', 'Latitude'} & set(rotas_anteriores.columns)):
+        logging.info("Warm start: rotas anteriores vazias ou sem as colunas 'Veículo', 'Sequencia' e 'Node_Index_OR'.")
+        return None
+    rotas_anteriores = rotas_anteriores.assign(_no=_chaves_pedidos(rotas_anteriores, pedidos))
+    rotas_anteriores = rotas_anteriores.sort_values(['Veículo', 'Sequencia'], kind='stable')
+    indice_veiculo = {}
+    for v, identificador in enumerate(veiculos):
+        indice_veiculo.setdefault(str(identificador), v)
+
+    rotas = [[] for _ in veiculos]
+    demandas = np.array([demandas for _, demandas, _ in dimensoes], dtype=np.int64) # dimensões x nós
+    capacidades = np.array([capacidades for _, _, capacidades in dimensoes], dtype=np.int64) # dimensões x veículos
+    carga = np.zeros_like(capacidades)
+    atribuidos = set()
+    for identificador, rota in rotas_anteriores.groupby('Veículo', sort=False):
+        v = indice_veiculo.get(str(identificador))
+        if v is None:
+            continue
+        for no in rota['_no']:
+            if no is None or pd.isna(no) or int(no) in atribuidos or (carga[:, v] + demandas[:, int(no)] > capacidades[:, v]).any():
+                continue
+            rotas[v].append(int(no))
+            carga[:, v] += demandas[:, int(no)]
+            atribuidos.add(int(no))
+
+    n = len(pedidos)
+    if len(atribuidos) < n * FRACAO_MINIMA_WARM_START:
+        logging.info(f"Warm start: só {len(atribuidos)} de {n} pedidos estão nas rotas anteriores; usando a busca completa.")
+        return None
+
+    # Inserção mais barata dos pedidos novos (os maiores primeiro, enquanto há mais espaço)
+    faltando = sorted(set(range(1, n + 1)) - atribuidos, key=lambda no: -demandas[0, no])
+    for no in faltando:
+        melhor = None
+        for v, rota in enumerate(rotas):
+            if (carga[:, v] + demandas[:, no] > capacidades[:, v]).any():
+                continue
+            nos = np.array([0] + rota + [0])
+            custo = matriz[nos[:-1], no].astype(np.int64) + matriz[no, nos[1:]] - matriz[nos[:-1], nos[1:]]
+            posicao = int(np.argmin(custo))
+            if melhor is None or custo[posicao] < melhor[0]:
+                melhor = (custo[posicao], v, posicao)
+        if melhor is None:
+            logging.info(f"Warm start: o pedido do nó {no} não cabe em nenhuma rota anterior; usando a busca completa.")
+            return None
+        _, v, posicao = melhor
+        rotas[v].insert(posicao, no)
+        carga[:, v] += demandas[:, no]
+    logging.info(f"Warm start: {len(atribuidos)} pedidos mantidos das rotas anteriores e {len(faltando)} inseridos.")
+    return rotas
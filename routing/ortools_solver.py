@@ -1,4 +1,3 @@
-from .vrp import solver_vrp
 from .cvrp import solver_cvrp
+from .cvrp_flex import solver_cvrp_flex
 from .vrptw import solver_vrptw
-from .tsp import solver_tsp
@@ -0,0 +1,191 @@
+"""
+Cliente HTTP compartilhado para o OSRM.
+
+Todas as chamadas ao OSRM (Table API em distancias.py, Route API nos mapas) passam
+por uma única requests.Session com pool de conexões keep-alive e compressão gzip,
+em vez de abrir uma conexão TCP nova a cada requests.get. O número de requisições
+simultâneas por servidor é limitado por um semáforo, e um disjuntor (circuit breaker)
+por servidor evita insistir em um OSRM fora do ar.
+"""
+import os
+import time
+import random
+import threading
+import logging
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+
+# --- Constantes ---
+# Use a variável de ambiente OSRM_BASE_URL se definida, senão usa localhost:5000
+OSRM_SERVER_URL = os.environ.get("OSRM_BASE_URL", "http://localhost:5000")
+# Máximo de requisições em andamento (e de conexões mantidas abertas) por servidor
+MAX_CONEXOES_POR_HOST = int(os.environ.get("OSRM_MAX_CONCURRENT", "8"))
+MAX_HOSTS_NO_POOL = 4 # Servidores distintos com conexões guardadas no pool
+# Retentativas: espera exponencial com jitter, de RETRY_BASE_DELAY até no máximo RETRY_MAX_DELAY segundos
+RETRY_BASE_DELAY = float(os.environ.get("OSRM_RETRY_BASE_DELAY", "0.5"))
+RETRY_MAX_DELAY = 15
+# Disjuntor: abre após N falhas seguidas (conexão, timeout ou 5xx) e fica aberto por alguns segundos
+CIRCUITO_FALHAS_PARA_ABRIR = int(os.environ.get("OSRM_CIRCUITO_FALHAS", "5"))
+CIRCUITO_TEMPO_ABERTO = float(os.environ.get("OSRM_CIRCUITO_TEMPO_ABERTO", "30"))
+
+_session = None
+_session_lock = threading.Lock()
+_semaforos = {}
+_disjuntores = {}
+
+
+class CircuitoAbertoError(requests.exceptions.ConnectionError):
+    """O disjuntor do servidor está aberto: a requisição nem chega a ser enviada."""
+
+
+class _Disjuntor:
+    """
+    Disjuntor de um servidor. Fechado: tudo passa. Após CIRCUITO_FALHAS_PARA_ABRIR falhas
+    seguidas, abre e recusa requisições por CIRCUITO_TEMPO_ABERTO segundos; depois deixa
+    passar uma requisição de teste (meio aberto), que fecha ou reabre o circuito.
+    """
+    def __init__(self, servidor):
+        self.servidor = servidor
+        self.falhas = 0
+        self.aberto_ate = 0.0
+        self.testando = False
+        self._lock = threading.Lock()
+
+    def permitir(self):
+        with self._lock:
+            if self.falhas < CIRCUITO_FALHAS_PARA_ABRIR:
+                return True
+            if time.monotonic() < self.aberto_ate or self.testando:
+                return False
+            self.testando = True # Meio aberto: só uma requisição de teste por vez
+            return True
+
+    def registrar_sucesso(self):
+        with self._lock:
+            if self.falhas >= CIRCUITO_FALHAS_PARA_ABRIR:
+                logging.info(f"Circuito do OSRM {self.servidor} fechado novamente.")
+            self.falhas = 0
+            self.testando = False
+
+    def registrar_falha(self):
+        with self._lock:
+            self.falhas += 1
+            self.testando = False
+            if self.falhas >= CIRCUITO_FALHAS_PARA_ABRIR:
+                if time.monotonic() >= self.aberto_ate:
+                    logging.warning(f"Circuito do OSRM {self.servidor} aberto após {self.falhas} falhas seguidas; "
+                                    f"novas requisições recusadas por {CIRCUITO_TEMPO_ABERTO:.0f}s.")
+                self.aberto_ate = time.monotonic() + CIRCUITO_TEMPO_ABERTO
+
+    def cancelar_teste(self):
+        with self._lock:
+            self.testando = False
+
+    @property
+    def aberto(self):
+        with self._lock:
+            return self.falhas >= CIRCUITO_FALHAS_PARA_ABRIR and time.monotonic() < self.aberto_ate
+
+
+def get_session():
+    """Retorna a sessão HTTP compartilhada (criada na primeira chamada)."""
+    global _session
+    if _session is None:
+        with _session_lock:
+            if _session is None:
+                session = requests.Session()
+                # pool_block=True: acima do limite, a thread espera uma conexão livre em vez de abrir outra
+                adapter = HTTPAdapter(pool_connections=MAX_HOSTS_NO_POOL, pool_maxsize=MAX_CONEXOES_POR_HOST, pool_block=True)
+                session.mount("http://", adapter)
+                session.mount("https://", adapter)
+                session.headers.update({
+                    "Accept-Encoding": "gzip, deflate", # osrm-routed comprime as respostas (tabelas grandes)
+                    "Connection": "keep-alive",
+                    "User-Agent": "WazeLog",
+                })
+                logging.info(f"Sessão HTTP do OSRM criada (até {MAX_CONEXOES_POR_HOST} conexões por servidor).")
+                _session = session
+    return _session
+
+
+def _servidor(url):
+    """Esquema + host + porta da URL."""
+    partes = urlsplit(url)
+    return f"{partes.scheme}://{partes.netloc}"
+
+
+def _semaforo_servidor(url):
+    """Semáforo que limita as requisições simultâneas ao servidor da URL."""
+    servidor = _servidor(url)
+    with _session_lock:
+        if servidor not in _semaforos:
+            _semaforos[servidor] = threading.BoundedSemaphore(MAX_CONEXOES_POR_HOST)
+        return _semaforos[servidor]
+
+
+def _disjuntor_servidor(url):
+    servidor = _servidor(url)
+    with _session_lock:
+        if servidor not in _disjuntores:
+            _disjuntores[servidor] = _Disjuntor(servidor)
+        return _disjuntores[servidor]
+
+
+def circuito_aberto(url=None):
+    """True se o disjuntor do servidor (padrão: OSRM_SERVER_URL) estiver aberto."""
+    return _disjuntor_servidor(url or OSRM_SERVER_URL).aberto
+
+
+def espera_retentativa(tentativa):
+    """Espera antes da próxima tentativa: exponencial com jitter completo (0 a base*2^(tentativa-1), até RETRY_MAX_DELAY)."""
+    return random.uniform(0, min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** (tentativa - 1)))
+
+
+def osrm_get(url, params=None, timeout=None):
+    """
+    GET no OSRM pela sessão compartilhada, respeitando o limite de requisições simultâneas do servidor.
+    Falhas de conexão, timeouts e respostas 5xx contam para o disjuntor do servidor; com o
+    circuito aberto, levanta CircuitoAbertoError sem enviar a requisição.
+
+    Args:
+        url (str): URL completa do serviço OSRM (ex.: f"{OSRM_SERVER_URL}/table/v1/driving/...").
+        params (dict, optional): Parâmetros da query string.
+        timeout (float, optional): Timeout da requisição em segundos.
+
+    Returns:
+        requests.Response: Resposta HTTP (as exceções de requests são propagadas).
+    """
+    disjuntor = _disjuntor_servidor(url)
+    if not disjuntor.permitir():
+        raise CircuitoAbertoError(f"Circuito aberto para {disjuntor.servidor}: OSRM com falhas recentes.")
+    try:
+        with _semaforo_servidor(url):
+            response = get_session().get(url, params=params, timeout=timeout)
+    except (requests.exceptions.ConnectionError, requests.exceptions.Timeout):
+        disjuntor.registrar_falha()
+        raise
+    except Exception:
+        disjuntor.cancelar_teste() # Erro local (ex.: URL inválida), não diz nada sobre o servidor
+        raise
+    if response.status_code >= 500:
+        disjuntor.registrar_falha()
+    else:
+        disjuntor.registrar_sucesso()
+    return response
+
+
+def url_rota(origem, destino, perfil="driving"):
+    """URL da Route API do OSRM entre dois pontos (lat, lon), com a geometria completa em GeoJSON."""
+    return (f"{OSRM_SERVER_URL}/route/v1/{perfil}/{origem[1]},{origem[0]};{destino[1]},{destino[0]}"
+            f"?overview=full&geometries=geojson")
+
+
+def fechar_sessao():
+    """Fecha as conexões do pool (ex.: ao trocar de servidor ou encerrar a aplicação)."""
+    global _session
+    with _session_lock:
+        if _session is not None:
+            _session.close()
+            _session = None
@@ -0,0 +1,243 @@
+"""
+Servidor OSRM simulado, para rodar benchmarks e testes sem o OSRM do Docker (start_wazelog.sh).
+
+Implementa os serviços usados pelo WazeLog, /table/v1/<perfil>/ (com sources, destinations e
+annotations) e /route/v1/<perfil>/, respondendo no formato do osrm-routed com valores calculados
+pela distância em linha reta: distância = haversine x fator de circuito, tempo = distância / velocidade.
+Latência, limite de tabela (max-table-size) e injeção de erros são configuráveis, e o sorteio dos
+erros usa uma semente fixa, para execuções reproduzíveis.
+
+Uso:
+    python -m routing.osrm_simulado --porta 5000 --latencia 0.02 --taxa-erro 0.1
+    OSRM_BASE_URL=http://localhost:5000 streamlit run app/app.py
+
+Ou dentro de um script de benchmark:
+    servidor = iniciar_servidor(porta=0, latencia=0.01)
+    url = f"http://127.0.0.1:{servidor.server_address[1]}"
+    ...
+    servidor.shutdown()
+"""
+import argparse
+import json
+import logging
+import random
+import threading
+import time
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlsplit, parse_qs
+
+import numpy as np
+
+# --- Constantes ---
+EARTH_RADIUS_M = 6371000
+FATOR_CIRCUITO = 1.3 # Mesmos padrões da estimativa haversine de routing/distancias.py
+VELOCIDADE_KMH = 40
+MAX_TABLE_SIZE = 100 # Padrão do osrm-routed (--max-table-size)
+
+
+def _haversine_m(lat_o, lon_o, lat_d, lon_d):
+    """Distância em linha reta (m) com broadcasting NumPy; entradas em graus."""
+    lat_o, lon_o, lat_d, lon_d = map(np.radians, (lat_o, lon_o, lat_d, lon_d))
+    a = np.sin((lat_d - lat_o) / 2) ** 2 + np.cos(lat_o) * np.cos(lat_d) * np.sin((lon_d - lon_o) / 2) ** 2
+    return 2 * EARTH_RADIUS_M * np.arcsin(np.sqrt(np.clip(a, 0, 1)))
+
+
+class ErroOSRM(Exception):
+    """Erro devolvido ao cliente no formato do OSRM: {"code": ..., "message": ...}."""
+    def __init__(self, code, message, status=400):
+        super().__init__(message)
+        self.code = code
+        self.message = message
+        self.status = status
+
+
+class ServidorOSRMSimulado(ThreadingHTTPServer):
+    """Servidor HTTP com a configuração da simulação e contadores de requisições."""
+    daemon_threads = True
+
+    def __init__(self, endereco, latencia=0.0, jitter=0.0, taxa_erro=0.0, status_erro=503, max_tabela=MAX_TABLE_SIZE,
+                 fator_circuito=FATOR_CIRCUITO, velocidade_kmh=VELOCIDADE_KMH, semente=42):
+        super().__init__(endereco, _ManipuladorOSRM)
+        self.latencia = latencia
+        self.jitter = jitter
+        self.taxa_erro = taxa_erro
+        self.status_erro = status_erro
+        self.max_tabela = max_tabela
+        self.fator_circuito = fator_circuito
+        self.velocidade_mps = velocidade_kmh * 1000 / 3600
+        self._random = random.Random(semente)
+        self._lock = threading.Lock()
+        self.estatisticas = {'requisicoes': 0, 'table': 0, 'route': 0, 'erros_injetados': 0, 'erros_requisicao': 0}
+
+    def sortear(self):
+        """Sorteia (atraso da resposta, se a requisição deve falhar), de forma reproduzível pela semente."""
+        with self._lock:
+            self.estatisticas['requisicoes'] += 1
+            atraso = self.latencia + (self._random.uniform(0, self.jitter) if self.jitter else 0)
+            falhar = self.taxa_erro > 0 and self._random.random() < self.taxa_erro
+            if falhar:
+                self.estatisticas['erros_injetados'] += 1
+        return atraso, falhar
+
+    def contar(self, chave):
+        with self._lock:
+            self.estatisticas[chave] += 1
+
+    def distancias(self, coords_origem, coords_destino):
+        """Matriz de distâncias (m) pelas ruas simuladas: haversine x fator de circuito."""
+        return _haversine_m(coords_origem[:, None, 1], coords_origem[:, None, 0],
+                            coords_destino[None, :, 1], coords_destino[None, :, 0]) * self.fator_circuito
+
+
+class _ManipuladorOSRM(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1" # Mantém a conexão aberta (keep-alive), como o osrm-routed
+    disable_nagle_algorithm = True # Sem isso, respostas pequenas esperam ~40 ms no TCP
+
+    def log_message(self, formato, *args):
+        logging.debug(f"osrm_simulado: {self.address_string()} {formato % args}")
+
+    def _responder(self, status, corpo):
+        dados = json.dumps(corpo).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json; charset=UTF-8")
+        self.send_header("Content-Length", str(len(dados)))
+        self.end_headers()
+        self.wfile.write(dados)
+
+    def do_GET(self):
+        atraso, falhar = self.server.sortear()
+        if atraso > 0:
+            time.sleep(atraso)
+        if falhar:
+            return self._responder(self.server.status_erro, {'code': "InternalError", 'message': "Erro injetado pelo OSRM simulado."})
+        try:
+            partes = urlsplit(self.path)
+            servico, coords = self._interpretar_caminho(partes.path)
+            parametros = {chave: valores[-1] for chave, valores in parse_qs(partes.query).items()}
+            if servico == "table":
+                self.server.contar('table')
+                return self._responder(200, self._tabela(coords, parametros))
+            self.server.contar('route')
+            return self._responder(200, self._rota(coords, parametros))
+        except ErroOSRM as e:
+            self.server.contar('erros_requisicao')
+            return self._responder(e.status, {'code': e.code, 'message': e.message})
+
+    def _interpretar_caminho(self, caminho):
+        """'/table/v1/driving/lon,lat;lon,lat' -> ('table', array Nx2 de (lon, lat))."""
+        partes = caminho.strip("/").split("/")
+        if len(partes) != 4 or partes[1] != "v1":
+            raise ErroOSRM("InvalidUrl", f"URL inválida: {caminho}")
+        if partes[0] not in ("table", "route"):
+            raise ErroOSRM("InvalidService", f"Serviço não suportado pelo OSRM simulado: {partes[0]}")
+        try:
+            coords = np.array([[float(valor) for valor in par.split(",")] for par in partes[3].split(";")], dtype=float)
+        except ValueError:
+            raise ErroOSRM("InvalidQuery", "Coordenadas inválidas.")
+        if coords.ndim != 2 or coords.shape[1] != 2 or (np.abs(coords[:, 0]) > 180).any() or (np.abs(coords[:, 1]) > 90).any():
+            raise ErroOSRM("InvalidValue", "Coordenadas fora dos limites (lon,lat).")
+        return partes[0], coords
+
+    @staticmethod
+    def _indices(parametros, chave, n):
+        valor = parametros.get(chave)
+        if valor is None or valor == "all":
+            return np.arange(n)
+        try:
+            indices = np.array([int(i) for i in valor.split(";")], dtype=np.int64)
+        except ValueError:
+            raise ErroOSRM("InvalidOptions", f"Parâmetro {chave} inválido.")
+        if (indices < 0).any() or (indices >= n).any():
+            raise ErroOSRM("InvalidOptions", f"Índice fora das coordenadas em {chave}.")
+        return indices
+
+    @staticmethod
+    def _waypoints(coords):
+        return [{'location': [round(lon, 6), round(lat, 6)], 'name': "", 'distance': 0} for lon, lat in coords.tolist()]
+
+    def _tabela(self, coords, parametros):
+        sources = self._indices(parametros, "sources", len(coords))
+        destinations = self._indices(parametros, "destinations", len(coords))
+        if len(sources) * len(destinations) > self.server.max_tabela ** 2:
+            raise ErroOSRM("TooBig", "Too many table coordinates")
+        annotations = parametros.get("annotations", "duration").split(",")
+        distancias = self.server.distancias(coords[sources], coords[destinations])
+        resposta = {'code': "Ok", 'sources': self._waypoints(coords[sources]), 'destinations': self._waypoints(coords[destinations])}
+        if "duration" in annotations:
+            resposta['durations'] = np.round(distancias / self.server.velocidade_mps, 1).tolist()
+        if "distance" in annotations:
+            resposta['distances'] = np.round(distancias, 1).tolist()
+        return resposta
+
+    def _rota(self, coords, parametros):
+        if len(coords) < 2:
+            raise ErroOSRM("InvalidQuery", "A rota precisa de pelo menos duas coordenadas.")
+        trechos = np.diag(self.server.distancias(coords[:-1], coords[1:]))
+        legs = [{'distance': round(float(d), 1), 'duration': round(float(d) / self.server.velocidade_mps, 1), 'steps': [], 'summary': ""}
+                for d in trechos]
+        rota = {
+            'distance': round(float(trechos.sum()), 1),
+            'duration': round(float(trechos.sum()) / self.server.velocidade_mps, 1),
+            'legs': legs,
+            'weight_name': "routability",
+            'weight': round(float(trechos.sum()) / self.server.velocidade_mps, 1),
+        }
+        if parametros.get("overview", "simplified") != "false":
+            # Linha reta entre os pontos: GeoJSON com geometries=geojson, senão polyline (não simulada)
+            if parametros.get("geometries") == "geojson":
+                rota['geometry'] = {'type': "LineString", 'coordinates': coords.tolist()}
+            else:
+                rota['geometry'] = ""
+        return {'code': "Ok", 'routes': [rota], 'waypoints': self._waypoints(coords)}
+
+
+def iniciar_servidor(host="127.0.0.1", porta=0, em_thread=True, **config):
+    """
+    Cria o servidor OSRM simulado.
+
+    Args:
+        host (str): Endereço de escuta.
+        porta (int): Porta (0 = porta livre escolhida pelo sistema; veja servidor.server_address).
+        em_thread (bool): Se True, atende as requisições numa thread daemon e retorna em seguida.
+        **config: latencia, jitter, taxa_erro, status_erro, max_tabela, fator_circuito, velocidade_kmh, semente.
+
+    Returns:
+        ServidorOSRMSimulado: Servidor (use servidor.shutdown() para parar; servidor.estatisticas traz os contadores).
+    """
+    servidor = ServidorOSRMSimulado((host, porta), **config)
+    if em_thread:
+        threading.Thread(target=servidor.serve_forever, name="osrm_simulado", daemon=True).start()
+    return servidor
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Servidor OSRM simulado (table e route por distância em linha reta).")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--porta", type=int, default=5000)
+    parser.add_argument("--latencia", type=float, default=0.0, help="Atraso fixo de cada resposta, em segundos.")
+    parser.add_argument("--jitter", type=float, default=0.0, help="Atraso extra aleatório (0 a JITTER segundos).")
+    parser.add_argument("--taxa-erro", type=float, default=0.0, help="Fração das requisições respondidas com erro (0 a 1).")
+    parser.add_argument("--status-erro", type=int, default=503, help="Status HTTP dos erros injetados.")
+    parser.add_argument("--max-tabela", type=int, default=MAX_TABLE_SIZE, help="Equivalente ao --max-table-size do osrm-routed.")
+    parser.add_argument("--fator-circuito", type=float, default=FATOR_CIRCUITO)
+    parser.add_argument("--velocidade-kmh", type=float, default=VELOCIDADE_KMH)
+    parser.add_argument("--semente", type=int, default=42, help="Semente do sorteio de erros e jitter.")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    servidor = iniciar_servidor(args.host, args.porta, em_thread=False, latencia=args.latencia, jitter=args.jitter,
+                                taxa_erro=args.taxa_erro, status_erro=args.status_erro, max_tabela=args.max_tabela,
+                                fator_circuito=args.fator_circuito, velocidade_kmh=args.velocidade_kmh, semente=args.semente)
+    logging.info(f"OSRM simulado em http://{args.host}:{servidor.server_address[1]} (latência {args.latencia}s, "
+                 f"taxa de erro {args.taxa_erro:.0%}, max-table-size {args.max_tabela}).")
+    try:
+        servidor.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        servidor.server_close()
+        logging.info(f"OSRM simulado encerrado: {servidor.estatisticas}")
+
+
+if __name__ == "__main__":
+    main()
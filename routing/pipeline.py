@@ -0,0 +1,338 @@
+"""
+Pipeline de roteirização (matriz de distâncias + solver) executado fora da thread da requisição.
+
+Usado pela API (main.py): cada roteirização vira um job, executado por um pool de workers
+limitado a MAX_JOBS_SIMULTANEOS; o progresso e o resultado ficam guardados em memória para
+consulta (polling) ou streaming. Vários usuários podem roteirizar ao mesmo tempo sem que um
+bloqueie o outro, e recarregar a página não interrompe o cálculo.
+"""
+import os
+import time
+import uuid
+import logging
+import threading
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+from routing.distancias import calcular_matrizes_tempo_distancia, calcular_matrizes_esparsas, LIMITE_MATRIZ_DENSA, INFINITE_VALUE
+from routing.cvrp import solver_cvrp
+from routing.cvrp_flex import solver_cvrp_flex
+from routing.decomposicao import solver_cvrp_decomposto, LIMITE_DECOMPOSICAO
+from routing.portfolio import solver_cvrp_portfolio
+from routing.vrptw import solver_vrptw
+
+# --- Constantes ---
+MAX_JOBS_SIMULTANEOS = int(os.environ.get("WAZELOG_MAX_JOBS", "2")) # Roteirizações executadas em paralelo
+MAX_JOBS_GUARDADOS = 100 # Jobs concluídos mantidos em memória (os mais antigos são descartados)
+TIPOS_ROTEIRIZACAO = ("CVRP", "CVRP Flex", "VRPTW")
+STATUS_FINAIS = ("concluido", "erro", "cancelado")
+# Fração do progresso reservada para a matriz; o restante é do solver
+PESO_MATRIZ = 0.5
+
+
+class ErroRoteirizacao(Exception):
+    """Dados inválidos ou falha em uma das etapas da roteirização (a mensagem vai para o job)."""
+
+
+# --- Pipeline ---
+def _preparar_frota(frota):
+    """Veículos disponíveis, com 'Capacidade (Kg)' numérica (mesmo tratamento da tela de roteirização)."""
+    frota = frota.loc[:, ~frota.columns.duplicated()].copy()
+    if 'Disponível' in frota.columns:
+        frota = frota[frota['Disponível'].astype(bool)]
+    frota['Capacidade (Kg)'] = pd.to_numeric(frota.get('Capacidade (Kg)', 0), errors='coerce').fillna(0)
+    return frota.reset_index(drop=True)
+
+def _separar_pedidos(pedidos):
+    """(pedidos com coordenadas válidas, pedidos sem coordenadas)."""
+    pedidos = pedidos.copy()
+    for coluna in ('Latitude', 'Longitude'):
+        pedidos[coluna] = pd.to_numeric(pedidos[coluna], errors='coerce') if coluna in pedidos.columns else np.nan
+    sem_coordenadas = pedidos['Latitude'].isna() | pedidos['Longitude'].isna()
+    return pedidos[~sem_coordenadas].reset_index(drop=True), pedidos[sem_coordenadas].reset_index(drop=True)
+
+def _distancia_rotas(rotas_df, matriz_distancias, depot_index=0):
+    """Distância total (m) das rotas, incluindo a saída e a volta ao depósito de cada veículo."""
+    total = 0
+    for _, rota in rotas_df.groupby('Veículo'):
+        nos = [depot_index] + rota.sort_values('Sequencia')['Node_Index_OR'].astype(int).tolist() + [depot_index]
+        total += sum(int(matriz_distancias[a, b]) for a, b in zip(nos[:-1], nos[1:]))
+    return total
+
+def executar_roteirizacao(pedidos, frota, deposito, tipo="CVRP", ajuste_capacidade_pct=100, simetrica=False, decompor=None,
+                          rotas_iniciais=None, portfolio=False, progress_callback=None, ao_melhorar=None, deve_parar=None):
+    """
+    Executa a roteirização completa: matrizes de tempo e distância (OSRM, com fallback haversine)
+    e o solver escolhido, como na tela de roteirização.
+
+    Args:
+        pedidos (pd.DataFrame): Pedidos com 'Latitude', 'Longitude' e 'Peso dos Itens'.
+        frota (pd.DataFrame): Veículos com 'Capacidade (Kg)' (e opcionalmente 'Disponível', 'Placa').
+        deposito (tuple): (latitude, longitude) do depósito.
+        tipo (str): "CVRP", "CVRP Flex" ou "VRPTW" (janelas 'Janela Início'/'Janela Fim' e 'Tempo de Serviço').
+        ajuste_capacidade_pct (int): Ajuste da capacidade dos veículos (CVRP Flex), de 0 a 120.
+        simetrica (bool): Usa a matriz simétrica aproximada (metade das requisições ao OSRM).
+        decompor (bool, optional): CVRP por clusters geográficos (routing/decomposicao.py). Padrão: só acima de
+                                   LIMITE_DECOMPOSICAO pedidos.
+        rotas_iniciais (pd.DataFrame, optional): Rotas de uma roteirização anterior para o CVRP partir delas (warm start).
+        portfolio (bool): CVRP com várias estratégias do OR-Tools em paralelo (routing/portfolio.py), sem warm start.
+        progress_callback (function, optional): Recebe (fração 0.0 a 1.0, descrição da etapa).
+        ao_melhorar (function, optional): Recebe cada nova melhor solução do CVRP ou VRPTW ({'objetivo', 'veiculos', 'tempo_s'}).
+                                          Não é chamado na decomposição, no portfólio e no CVRP Flex, que resolvem em outros processos.
+        deve_parar (function, optional): Se retornar True durante a busca do CVRP ou VRPTW, o solver termina com a melhor solução até ali.
+
+    Returns:
+        dict: {'rotas': DataFrame, 'pedidos_nao_alocados': DataFrame, 'distancia_total_m': int, 'metadados_matriz': dict,
+               'portfolio': DataFrame com o resultado de cada estratégia (vazio sem portfolio)}
+
+    Raises:
+        ErroRoteirizacao: Dados inválidos, matriz indisponível ou solver sem solução.
+    """
+    def _progresso(fracao, etapa):
+        if progress_callback:
+            progress_callback(fracao, etapa)
+
+    if tipo not in TIPOS_ROTEIRIZACAO:
+        raise ErroRoteirizacao(f"Tipo de roteirização '{tipo}' não suportado. Use um de: {', '.join(TIPOS_ROTEIRIZACAO)}.")
+    frota = _preparar_frota(frota)
+    pedidos_validos, pedidos_nao_alocados = _separar_pedidos(pedidos)
+    if frota.empty:
+        raise ErroRoteirizacao("A frota está vazia (ou sem veículos disponíveis).")
+    if pedidos_validos.empty:
+        raise ErroRoteirizacao("Nenhum pedido com coordenadas válidas para roteirizar.")
+    if 'Peso dos Itens' not in pedidos_validos.columns:
+        raise ErroRoteirizacao("Coluna 'Peso dos Itens' necessária para a roteirização não encontrada nos pedidos.")
+    demandas = pd.to_numeric(pedidos_validos['Peso dos Itens'], errors='coerce').fillna(0)
+    if tipo == "CVRP" and (demandas > frota['Capacidade (Kg)'].max()).any():
+        raise ErroRoteirizacao(f"Existem pedidos cuja demanda excede a capacidade máxima dos veículos ({frota['Capacidade (Kg)'].max():.1f} Kg).")
+
+    # --- Matrizes ---
+    pontos = [tuple(deposito)] + pedidos_validos[['Latitude', 'Longitude']].values.tolist()
+    progresso_matriz = lambda fracao: _progresso(PESO_MATRIZ * fracao, "Calculando matriz de distâncias")
+    _progresso(0.0, "Calculando matriz de distâncias")
+    if len(pontos) > LIMITE_MATRIZ_DENSA:
+        matrizes, metadados_matriz = calcular_matrizes_esparsas(pontos, progress_callback=progresso_matriz,
+                                                                retornar_metadados=True, fallback="haversine")
+        matriz_tempos, matriz_distancias = (matrizes["duration"], matrizes["distance"]) if matrizes is not None else (None, None)
+    else:
+        matriz_tempos, matriz_distancias, metadados_matriz = calcular_matrizes_tempo_distancia(
+            pontos, progress_callback=progresso_matriz, retornar_metadados=True, fallback="haversine", simetrica=simetrica)
+    if matriz_distancias is None or len(matriz_distancias) != len(pontos):
+        raise ErroRoteirizacao("Falha ao calcular a matriz de distâncias completa.")
+    if isinstance(matriz_distancias, np.ndarray) and (matriz_distancias >= INFINITE_VALUE).any():
+        raise ErroRoteirizacao("A matriz de distâncias contém valores infinitos ou impossíveis. Verifique as coordenadas dos pedidos e do depósito.")
+
+    # --- Solver ---
+    estrategias = pd.DataFrame()
+    _progresso(PESO_MATRIZ, f"Executando o solver {tipo}")
+    if decompor is None:
+        decompor = len(pedidos_validos) > LIMITE_DECOMPOSICAO
+    if tipo == "CVRP" and decompor:
+        progresso_clusters = lambda feitos, total: _progresso(PESO_MATRIZ + (1 - PESO_MATRIZ) * feitos / total,
+                                                              f"Executando o solver {tipo} por clusters ({feitos}/{total})")
+        rotas_df = solver_cvrp_decomposto(pedidos_validos, frota, matriz_distancias, ao_concluir_cluster=progresso_clusters)
+        if rotas_df is not None and not rotas_df.empty:
+            # Pedidos de clusters que ficaram sem solução
+            pedidos_nao_alocados = pd.concat([pedidos_nao_alocados, pedidos_validos.drop(index=rotas_df['Pedido_Index_DF'])],
+                                             ignore_index=True)
+    elif tipo == "CVRP" and portfolio and rotas_iniciais is None:
+        disputa = solver_cvrp_portfolio(pedidos_validos, frota, matriz_distancias)
+        rotas_df, estrategias = disputa['rotas'], disputa['estrategias']
+    elif tipo == "CVRP":
+        rotas_df = solver_cvrp(pedidos_validos, frota, matriz_distancias, rotas_iniciais=rotas_iniciais,
+                               ao_melhorar=ao_melhorar, deve_parar=deve_parar)
+    elif tipo == "VRPTW":
+        rotas_df = solver_vrptw(pedidos_validos, frota, matriz_tempos, matriz_distancias, ao_melhorar=ao_melhorar, deve_parar=deve_parar)
+        if rotas_df is not None and not rotas_df.empty:
+            # Pedidos que não couberam nas janelas de tempo
+            pedidos_nao_alocados = pd.concat([pedidos_nao_alocados, pedidos_validos.drop(index=rotas_df['Pedido_Index_DF'])],
+                                             ignore_index=True)
+    else:
+        resultado = solver_cvrp_flex(pedidos_validos, frota, matriz_distancias, depot_index=0,
+                                     ajuste_capacidade_pct=ajuste_capacidade_pct)['Cenário_1']
+        if resultado['pedidos_result'] is None:
+            raise ErroRoteirizacao(resultado['diagnostico'] or "Solver CVRP Flex não encontrou solução.")
+        rotas_df = resultado['pedidos_result']
+        pedidos_nao_alocados = pd.concat([pedidos_nao_alocados, rotas_df[rotas_df['Veículo'].isna()]], ignore_index=True)
+        rotas_df = rotas_df[rotas_df['Veículo'].notna()].reset_index(drop=True)
+    if rotas_df is None or rotas_df.empty:
+        raise ErroRoteirizacao(f"O solver {tipo} não encontrou solução. Verifique capacidades e coordenadas.")
+
+    # Coordenadas dos pedidos nas rotas (para o mapa)
+    if 'Pedido_Index_DF' in rotas_df.columns and 'Latitude' not in rotas_df.columns:
+        coordenadas = pedidos_validos[['Latitude', 'Longitude']].rename_axis('Pedido_Index_DF').reset_index()
+        rotas_df = rotas_df.merge(coordenadas, on='Pedido_Index_DF', how='left')
+    rotas_df = rotas_df.sort_values(['Veículo', 'Sequencia']).reset_index(drop=True)
+    _progresso(1.0, "Concluído")
+    return {
+        'rotas': rotas_df,
+        'pedidos_nao_alocados': pedidos_nao_alocados,
+        'distancia_total_m': _distancia_rotas(rotas_df, matriz_distancias),
+        'metadados_matriz': metadados_matriz,
+        'portfolio': estrategias,
+    }
+# --- Fim Pipeline ---
+
+
+# --- Jobs ---
+_jobs = {}
+_jobs_lock = threading.Lock()
+_executor = None
+
+def _get_executor():
+    global _executor
+    with _jobs_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=MAX_JOBS_SIMULTANEOS, thread_name_prefix="roteirizacao")
+        return _executor
+
+def _atualizar_job(job_id, **campos):
+    with _jobs_lock:
+        job = _jobs.get(job_id)
+        if job is not None:
+            job.update(campos)
+            job['versao'] += 1
+
+def _podar_jobs():
+    """Descarta os jobs finalizados mais antigos acima de MAX_JOBS_GUARDADOS (chamada com o lock)."""
+    finalizados = sorted((job for job in _jobs.values() if job['status'] in STATUS_FINAIS), key=lambda job: job['criado_em'])
+    for job in finalizados[:max(0, len(finalizados) - MAX_JOBS_GUARDADOS)]:
+        del _jobs[job['id']]
+
+def _resumo(job):
+    """Cópia do job sem o resultado, sem os dados de entrada e sem o histórico de melhorias (para status e listagem)."""
+    return {chave: valor for chave, valor in job.items() if chave not in ('resultado', 'future', 'melhorias')}
+
+def _registrar_melhoria(job_id, evento):
+    """Guarda a nova melhor solução do solver no histórico do job (a última também fica no resumo, em 'melhoria')."""
+    with _jobs_lock:
+        job = _jobs.get(job_id)
+        if job is not None:
+            job['melhorias'].append(evento)
+            job['melhoria'] = evento
+            job['versao'] += 1
+
+def _parada_solicitada(job_id):
+    with _jobs_lock:
+        return _jobs.get(job_id, {}).get('parada_solicitada', False)
+
+def _executar_job(job_id, pedidos, frota, deposito, tipo, ajuste_capacidade_pct, simetrica, decompor, rotas_iniciais, portfolio):
+    with _jobs_lock:
+        if _jobs.get(job_id, {}).get('status') != "pendente":
+            return # Cancelado antes de começar
+    _atualizar_job(job_id, status="executando", iniciado_em=time.time(), etapa="Iniciando")
+    try:
+        resultado = executar_roteirizacao(pedidos, frota, deposito, tipo=tipo, ajuste_capacidade_pct=ajuste_capacidade_pct,
+                                          simetrica=simetrica, decompor=decompor, rotas_iniciais=rotas_iniciais,
+                                          portfolio=portfolio,
+                                          progress_callback=lambda fracao, etapa: _atualizar_job(job_id, progresso=round(fracao, 4), etapa=etapa),
+                                          ao_melhorar=lambda evento: _registrar_melhoria(job_id, evento),
+                                          deve_parar=lambda: _parada_solicitada(job_id))
+        _atualizar_job(job_id, status="concluido", progresso=1.0, etapa="Concluído", concluido_em=time.time(), resultado=resultado)
+        logging.info(f"Job {job_id} concluído: {len(resultado['rotas'])} paradas, {resultado['distancia_total_m'] / 1000:.1f} km.")
+    except ErroRoteirizacao as e:
+        _atualizar_job(job_id, status="erro", erro=str(e), concluido_em=time.time())
+        logging.warning(f"Job {job_id} sem resultado: {e}")
+    except Exception as e:
+        _atualizar_job(job_id, status="erro", erro=f"Erro inesperado: {e}", concluido_em=time.time())
+        logging.error(f"Erro inesperado no job {job_id}: {e}")
+        logging.error(traceback.format_exc())
+
+def submeter_job(pedidos, frota, deposito, tipo="CVRP", ajuste_capacidade_pct=100, simetrica=False, decompor=None,
+                 rotas_iniciais=None, portfolio=False):
+    """
+    Enfileira uma roteirização no pool de workers e retorna imediatamente.
+
+    Args:
+        Mesmos de `executar_roteirizacao`, exceto `progress_callback`.
+
+    Returns:
+        str: Identificador do job (use `consultar_job` / `resultado_job`).
+    """
+    if tipo not in TIPOS_ROTEIRIZACAO:
+        raise ErroRoteirizacao(f"Tipo de roteirização '{tipo}' não suportado. Use um de: {', '.join(TIPOS_ROTEIRIZACAO)}.")
+    job_id = uuid.uuid4().hex
+    with _jobs_lock:
+        _podar_jobs()
+        _jobs[job_id] = {
+            'id': job_id,
+            'tipo': tipo,
+            'n_pedidos': len(pedidos),
+            'n_veiculos': len(frota),
+            'status': "pendente",
+            'etapa': "Na fila",
+            'progresso': 0.0,
+            'erro': None,
+            'criado_em': time.time(),
+            'iniciado_em': None,
+            'concluido_em': None,
+            'versao': 0,
+            'melhoria': None, # Última melhor solução do solver ({'objetivo', 'veiculos', 'tempo_s'})
+            'melhorias': [],
+            'parada_solicitada': False,
+            'resultado': None,
+        }
+    future = _get_executor().submit(_executar_job, job_id, pedidos, frota, deposito, tipo, ajuste_capacidade_pct, simetrica,
+                                    decompor, rotas_iniciais, portfolio)
+    with _jobs_lock:
+        _jobs[job_id]['future'] = future
+    logging.info(f"Job {job_id} ({tipo}, {len(pedidos)} pedidos, {len(frota)} veículos) enfileirado.")
+    return job_id
+
+def consultar_job(job_id):
+    """Status e progresso do job (dict), ou None se o job não existir."""
+    with _jobs_lock:
+        job = _jobs.get(job_id)
+        return _resumo(job) if job is not None else None
+
+def resultado_job(job_id):
+    """Resultado de `executar_roteirizacao` para um job concluído, ou None (job inexistente ou não concluído)."""
+    with _jobs_lock:
+        job = _jobs.get(job_id)
+        return job['resultado'] if job is not None and job['status'] == "concluido" else None
+
+def consultar_melhorias(job_id, desde=0):
+    """Melhores soluções do solver registradas no job a partir da posição `desde`, ou None se o job não existir."""
+    with _jobs_lock:
+        job = _jobs.get(job_id)
+        return list(job['melhorias'][desde:]) if job is not None else None
+
+def listar_jobs():
+    """Resumo de todos os jobs guardados, do mais recente para o mais antigo."""
+    with _jobs_lock:
+        return sorted((_resumo(job) for job in _jobs.values()), key=lambda job: job['criado_em'], reverse=True)
+
+def cancelar_job(job_id):
+    """
+    Cancela um job que ainda está na fila. Jobs em execução não são interrompidos (o solver não
+    tem ponto de parada seguro; use `parar_job` para encerrar a busca com a melhor solução até ali).
+    Retorna True se o job foi cancelado.
+    """
+    with _jobs_lock:
+        job = _jobs.get(job_id)
+        if job is None or job['status'] != "pendente":
+            return False
+        if job.get('future') is not None:
+            job['future'].cancel()
+        job.update(status="cancelado", etapa="Cancelado", concluido_em=time.time())
+        job['versao'] += 1
+        return True
+
+def parar_job(job_id):
+    """
+    Pede ao solver de um job em execução que termine com a melhor solução encontrada até agora (o job
+    conclui normalmente, com essas rotas). Vale para o CVRP e o VRPTW; feito ainda durante a matriz, a
+    busca termina na primeira solução. Na decomposição, no portfólio e no CVRP Flex o pedido não tem
+    efeito. Retorna True se o pedido foi registrado.
+    """
+    with _jobs_lock:
+        job = _jobs.get(job_id)
+        if job is None or job['status'] != "executando":
+            return False
+        job.update(parada_solicitada=True)
+        job['versao'] += 1
+        return True
+# --- Fim Jobs ---
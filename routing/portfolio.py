@@ -0,0 +1,153 @@
+"""
+Portfólio de estratégias do CVRP: várias combinações de solução inicial e metaheurística do
+OR-Tools disputam a mesma instância em processos paralelos, dentro de um orçamento de tempo
+comum, e a melhor solução é a devolvida.
+
+Qual combinação vence depende muito da instância (densidade, folga de capacidade, depósito
+central ou na borda), então cada disputa é registrada em PORTFOLIO_LOG_PATH (uma linha por
+estratégia, com objetivo e tempos) para ajustar a lista padrão depois.
+"""
+import os
+import csv
+import math
+import time
+import shutil
+import logging
+import tempfile
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
+import pandas as pd
+
+from routing.cvrp import solver_cvrp
+from routing.cvrp_flex import _num_processos, _compartilhar_matrizes
+
+# --- Constantes ---
+# (solução inicial, metaheurística): nomes de FirstSolutionStrategy e LocalSearchMetaheuristic
+ESTRATEGIAS_PORTFOLIO = (
+    ("PATH_CHEAPEST_ARC", "GUIDED_LOCAL_SEARCH"),
+    ("SAVINGS", "GUIDED_LOCAL_SEARCH"),
+    ("PARALLEL_CHEAPEST_INSERTION", "TABU_SEARCH"),
+    ("LOCAL_CHEAPEST_INSERTION", "SIMULATED_ANNEALING"),
+)
+TEMPO_PORTFOLIO_S = 30 # Orçamento total de tempo (relógio) da disputa
+PORTFOLIO_LOG_PATH = os.environ.get("WAZELOG_PORTFOLIO_LOG",
+                                    os.path.join(os.path.dirname(__file__), '..', 'database', 'portfolio_estrategias.csv'))
+CAMPOS_LOG = ('data', 'n_pedidos', 'n_veiculos', 'primeira_solucao', 'metaheuristica', 'tempo_limite_s',
+              'objetivo', 'status', 'tempo_s', 'tempo_melhor_s', 'solucoes', 'vencedora')
+
+
+def _resolver_estrategia(pedidos, frota, matriz_distancias, primeira_solucao, metaheuristica, tempo_limite_s):
+    """Executa solver_cvrp com uma estratégia e retorna (rotas, estatísticas). Aceita o caminho de um .npy como matriz."""
+    if isinstance(matriz_distancias, str):
+        matriz_distancias = np.load(matriz_distancias, mmap_mode='r')
+    estatisticas = {}
+    rotas = solver_cvrp(pedidos, frota, matriz_distancias, primeira_solucao=primeira_solucao, metaheuristica=metaheuristica,
+                        tempo_limite_s=tempo_limite_s, estatisticas=estatisticas)
+    return rotas, estatisticas
+
+
+def registrar_disputa(registros, caminho=None):
+    """Acrescenta as linhas da disputa ao CSV de histórico do portfólio (cria o arquivo com cabeçalho)."""
+    caminho = caminho or PORTFOLIO_LOG_PATH
+    try:
+        os.makedirs(os.path.dirname(os.path.abspath(caminho)), exist_ok=True)
+        novo = not os.path.exists(caminho)
+        with open(caminho, "a", newline="", encoding="utf-8") as f:
+            writer = csv.DictWriter(f, fieldnames=CAMPOS_LOG, extrasaction='ignore')
+            if novo:
+                writer.writeheader()
+            writer.writerows(registros)
+    except OSError as e:
+        logging.warning(f"Não foi possível registrar a disputa do portfólio em {caminho}: {e}")
+
+
+def solver_cvrp_portfolio(pedidos, frota, matriz_distancias, estrategias=None, tempo_total_s=TEMPO_PORTFOLIO_S,
+                          max_processos=None, registrar=True):
+    """
+    Resolve o CVRP com várias estratégias em paralelo e fica com a de menor custo.
+
+    Com menos núcleos do que estratégias, as estratégias rodam em rodadas e o tempo de cada uma é
+    dividido para que a disputa inteira caiba em `tempo_total_s`.
+
+    Args:
+        pedidos (pd.DataFrame): Pedidos, como em solver_cvrp.
+        frota (pd.DataFrame): Frota, como em solver_cvrp.
+        matriz_distancias (array-like): Matriz com o depósito no índice 0.
+        estrategias (list, optional): Pares (solução inicial, metaheurística). Padrão: ESTRATEGIAS_PORTFOLIO.
+        tempo_total_s (float): Orçamento de tempo (relógio) da disputa inteira.
+        max_processos (int, optional): Máximo de processos. Padrão: núcleos disponíveis (ou WAZELOG_MAX_PROCESSOS).
+        registrar (bool): Se True, acrescenta o resultado de cada estratégia em PORTFOLIO_LOG_PATH.
+
+    Returns:
+        dict: {'rotas': DataFrame da melhor estratégia (vazio se nenhuma achou solução),
+               'vencedora': 'SOLUCAO_INICIAL + METAHEURISTICA' ou None,
+               'estrategias': DataFrame com objetivo, status e tempos de cada estratégia}
+    """
+    estrategias = [tuple(estrategia) for estrategia in (estrategias or ESTRATEGIAS_PORTFOLIO)]
+    num_processos = _num_processos(len(estrategias), max_processos)
+    rodadas = math.ceil(len(estrategias) / num_processos)
+    tempo_limite_s = max(1.0, tempo_total_s / rodadas)
+    logging.info(f"Portfólio CVRP: {len(estrategias)} estratégias em {num_processos} processo(s), {tempo_limite_s:.1f}s cada.")
+
+    resultados = {}
+    inicio = time.time()
+    if num_processos == 1:
+        for estrategia in estrategias:
+            resultados[estrategia] = _resolver_estrategia(pedidos, frota, matriz_distancias, *estrategia, tempo_limite_s)
+    else:
+        pasta = tempfile.mkdtemp(prefix="cvrp_portfolio_")
+        try:
+            arquivo = _compartilhar_matrizes([{'matriz_distancias': matriz_distancias}], pasta)[id(matriz_distancias)]
+            # spawn: o app (Streamlit/FastAPI) tem várias threads, e fork com threads ativas pode travar o processo filho
+            with ProcessPoolExecutor(max_workers=num_processos, mp_context=multiprocessing.get_context("spawn")) as executor:
+                futures = {executor.submit(_resolver_estrategia, pedidos, frota, arquivo, *estrategia, tempo_limite_s): estrategia
+                           for estrategia in estrategias}
+                for future in as_completed(futures):
+                    estrategia = futures[future]
+                    try:
+                        resultados[estrategia] = future.result()
+                    except Exception as e:
+                        logging.error(f"Portfólio CVRP: falha na estratégia {' + '.join(estrategia)}: {e}")
+                        resultados[estrategia] = (pd.DataFrame(), {'status': f'ERRO: {e}'})
+        finally:
+            shutil.rmtree(pasta, ignore_errors=True)
+
+    registros = []
+    for primeira_solucao, metaheuristica in estrategias:
+        rotas, estatisticas = resultados[(primeira_solucao, metaheuristica)]
+        registros.append({
+            'data': time.strftime("%Y-%m-%d %H:%M:%S"),
+            'n_pedidos': len(pedidos),
+            'n_veiculos': len(frota),
+            'primeira_solucao': primeira_solucao,
+            'metaheuristica': metaheuristica,
+            'tempo_limite_s': round(tempo_limite_s, 1),
+            'objetivo': estatisticas.get('objetivo') if rotas is not None and not rotas.empty else None,
+            'status': estatisticas.get('status'),
+            'tempo_s': estatisticas.get('tempo_s'),
+            'tempo_melhor_s': estatisticas.get('tempo_melhor_s'),
+            'solucoes': estatisticas.get('solucoes'),
+            'vencedora': False,
+        })
+
+    # Menor custo; no empate, a que chegou nele primeiro
+    validos = [i for i, registro in enumerate(registros) if registro['objetivo'] is not None]
+    if not validos:
+        logging.warning("Portfólio CVRP: nenhuma estratégia encontrou solução.")
+        if registrar:
+            registrar_disputa(registros)
+        return {'rotas': pd.DataFrame(), 'vencedora': None, 'estrategias': pd.DataFrame(registros)}
+
+    melhor = min(validos, key=lambda i: (registros[i]['objetivo'], registros[i]['tempo_melhor_s'] or 0))
+    registros[melhor]['vencedora'] = True
+    vencedora = f"{registros[melhor]['primeira_solucao']} + {registros[melhor]['metaheuristica']}"
+    logging.info(f"Portfólio CVRP: vencedora {vencedora} (custo {registros[melhor]['objetivo']}) em {time.time() - inicio:.1f}s.")
+    if registrar:
+        registrar_disputa(registros)
+    return {
+        'rotas': resultados[estrategias[melhor]][0],
+        'vencedora': vencedora,
+        'estrategias': pd.DataFrame(registros),
+    }
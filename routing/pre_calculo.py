@@ -0,0 +1,162 @@
+"""
+Pré-cálculo da matriz de tempos e distâncias da base permanente de clientes.
+
+Feito para rodar fora do horário de pico (ex.: cron às 3h): calcula, pelo OSRM, a matriz
+completa entre o(s) depósito(s) e todos os clientes geocodificados em database/coordenadas.csv
+e grava em disco (um .npy por métrica + manifesto JSON em PRE_CALCULO_PATH). Na roteirização,
+`calcular_matriz_distancias` recorta dessa matriz as linhas e colunas dos pedidos do dia e só
+consulta o OSRM para clientes novos.
+
+Uso:
+    python -m routing.pre_calculo
+    python -m routing.pre_calculo --deposito -23.251501 -47.084560 --requisicoes 4
+    # crontab: 0 3 * * * cd /caminho/WazeLog && python -m routing.pre_calculo
+"""
+import argparse
+import glob
+import json
+import logging
+import os
+import sqlite3
+import sys
+import time
+
+import pandas as pd
+
+from routing.distancias import (calcular_matrizes_tempo_distancia, carregar_matriz_pre_calculada, _chave_coordenada,
+                                _is_valid_lat_lon, PRE_CALCULO_PATH)
+
+# --- Constantes ---
+COORDENADAS_CSV = os.path.join(os.path.dirname(__file__), '..', 'database', 'coordenadas.csv')
+WAZELOG_DB = os.path.join(os.path.dirname(__file__), '..', 'database', 'wazelog.db')
+METRICAS = ("duration", "distance")
+
+
+def carregar_clientes(caminho_csv=COORDENADAS_CSV):
+    """Coordenadas (lat, lon) válidas e sem repetição da base de clientes geocodificados."""
+    df = pd.read_csv(caminho_csv, dtype=str)
+    latitudes = pd.to_numeric(df['Latitude'].str.replace(',', '.'), errors='coerce')
+    longitudes = pd.to_numeric(df['Longitude'].str.replace(',', '.'), errors='coerce')
+    pontos, vistos = [], set()
+    for lat, lon in zip(latitudes, longitudes):
+        if pd.isnull(lat) or pd.isnull(lon) or not _is_valid_lat_lon(float(lat), float(lon)):
+            continue
+        chave = _chave_coordenada(lat, lon)
+        if chave not in vistos:
+            vistos.add(chave)
+            pontos.append((float(lat), float(lon)))
+    logging.info(f"{len(pontos)} clientes com coordenadas distintas em {caminho_csv} ({len(df)} linhas).")
+    return pontos
+
+
+def carregar_deposito_configurado(caminho_db=WAZELOG_DB):
+    """Endereço de partida salvo pela tela de roteirização (tabela config), ou None."""
+    try:
+        conn = sqlite3.connect(f"file:{os.path.abspath(caminho_db)}?mode=ro", uri=True)
+        try:
+            row = conn.execute("SELECT latitude, longitude FROM config WHERE chave = ?", ("endereco_partida",)).fetchone()
+        finally:
+            conn.close()
+    except sqlite3.Error as e:
+        logging.warning(f"Não foi possível ler o endereço de partida em {caminho_db}: {e}")
+        return None
+    if row and row[0] is not None and row[1] is not None:
+        return float(row[0]), float(row[1])
+    return None
+
+
+def pre_calcular_matriz_clientes(pontos, caminho=None, requisicoes_simultaneas=None):
+    """
+    Calcula e grava a matriz de tempos e distâncias dos `pontos`.
+
+    As matrizes são gravadas em arquivos novos ('<nome>_<data>_<metrica>.npy') e o manifesto
+    é trocado de uma vez só no final, então uma roteirização em andamento nunca lê uma matriz
+    pela metade; os arquivos da versão anterior são apagados em seguida.
+
+    Args:
+        pontos (list): Lista de tuplas (latitude, longitude): depósito(s) e clientes.
+        caminho (str, optional): Caminho do manifesto. Padrão: PRE_CALCULO_PATH.
+        requisicoes_simultaneas (int, optional): Máximo de requisições OSRM em paralelo.
+
+    Returns:
+        dict or None: Metadados do cálculo, ou None se o OSRM falhar (a matriz anterior é mantida).
+    """
+    caminho = os.path.abspath(caminho or PRE_CALCULO_PATH)
+    pasta, nome = os.path.dirname(caminho), os.path.splitext(os.path.basename(caminho))[0]
+    os.makedirs(pasta, exist_ok=True)
+    versao = time.strftime("%Y%m%dT%H%M%S")
+    prefixo = os.path.join(pasta, f"{nome}_{versao}")
+
+    # Sem fallback: uma estimativa não deve ficar guardada como se fosse a matriz do OSRM.
+    # Sem pré-cálculo: a matriz antiga não serve de fonte para a nova (clientes podem ter mudado de endereço).
+    matriz_tempos, matriz_distancias, metadados = calcular_matrizes_tempo_distancia(
+        pontos, requisicoes_simultaneas=requisicoes_simultaneas, retornar_metadados=True, arquivo_memmap=prefixo,
+        fallback=None, usar_pre_calculo=False)
+    if matriz_tempos is None or matriz_distancias is None:
+        logging.error("Falha ao calcular a matriz da base de clientes. A matriz pré-calculada anterior foi mantida.")
+        for arquivo in glob.glob(f"{glob.escape(prefixo)}_*.npy"):
+            os.remove(arquivo)
+        return None
+    matriz_tempos.flush()
+    matriz_distancias.flush()
+
+    manifesto = {
+        'gerado_em': time.strftime("%Y-%m-%d %H:%M:%S"),
+        'n_pontos': len(pontos),
+        'pontos': [[lat, lon] for lat, lon in pontos],
+        'arquivos': {metrica: os.path.basename(f"{prefixo}_{metrica}.npy") for metrica in METRICAS},
+        'metadados': {chave: metadados.get(chave) for chave in ('num_requisicoes', 'pares_cache', 'pares_consultados', 'tempo_s')},
+    }
+    temporario = f"{caminho}.tmp"
+    with open(temporario, "w", encoding="utf-8") as f:
+        json.dump(manifesto, f)
+    os.replace(temporario, caminho)
+
+    # Remove as versões anteriores (já fora do manifesto)
+    atuais = set(manifesto['arquivos'].values())
+    for arquivo in glob.glob(os.path.join(glob.escape(pasta), f"{glob.escape(nome)}_*.npy")):
+        if os.path.basename(arquivo) not in atuais:
+            try:
+                os.remove(arquivo)
+            except OSError as e:
+                logging.warning(f"Não foi possível remover a matriz antiga {arquivo}: {e}")
+
+    logging.info(f"Matriz de {len(pontos)} pontos gravada em {caminho} ({metadados.get('num_requisicoes')} requisições, "
+                 f"{metadados.get('pares_cache')} pares do cache, {metadados.get('tempo_s')}s).")
+    return metadados
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Pré-calcula a matriz de tempos e distâncias da base de clientes.")
+    parser.add_argument("--coordenadas", default=COORDENADAS_CSV, help="CSV de clientes geocodificados (colunas Latitude e Longitude).")
+    parser.add_argument("--deposito", nargs=2, type=float, action="append", metavar=("LAT", "LON"),
+                        help="Coordenadas de um depósito (pode repetir). Padrão: endereço de partida salvo no app.")
+    parser.add_argument("--saida", default=PRE_CALCULO_PATH, help="Caminho do manifesto JSON da matriz.")
+    parser.add_argument("--requisicoes", type=int, default=None, help="Requisições OSRM simultâneas.")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    depositos = [tuple(d) for d in args.deposito] if args.deposito else []
+    if not depositos:
+        deposito = carregar_deposito_configurado()
+        if deposito:
+            depositos = [deposito]
+        else:
+            logging.warning("Nenhum depósito informado nem salvo no app: a matriz terá só os clientes.")
+
+    clientes = carregar_clientes(args.coordenadas)
+    chaves_depositos = {_chave_coordenada(lat, lon) for lat, lon in depositos}
+    pontos = depositos + [p for p in clientes if _chave_coordenada(*p) not in chaves_depositos]
+    if len(pontos) < 2:
+        logging.error("Pontos insuficientes para montar a matriz.")
+        return 1
+
+    metadados = pre_calcular_matriz_clientes(pontos, args.saida, args.requisicoes)
+    if metadados is None:
+        return 1
+    carregar_matriz_pre_calculada(args.saida) # Valida o que foi gravado
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,209 @@
+"""
+VRPTW: CVRP com janelas de tempo dos pedidos e dos veículos e tempo de serviço em cada parada.
+
+A dimensão de tempo é um trânsito nativo do OR-Tools: a matriz de tempos de viagem somada ao
+tempo de serviço do nó de origem (tempo[i][j] + serviço[i]) é registrada uma única vez, e a
+busca roda inteira em C++. Pedidos que não cabem em nenhuma janela ficam de fora da solução
+(disjunção com penalidade) em vez de tornar o dia inteiro inviável.
+"""
+import time
+import logging
+
+import numpy as np
+import pandas as pd
+from ortools.constraint_solver import pywrapcp, routing_enums_pb2
+
+from routing.distancias import MatrizEsparsa, INFINITE_VALUE
+from routing.ortools_comum import (registrar_transito_matriz, dimensoes_capacidade, registrar_dimensoes_capacidade, nome_status,
+                                   tempo_limite_adaptativo, janela_sem_melhoria, MonitorMelhoria, extrair_paradas)
+
+# --- Constantes ---
+HORIZONTE_S = 24 * 3600 # As janelas são em segundos desde 00:00 do dia da entrega
+TEMPO_SERVICO_PADRAO_S = 15 * 60 # Mesmo padrão de routing/simulador.py (default_service_time_min)
+JANELA_PEDIDO_PADRAO = ("06:00", "20:00") # Mesmos padrões de app/pedidos.py
+JANELA_VEICULO_PADRAO = ("00:00", "23:59") # Mesmos padrões de app/frota.py
+
+
+def _horario_em_segundos(valor, padrao):
+    """'HH:MM' (ou 'HH:MM:SS', datetime.time, número de minutos) -> segundos desde 00:00."""
+    if valor is None or (isinstance(valor, float) and np.isnan(valor)) or str(valor).strip() == '':
+        valor = padrao
+    if hasattr(valor, 'hour') and hasattr(valor, 'minute'):
+        return valor.hour * 3600 + valor.minute * 60 + getattr(valor, 'second', 0)
+    if isinstance(valor, (int, float, np.integer, np.floating)):
+        return int(valor * 60)
+    partes = str(valor).strip().split(':')
+    try:
+        horas, minutos = int(partes[0]), int(partes[1]) if len(partes) > 1 else 0
+        segundos = int(float(partes[2])) if len(partes) > 2 else 0
+    except ValueError:
+        logging.warning(f"VRPTW: horário inválido '{valor}', usando '{padrao}'.")
+        return _horario_em_segundos(padrao, padrao)
+    return horas * 3600 + minutos * 60 + segundos
+
+
+def _janelas(df, padrao):
+    """Listas (início, fim) em segundos a partir das colunas 'Janela Início' e 'Janela Fim'."""
+    inicios = df['Janela Início'] if 'Janela Início' in df.columns else [padrao[0]] * len(df)
+    fins = df['Janela Fim'] if 'Janela Fim' in df.columns else [padrao[1]] * len(df)
+    janelas = []
+    for inicio, fim in zip(inicios, fins):
+        inicio, fim = _horario_em_segundos(inicio, padrao[0]), _horario_em_segundos(fim, padrao[1])
+        janelas.append((min(inicio, fim, HORIZONTE_S), min(max(inicio, fim), HORIZONTE_S)))
+    return janelas
+
+
+def _tempos_servico(pedidos):
+    """Tempo de serviço (s) de cada pedido: 'Tempo de Serviço' ('HH:MM'), senão 'Janela de Descarga' (minutos), senão o padrão."""
+    if 'Tempo de Serviço' in pedidos.columns:
+        return [_horario_em_segundos(valor, TEMPO_SERVICO_PADRAO_S / 60) for valor in pedidos['Tempo de Serviço']]
+    if 'Janela de Descarga' in pedidos.columns:
+        minutos = pd.to_numeric(pedidos['Janela de Descarga'], errors='coerce').fillna(TEMPO_SERVICO_PADRAO_S / 60)
+        return (minutos * 60).astype(int).tolist()
+    return [TEMPO_SERVICO_PADRAO_S] * len(pedidos)
+
+
+def solver_vrptw(pedidos, frota, matriz_tempos, matriz_distancias=None, tempo_limite_s=None, estatisticas=None,
+                 janela_sem_melhoria_s=None, ao_melhorar=None, deve_parar=None):
+    """
+    Resolve o VRPTW (capacidade + janelas de tempo + tempo de serviço).
+
+    Args:
+        pedidos (pd.DataFrame): Pedidos com 'Peso dos Itens' e, opcionalmente, 'Janela Início', 'Janela Fim'
+                                ('HH:MM') e 'Tempo de Serviço' ('HH:MM') ou 'Janela de Descarga' (minutos).
+        frota (pd.DataFrame): Veículos com 'Capacidade (Kg)' e, opcionalmente, 'Janela Início' e 'Janela Fim'.
+        matriz_tempos (array-like): Tempos de viagem (s) com o depósito no índice 0 (ndarray, memmap ou MatrizEsparsa).
+        matriz_distancias (array-like, optional): Distâncias (m) usadas como custo dos arcos. Padrão: os tempos.
+        tempo_limite_s (float, optional): Limite de tempo da busca. Padrão: cresce com paradas e veículos,
+                                          como no CVRP (ortools_comum.tempo_limite_adaptativo).
+        estatisticas (dict, optional): Recebe 'objetivo', 'status', 'tempo_s', 'tempo_limite_s', 'parada_antecipada'
+                                       e 'pedidos_nao_atendidos'.
+        janela_sem_melhoria_s (float, optional): Encerra a busca se o objetivo não melhorar por este tempo.
+                                                 Padrão: uma fração do limite; 0 desliga.
+        ao_melhorar (function, optional): Recebe cada nova melhor solução ({'objetivo', 'veiculos', 'tempo_s'}).
+        deve_parar (function, optional): Se retornar True, a busca termina com a melhor solução até ali.
+
+    Returns:
+        pd.DataFrame: Uma linha por parada ('Veículo', 'Sequencia', 'Node_Index_OR', 'Pedido_Index_DF',
+                      'tempo_chegada', 'tempo_saida' em segundos desde 00:00, ...). Vazio se não houver solução.
+    """
+    if pedidos.empty or frota.empty:
+        logging.warning("VRPTW Solver: pedidos ou frota vazios.")
+        return pd.DataFrame()
+    if not isinstance(matriz_tempos, (list, np.ndarray, MatrizEsparsa)) or len(matriz_tempos) != len(pedidos) + 1:
+        logging.error("VRPTW Solver: matriz de tempos ausente ou com tamanho diferente de pedidos + depósito.")
+        return pd.DataFrame()
+
+    pedidos = pedidos.reset_index(drop=True)
+    frota = frota.reset_index(drop=True)
+    n_pedidos, n_veiculos = len(pedidos), len(frota)
+    depot_index = 0
+
+    # --- Dados ---
+    tempos = np.asarray(matriz_tempos).astype(np.int64)
+    custos = tempos if matriz_distancias is None else np.asarray(matriz_distancias)
+    servicos = np.asarray([0] + _tempos_servico(pedidos), dtype=np.int64)
+    # Trânsito de tempo: viagem i -> j + serviço em i (o veículo só sai depois de atender)
+    transito_tempo = np.minimum(tempos + servicos[:, None], INFINITE_VALUE)
+    np.fill_diagonal(transito_tempo, 0)
+
+    dimensoes = dimensoes_capacidade(pedidos, frota) # Peso e, se cadastradas, caixas
+
+    janelas_pedidos = _janelas(pedidos, JANELA_PEDIDO_PADRAO)
+    janelas_veiculos = _janelas(frota, JANELA_VEICULO_PADRAO)
+    identificadores = (frota['ID Veículo'] if 'ID Veículo' in frota.columns else
+                       frota['Placa'] if 'Placa' in frota.columns else
+                       pd.Series([f'veiculo_{v+1}' for v in range(n_veiculos)])).tolist()
+
+    # --- Modelo ---
+    try:
+        manager = pywrapcp.RoutingIndexManager(n_pedidos + 1, n_veiculos, depot_index)
+        routing = pywrapcp.RoutingModel(manager)
+
+        custo_index = registrar_transito_matriz(routing, manager, custos)
+        routing.SetArcCostEvaluatorOfAllVehicles(custo_index)
+
+        registrar_dimensoes_capacidade(routing, dimensoes)
+
+        tempo_index = registrar_transito_matriz(routing, manager, transito_tempo)
+        # Folga = espera permitida antes da abertura da janela; início livre (o veículo sai quando convém)
+        routing.AddDimension(tempo_index, HORIZONTE_S, HORIZONTE_S, False, 'Time')
+        time_dimension = routing.GetDimensionOrDie('Time')
+        for i, (inicio, fim) in enumerate(janelas_pedidos):
+            time_dimension.CumulVar(manager.NodeToIndex(i + 1)).SetRange(inicio, fim)
+        for v, (inicio, fim) in enumerate(janelas_veiculos):
+            time_dimension.CumulVar(routing.Start(v)).SetRange(inicio, fim)
+            time_dimension.CumulVar(routing.End(v)).SetRange(inicio, fim)
+            routing.AddVariableMinimizedByFinalizer(time_dimension.CumulVar(routing.Start(v)))
+            routing.AddVariableMinimizedByFinalizer(time_dimension.CumulVar(routing.End(v)))
+
+        # Pedido fora de qualquer janela sai da solução com uma penalidade maior que qualquer rota
+        penalidade = int(min(np.asarray(custos).max(), INFINITE_VALUE)) * 10 + 1
+        for i in range(1, n_pedidos + 1):
+            routing.AddDisjunction([manager.NodeToIndex(i)], penalidade)
+    except Exception as e:
+        logging.error(f"VRPTW Solver: erro na configuração do OR-Tools: {e}")
+        return pd.DataFrame()
+
+    # --- Busca ---
+    if tempo_limite_s is None:
+        tempo_limite_s = tempo_limite_adaptativo(n_pedidos + 1, n_veiculos)
+    search_parameters = pywrapcp.DefaultRoutingSearchParameters()
+    # Inserção paralela respeita as janelas melhor que PATH_CHEAPEST_ARC na solução inicial
+    search_parameters.first_solution_strategy = routing_enums_pb2.FirstSolutionStrategy.PARALLEL_CHEAPEST_INSERTION
+    search_parameters.local_search_metaheuristic = routing_enums_pb2.LocalSearchMetaheuristic.GUIDED_LOCAL_SEARCH
+    search_parameters.time_limit.FromMilliseconds(int(tempo_limite_s * 1000))
+
+    logging.info(f"VRPTW Solver: {n_pedidos} pedidos, {n_veiculos} veículos, limite de {tempo_limite_s:.0f}s.")
+    monitor = MonitorMelhoria(routing, janela_sem_melhoria(tempo_limite_s, janela_sem_melhoria_s),
+                              ao_melhorar=ao_melhorar, deve_parar=deve_parar, manager=manager)
+    routing.AddAtSolutionCallback(monitor)
+    solution = routing.SolveWithParameters(search_parameters)
+    monitor.relancar_erro()
+    if estatisticas is not None:
+        estatisticas.update({'objetivo': solution.ObjectiveValue() if solution else None, 'status': nome_status(routing),
+                             'tempo_s': round(time.time() - monitor.inicio, 3), 'tempo_limite_s': tempo_limite_s,
+                             'parada_antecipada': monitor.parada_antecipada})
+    if not solution:
+        logging.warning(f"VRPTW Solver: nenhuma solução encontrada (status {nome_status(routing)}).")
+        return pd.DataFrame()
+
+    # --- Resultado ---
+    # O percurso só coleta os nós; as colunas saem de uma vez sobre os arrays, como no solver_cvrp
+    veiculos, sequencias, nos, _ = extrair_paradas(routing, manager, solution)
+    indices = nos - 1 # Índice no DataFrame 'pedidos' (o nó 0 é o depósito)
+
+    def _coluna(colunas, padrao):
+        coluna = next((c for c in colunas if c in pedidos.columns), None)
+        return pedidos[coluna].to_numpy()[indices] if coluna is not None else padrao
+
+    # Horário de chegada: o CumulVar de tempo tem folga (espera), então é lido da solução, um valor por parada
+    chegadas = np.fromiter((solution.Min(time_dimension.CumulVar(manager.NodeToIndex(no))) for no in nos.tolist()),
+                           dtype=np.int64, count=len(nos))
+    rotas_df = pd.DataFrame({
+        'Veículo': np.asarray(identificadores, dtype=object)[veiculos],
+        'Sequencia': sequencias,
+        'Node_Index_OR': nos,
+        'Pedido_Index_DF': indices,
+        'ID Pedido': _coluna(('ID Pedido',), [f'Pedido_{i}' for i in indices]),
+        'Cliente': _coluna(('Cliente', 'Nome Cliente'), 'N/A'),
+        'Endereço': _coluna(('Endereço', 'Endereço Completo'), 'N/A'),
+    })
+    # Carga acumulada ao chegar = demandas das paradas anteriores da mesma rota (as capacidades não têm folga)
+    inicio_rota = np.searchsorted(veiculos, veiculos)
+    for nome, demandas, _ in dimensoes:
+        sufixo = nome.replace('Capacity', '') # 'Capacity' -> '', 'Capacity_Cx' -> '_Cx'
+        demanda = np.asarray(demandas, dtype=np.int64)[nos]
+        anteriores = np.cumsum(demanda) - demanda
+        rotas_df['Demanda' + sufixo] = demanda
+        rotas_df['Carga_Acumulada' + sufixo] = anteriores - anteriores[inicio_rota]
+    rotas_df['tempo_chegada'] = chegadas
+    rotas_df['tempo_saida'] = chegadas + servicos[nos]
+    nao_atendidos = n_pedidos - len(rotas_df)
+    if estatisticas is not None:
+        estatisticas['pedidos_nao_atendidos'] = nao_atendidos
+    if nao_atendidos:
+        logging.warning(f"VRPTW Solver: {nao_atendidos} pedidos não couberam nas janelas de tempo ou na capacidade.")
+    logging.info(f"VRPTW Solver: {len(rotas_df)} paradas em {rotas_df['Veículo'].nunique() if not rotas_df.empty else 0} veículos "
+                 f"(status {nome_status(routing)}).")
+    return rotas_df